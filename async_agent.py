@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+AI Agent Level 5 - Async Engine
+Runs many independent agent sessions concurrently on one asyncio event loop
+"""
+
+import os
+import sys
+import json
+import uuid
+import asyncio
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Any
+
+import httpx
+
+from main import (
+    BeautifulUI,
+    QuietUI,
+    CentralBrain,
+    ToolExecutor,
+    LLMBackend,
+    MistralBackend,
+    CachedBackend,
+    ShellJob,
+    ShellManager,
+    Tracer,
+    WireMessage,
+)
+
+
+class AsyncShellJob(ShellJob):
+    """A shell job whose process is an asyncio subprocess, read by a task on the event loop"""
+
+    def _start_reader(self) -> asyncio.Task:
+        return asyncio.get_running_loop().create_task(self._read_async())
+
+    @property
+    def reader(self) -> asyncio.Task:
+        return self._reader
+
+    async def _read_async(self):
+        with open(self.log_path, 'wb') as log:
+            while True:
+                chunk = await self.process.stdout.read(65536)
+                if not chunk:
+                    break
+                self._output(log, chunk)
+        self._exited(await self.process.wait())
+
+
+class AsyncToolExecutor(ToolExecutor):
+    """Executes tools without blocking the event loop"""
+
+    # One pooled HTTP client per event loop, shared by every session on it
+    _http_clients: Dict[int, httpx.AsyncClient] = {}
+
+    async def execute_async(self, tool_name: str, tool_input: Dict) -> str:
+        """Execute a tool and return result as string"""
+        if tool_name not in ("execute_shell", "web_search"):
+            # File tools and sub-agents are short or already threaded
+            return await asyncio.to_thread(self.execute, tool_name, tool_input)
+
+        with self.tracer.span("tool", tool=tool_name) as span:
+            result = await self._dispatch_async(tool_name, tool_input)
+            if tool_name in self.MUTATING_TOOLS:
+                self.forget_results()
+            self._trace_result(span, tool_input, result)
+            return result
+
+    async def _dispatch_async(self, tool_name: str, tool_input: Dict) -> str:
+        if self.allowed_tools is not None and tool_name not in self.allowed_tools:
+            return f"Error: Tool '{tool_name}' is not available to this agent"
+
+        try:
+            if tool_name == "execute_shell":
+                return await self._execute_shell_async(
+                    tool_input.get("command", ""),
+                    tool_input.get("timeout"),
+                    tool_input.get("background", False),
+                    tool_input.get("session")
+                )
+
+            results = await self._web_search_async(tool_input.get("query", ""))
+            return json.dumps(results, indent=2)
+
+        except Exception as e:
+            return f"Error executing {tool_name}: {str(e)}"
+
+    async def execute_many_async(self, calls: List[tuple]) -> List[str]:
+        """Execute (tool_name, tool_input) pairs concurrently, results in call order"""
+        semaphore = asyncio.Semaphore(max(self.max_workers, 1))
+
+        async def run(name: str, args: Dict) -> str:
+            async with semaphore:
+                timeout = self.call_timeout(name, args)
+                try:
+                    return await asyncio.wait_for(self.execute_async(name, args), timeout)
+                except asyncio.TimeoutError:
+                    return f"Error executing {name}: timed out after {timeout}s"
+
+        return list(await asyncio.gather(*(run(name, args) for name, args in calls)))
+
+    async def _execute_shell_async(self, command: str, timeout: Optional[float] = None,
+                                   background: bool = False, session: Optional[str] = None) -> str:
+        if background:
+            # Background jobs may outlive the event loop, so they keep their reader thread
+            return self._execute_shell(command, timeout, background, session)
+
+        # Same shell sessions as the sync path, but the process is an asyncio subprocess
+        session = session or "default"
+        job_id, cwd, state_dir, script = await asyncio.to_thread(self.shell.prepare, command, session)
+        process = await asyncio.create_subprocess_shell(
+            script,
+            executable=self.shell.shell,
+            cwd=cwd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=self.shell.shell is not None
+        )
+        job = self.shell.track(AsyncShellJob(job_id, command, session, process,
+                                             self.shell.log_dir / f"{job_id}.log", state_dir))
+        wait = min(30 if timeout is None else float(timeout), ShellManager.MAX_WAIT)
+        try:
+            # A command still running afterwards goes on as a background job
+            await asyncio.wait_for(asyncio.shield(job.reader), wait)
+        except asyncio.TimeoutError:
+            pass
+        return await asyncio.to_thread(self.shell.finish, job)
+
+    @classmethod
+    def http_client(cls) -> httpx.AsyncClient:
+        """Pooled async HTTP client for the running event loop"""
+        loop_id = id(asyncio.get_running_loop())
+        client = cls._http_clients.get(loop_id)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=10,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                transport=httpx.AsyncHTTPTransport(retries=2)
+            )
+            cls._http_clients[loop_id] = client
+        return client
+
+    @classmethod
+    async def close_http_client(cls):
+        client = cls._http_clients.pop(id(asyncio.get_running_loop()), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _web_search_async(self, query: str) -> List[Dict]:
+        key = self._search_key(query)
+        cached = await asyncio.to_thread(self.search_cache.get, key)
+        if cached is not None:
+            return cached
+
+        try:
+            params = {
+                'q': query,
+                'format': 'json',
+                'no_html': 1
+            }
+
+            response = await self.http_client().get(self.search_url, params=params)
+            response.raise_for_status()
+            data = response.json()
+
+        except httpx.TimeoutException:
+            return [{"error": "Search failed: the search service timed out", "type": "timeout"}]
+        except httpx.HTTPStatusError as e:
+            return [{"error": f"Search failed: HTTP {e.response.status_code} from search service", "type": "http_error"}]
+        except httpx.TransportError as e:
+            return [{"error": f"Search failed: could not connect ({e})", "type": "connection_error"}]
+        except ValueError:
+            return [{"error": "Search failed: search service returned invalid JSON", "type": "invalid_response"}]
+
+        results = self._search_results(data)
+        await asyncio.to_thread(self.search_cache.set, key, results)
+        return results
+
+
+class AsyncCentralBrain(CentralBrain):
+    """CentralBrain whose turns run on the event loop via the async Mistral client
+
+    Journal writes, snapshots and trace flushes go to a writer thread of the
+    session (in order) and context compaction runs in a worker thread, so
+    one session's disk I/O never holds up the others on the loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("tool_executor") is None:
+            kwargs["tool_executor"] = AsyncToolExecutor(
+                max_workers=kwargs.get("max_tool_workers", 4) if kwargs.get("parallel_tools", True) else 1,
+                timeouts=kwargs.get("tool_timeouts"),
+                ui=kwargs.get("ui", BeautifulUI),
+                allowed_tools=kwargs.get("allowed_tools")
+            )
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-writer")
+        self._writes: List[Future] = []
+        super().__init__(*args, **kwargs)
+
+    async def chat(self, user_message: str) -> str:
+        """Send message to AI and get response"""
+        self._budget = await self.governor.admit_async(self.tenant, self.session_tokens)
+        try:
+            with self._turn(user_message):
+                self._append_message({
+                    "role": "user",
+                    "content": user_message
+                })
+                self._select_skills(user_message)
+                self._select_tools(user_message)
+
+                self.ui.ai_thinking()
+
+                message = await self._complete_async()
+                return await self._process_response_async(message)
+        finally:
+            # The turn is over once its journal records are on disk
+            writes, self._writes = self._writes, []
+            await asyncio.gather(*(asyncio.wrap_future(write) for write in writes))
+
+    def _write(self, action, *args):
+        """Queue disk I/O on the session's writer thread, in order, with the current trace context"""
+        context = contextvars.copy_context()
+        self._writes.append(self._writer.submit(context.run, action, *args))
+
+    def _persist(self, message: WireMessage):
+        self._write(self.journal.record, message)
+
+    def _flush(self):
+        self._write(self.tracer.flush)
+
+    async def _complete_async(self, final: bool = False):
+        """Ask the model for the next assistant message (with tools disabled if final)"""
+        # Compaction (and its model-written summary, as in the sync path) runs on a worker thread
+        await asyncio.to_thread(self._fit_context)
+
+        tier = self.router.tier_for(self._hop)
+        self._hop += 1
+        options = {"tool_choice": "none"} if final else {}
+        message, usage, shown = await self._complete_on_async(tier, options)
+        escalation = self.router.escalation(tier, message)
+        if escalation:
+            self.ui.system_msg(f"Asking the {escalation} model", "PROCESS")
+            message, usage, shown = await self._complete_on_async(escalation, options)
+        if self.stream and not shown:
+            self._show_reply(message)
+
+        self._observe_completion(message, usage)
+        return message
+
+    async def _complete_on_async(self, tier: str, options: Optional[Dict] = None) -> tuple:
+        """(message, usage, shown) from the first model of the tier that answers"""
+        stream = self.stream and not self.router.holds_back(tier)
+
+        async def send(model: str) -> tuple:
+            with self._completion_span(model, tier, stream) as span:
+                if stream:
+                    accumulator = self._accumulator(tier)
+                    events = await self.backend.stream_async(
+                        model=model,
+                        messages=self._request_messages(),
+                        tools=self.turn_tools,
+                        **(options or {})
+                    )
+                    async with events:
+                        async for event in events:
+                            accumulator.add(event.data)
+                    span["render_ms"] = round(accumulator.render_seconds * 1000, 3)
+                    message, usage = accumulator.finish()
+                    shown = not accumulator.held
+                else:
+                    response = await self.backend.complete_async(
+                        model=model,
+                        messages=self._request_messages(),
+                        tools=self.turn_tools,
+                        **(options or {})
+                    )
+                    message, usage, shown = response.choices[0].message, response.usage, False
+                self._trace_completion(span, message, usage)
+            return message, usage, shown
+
+        _, (message, usage, shown) = await self.router.call_async(tier, send, self._model_failed)
+        self._charge(usage)
+        return message, usage, shown
+
+    def close(self):
+        # Queued journal records land before the final snapshot
+        self._writer.shutdown(wait=True)
+        super().close()
+
+    async def _process_response_async(self, message) -> str:
+        """Process an assistant message and handle tool calls"""
+        while message.tool_calls:
+            calls = self._begin_tool_calls(message)
+            results = await self.tool_executor.execute_many_async(calls)
+            self._record_tool_results(message, calls, results)
+
+            reason = self._out_of_budget()
+            if reason:
+                final = None if self._budget.out_of_tokens() else await self._complete_async(final=True)
+                return self._partial_answer(reason, final)
+
+            self.ui.ai_thinking("AI is processing tool results...")
+            message = await self._complete_async()
+
+        return self._finish_response(message)
+
+
+class AsyncAgentHost:
+    """Hosts many concurrent sessions in one process with one shared backend/client"""
+
+    def __init__(self, api_key: str = None, client: Any = None, ui=QuietUI,
+                 backend: Optional[LLMBackend] = None, tracer: Optional[Tracer] = None,
+                 response_cache: Optional[bool] = None, **brain_kwargs):
+        self.api_key = api_key or os.getenv("MISTRAL_API_KEY")
+        if not self.api_key and client is None and backend is None:
+            raise ValueError(
+                "No API key found! Set MISTRAL_API_KEY environment variable or pass api_key parameter.\n"
+                "Get your key from: https://console.mistral.ai/"
+            )
+
+        self.backend = backend or MistralBackend(self.api_key, client=client)
+        if response_cache is None:
+            response_cache = os.getenv("AGENT_LLM_CACHE", "").lower() in ("1", "true", "yes")
+        if response_cache and not isinstance(self.backend, CachedBackend):
+            # Wrapped once here so every session shares the in-memory tier
+            self.backend = CachedBackend(self.backend)
+        # One trace and one set of metrics for every session in this process
+        self.tracer = tracer or Tracer(
+            f"./memory/traces/host_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+            "./memory/metrics.prom"
+        )
+        self.ui = ui
+        self.brain_kwargs = brain_kwargs
+        self.sessions: Dict[str, AsyncCentralBrain] = {}
+        self._turn_locks: Dict[str, asyncio.Lock] = {}
+
+    def open_session(self, session_id: Optional[str] = None) -> str:
+        """Create (or return) a session with its own message history"""
+        if session_id is None:
+            session_id = f"{datetime.now().strftime('%Y%m%d')}_{uuid.uuid4().hex[:8]}"
+        if session_id not in self.sessions:
+            self.sessions[session_id] = AsyncCentralBrain(
+                backend=self.backend,
+                tracer=self.tracer,
+                session_id=session_id,
+                ui=self.ui,
+                **self.brain_kwargs
+            )
+            self._turn_locks[session_id] = asyncio.Lock()
+        return session_id
+
+    async def chat(self, session_id: str, user_message: str) -> str:
+        """Run one turn; turns of the same session never overlap"""
+        self.open_session(session_id)
+        async with self._turn_locks[session_id]:
+            return await self.sessions[session_id].chat(user_message)
+
+    def close_session(self, session_id: str):
+        brain = self.sessions.pop(session_id, None)
+        self._turn_locks.pop(session_id, None)
+        if brain is not None:
+            brain.close()
+
+    async def close(self):
+        for session_id in list(self.sessions):
+            self.close_session(session_id)
+        self.tracer.close()
+        await AsyncToolExecutor.close_http_client()
+
+
+async def run_prompts(prompts: List[str]) -> List[str]:
+    """Answer each prompt in its own session, all at once"""
+    host = AsyncAgentHost()
+    try:
+        sessions = [host.open_session() for _ in prompts]
+        return await asyncio.gather(*(host.chat(s, p) for s, p in zip(sessions, prompts)))
+    finally:
+        await host.close()
+
+
+def main():
+    """Answer every prompt given on the command line concurrently"""
+    prompts = sys.argv[1:]
+    if not prompts:
+        print("Usage: python async_agent.py \"prompt one\" \"prompt two\" ...")
+        return 1
+
+    try:
+        answers = asyncio.run(run_prompts(prompts))
+    except ValueError as e:
+        BeautifulUI.error_box("CONFIGURATION ERROR", str(e))
+        return 1
+
+    for prompt, answer in zip(prompts, answers):
+        print(f"YOU > {prompt}")
+        BeautifulUI.ai_response(answer)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
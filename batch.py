@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+AI Agent Level 5 - Batch Runner
+Answers every prompt of a JSONL file, each in its own session, a few at a time
+
+    python batch.py prompts.jsonl -o results.jsonl [--concurrency 8] [--cache] [--retry-failed] [--limit N]
+
+Each input line is a JSON object with the prompt in "prompt" (or "body",
+"content", "text") and an optional "id" (or "request_id"); a bare JSON
+string is a prompt too. An id already used by an earlier line gets
+"@line-<n>" appended. Each result is appended to the output as soon as
+its item finishes, so rerunning the same command after a crash skips the
+items already written.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import threading
+from itertools import islice
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Any
+
+from main import (
+    BeautifulUI,
+    QuietUI,
+    CentralBrain,
+    LLMBackend,
+    MistralBackend,
+    CachedBackend,
+    Tracer,
+    RequestScheduler,
+    _message_field,
+    _tool_call_name,
+    _tool_call_arguments,
+)
+
+PROMPT_FIELDS = ("prompt", "body", "content", "text")
+ID_FIELDS = ("id", "request_id")
+
+
+def read_items(path: str) -> Iterator[Dict]:
+    """{"id", "prompt", "error"} for each line, read lazily; ids are unique within the file"""
+    seen = set()
+
+    def unique(item_id: Any, number: int) -> str:
+        # A repeated id would share a session and a results row with the first one
+        item_id = str(item_id)
+        if item_id in seen:
+            item_id = f"{item_id}@line-{number}"
+        seen.add(item_id)
+        return item_id
+
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {"id": unique(f"line-{number}", number), "prompt": None,
+                       "error": f"Invalid JSON on line {number}: {e}"}
+                continue
+
+            if isinstance(record, str):
+                yield {"id": unique(f"line-{number}", number), "prompt": record}
+                continue
+
+            item_id = next((record[k] for k in ID_FIELDS if record.get(k) is not None), f"line-{number}")
+            prompt = next((record[k] for k in PROMPT_FIELDS if record.get(k)), None)
+            if prompt is not None and record.get("title") and prompt != record["title"]:
+                # Backlog-style items: the title is part of the ask
+                prompt = f"{record['title']}\n\n{prompt}"
+            yield {"id": unique(item_id, number), "prompt": prompt,
+                   "error": None if prompt else f"No prompt field ({', '.join(PROMPT_FIELDS)}) on line {number}"}
+
+
+def completed_ids(path: str, retry_failed: bool = False) -> set:
+    """Ids already in the output file; a torn last line from a crash is ignored"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if retry_failed and result.get("status") != "ok":
+                continue
+            done.add(str(result.get("id")))
+    return done
+
+
+def tool_trace(messages: List[Any]) -> List[Dict]:
+    """The tool calls of one turn with the size of each result"""
+    results = {
+        _message_field(m, "tool_call_id"): _message_field(m, "content", "")
+        for m in messages if _message_field(m, "role") == "tool"
+    }
+    trace = []
+    for message in messages:
+        for call in _message_field(message, "tool_calls") or []:
+            result = str(results.get(_message_field(call, "id"), ""))
+            trace.append({
+                "tool": _tool_call_name(call),
+                "arguments": _tool_call_arguments(call),
+                "result_chars": len(result),
+                "error": result.startswith("Error")
+            })
+    return trace
+
+
+class BatchRunner:
+    """Runs items through independent CentralBrain sessions with bounded concurrency"""
+
+    # Item sessions are journaled here, where --resume and search_memory do not look
+    JOURNAL_DIR = "./memory/batch"
+
+    def __init__(self, output_path: str, concurrency: int = 4, backend: Optional[LLMBackend] = None,
+                 ui=QuietUI, **brain_kwargs):
+        self.output_path = Path(output_path)
+        self.concurrency = max(concurrency, 1)
+        # One backend (and HTTP client) for every session
+        self.backend = backend or MistralBackend(os.getenv("MISTRAL_API_KEY"))
+        self.ui = ui
+        self.brain_kwargs = dict({"journal_dir": self.JOURNAL_DIR}, **brain_kwargs)
+        self.counts = {"ok": 0, "error": 0}
+        # Sessions of this run get their own journal files, even for retried ids
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self._lock = threading.Lock()
+
+    def session_id(self, item_id: str) -> str:
+        """Journal name of an item's session; ids that sanitize alike still get their own"""
+        digest = hashlib.sha1(item_id.encode()).hexdigest()[:8]
+        return f"batch_{self.run_id}_{re.sub(r'[^A-Za-z0-9_-]', '_', item_id)[:48]}_{digest}"
+
+    def run_item(self, item: Dict) -> Dict:
+        """Answer one item in a fresh session and describe the outcome"""
+        result = {"id": item["id"], "status": "error", "answer": None, "error": item.get("error")}
+        if item.get("prompt") is None:
+            return result
+
+        tracer = Tracer()
+        start = time.perf_counter()
+        brain = None
+        try:
+            brain = CentralBrain(
+                backend=self.backend,
+                ui=QuietUI,
+                tracer=tracer,
+                session_id=self.session_id(item["id"]),
+                **self.brain_kwargs
+            )
+            first = len(brain.messages)
+            # Interactive sessions in the same process go first
+            with RequestScheduler.priority(RequestScheduler.BATCH):
+                result["answer"] = brain.chat(item["prompt"])
+            result["status"] = "ok"
+            result["tools"] = tool_trace(brain.messages[first:])
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            if brain is not None:
+                result["session_id"] = brain.journal.session_id
+                brain.close()
+
+        result["usage"] = {
+            "prompt_tokens": tracer.tokens["prompt"],
+            "completion_tokens": tracer.tokens["completion"],
+            "api_calls": sum(row["count"] for row in tracer.summary() if row["span"].startswith("llm."))
+        }
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def _write(self, result: Dict):
+        line = json.dumps(result, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            with open(self.output_path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.counts["ok" if result["status"] == "ok" else "error"] += 1
+
+    def _prepare_output(self):
+        """Make sure appends start on a fresh line after a torn write"""
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.output_path.exists() and self.output_path.stat().st_size:
+            with open(self.output_path, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def run(self, items: Iterator[Dict], skip: Optional[set] = None, total: Optional[int] = None) -> Dict[str, int]:
+        """Process items as they are read; at most 2x concurrency are queued at once
+
+        Each result is written the moment its item finishes, whatever the
+        order the items were submitted in.
+        """
+        skip = skip or set()
+        self._prepare_output()
+        started = time.perf_counter()
+        finished = 0
+        report_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        failures = []
+
+        def report(result: Dict):
+            nonlocal finished
+            finished += 1
+            mark = "✓" if result["status"] == "ok" else "✗"
+            progress = f"{finished}/{total}" if total else str(finished)
+            detail = f"{result.get('seconds', 0):.1f}s" if result["status"] == "ok" else result["error"]
+            self.ui.system_msg(f"[{progress}] {mark} {result['id']} {detail}",
+                               "SUCCESS" if result["status"] == "ok" else "ERROR")
+
+        def finish(future):
+            # Runs on the worker thread as soon as the item is done
+            try:
+                result = future.result()
+                self._write(result)
+                with report_lock:
+                    report(result)
+            except CancelledError:
+                pass
+            except Exception as e:
+                failures.append(e)
+            finally:
+                slots.release()
+
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        try:
+            for item in items:
+                if item["id"] in skip:
+                    continue
+                slots.acquire()
+                pool.submit(self.run_item, item).add_done_callback(finish)
+        except BaseException:
+            # Items already running finish and are written; a rerun picks up the rest
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        pool.shutdown(wait=True)
+        if failures:
+            raise failures[0]
+
+        self.counts["seconds"] = round(time.perf_counter() - started, 1)
+        return dict(self.counts)
+
+
+def main():
+    """Run a batch from the command line"""
+    args = sys.argv[1:]
+
+    def option(name: str, default: Optional[str] = None) -> Optional[str]:
+        if name in args:
+            index = args.index(name)
+            value = args[index + 1]
+            del args[index:index + 2]
+            return value
+        return default
+
+    output = option("-o") or option("--output")
+    concurrency = int(option("--concurrency", "4"))
+    limit = option("--limit")
+    cache = "--cache" in args
+    retry_failed = "--retry-failed" in args
+    inputs = [a for a in args if not a.startswith("--")]
+
+    if len(inputs) != 1:
+        print(__doc__.strip())
+        return 1
+    input_path = inputs[0]
+    output = output or str(Path(input_path).with_suffix("")) + ".results.jsonl"
+
+    if not os.getenv("MISTRAL_API_KEY"):
+        BeautifulUI.error_box("CONFIGURATION ERROR", "No API key found! Set MISTRAL_API_KEY environment variable.")
+        return 1
+
+    backend = MistralBackend(os.getenv("MISTRAL_API_KEY"))
+    if cache:
+        backend = CachedBackend(backend)
+
+    skip = completed_ids(output, retry_failed=retry_failed)
+    with open(input_path, 'r') as f:
+        total = sum(1 for line in f if line.strip())
+    items = read_items(input_path)
+    if limit:
+        items = islice(items, int(limit))
+        total = min(total, int(limit))
+
+    BeautifulUI.system_msg(
+        f"Batch: {total} items from {input_path} -> {output} "
+        f"({len(skip)} already done, concurrency {concurrency})", "PROCESS"
+    )
+    runner = BatchRunner(output, concurrency=concurrency, backend=backend, ui=BeautifulUI)
+    counts = runner.run(items, skip=skip, total=max(total - len(skip), 0))
+    BeautifulUI.system_msg(
+        f"Batch finished in {counts['seconds']}s: {counts['ok']} ok, {counts['error']} failed", "SUCCESS"
+    )
+    return 0 if counts["error"] == 0 else 3
+
+
+if __name__ == "__main__":
+    exit(main())
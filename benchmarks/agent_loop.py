@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Agent loop benchmark - per-turn cost of the agent itself, with the model mocked out
+
+Drives CentralBrain through 10, 100 and 1000 turns against MockBackend (a
+scripted model with zero latency), so the numbers are the agent's own
+overhead: turn latency, tool dispatch, history serialization and memory.
+
+    python benchmarks/agent_loop.py [--turns 10,100,1000] [--tools 3] [--hops 1] [--stream] [--no-memory]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import functools
+import statistics
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from main import CentralBrain, QuietUI, completion_response, request_body  # noqa: E402
+from offline_llm import MockBackend, completion_payload, scripted_responder  # noqa: E402
+
+
+def percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+def timed(samples: list, fn):
+    """Wrap fn so every call's duration (ms) lands in samples"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            samples.append((time.perf_counter() - start) * 1000)
+    return wrapper
+
+
+class SerializingBackend(MockBackend):
+    """MockBackend that also pays (and times) the encoding of the body MistralBackend would send"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encode_ms = []
+        self.body_bytes = []
+
+    def _payload(self, request, wait=True):
+        start = time.perf_counter()
+        body = request_body(request)
+        self.encode_ms.append((time.perf_counter() - start) * 1000)
+        self.body_bytes.append(len(body))
+        return super()._payload(request, wait)
+
+
+def run(turns: int, tools_per_hop: int, tool_hops: int, stream: bool, trace_memory: bool = False) -> dict:
+    """One fresh session driven for `turns` turns
+
+    tracemalloc slows every allocation down, so memory is measured in its own
+    pass and the timings of that pass are discarded.
+    """
+    backend = SerializingBackend(scripted_responder(tool_hops=tool_hops, tools_per_hop=tools_per_hop))
+    brain = CentralBrain(backend=backend, ui=QuietUI, stream=stream, skills_dir="./skills")
+
+    dispatch_ms, tool_ms, journal_ms = [], [], []
+    brain.tool_executor.execute_many = timed(dispatch_ms, brain.tool_executor.execute_many)
+    brain.tool_executor.execute = timed(tool_ms, brain.tool_executor.execute)
+    brain.journal.record = timed(journal_ms, brain.journal.record)
+
+    if trace_memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    turn_ms = []
+    for i in range(turns):
+        start = time.perf_counter()
+        brain.chat(f"Benchmark turn {i}: list the files here")
+        turn_ms.append((time.perf_counter() - start) * 1000)
+    current, peak = tracemalloc.get_traced_memory()
+    if trace_memory:
+        tracemalloc.stop()
+
+    brain.close()
+
+    # Dispatch overhead: time in execute_many not spent inside a tool
+    tool_time_per_hop = sum(tool_ms) / max(len(dispatch_ms), 1)
+    return {
+        "turns": turns,
+        "turn_p50": percentile(turn_ms, 0.50),
+        "turn_p95": percentile(turn_ms, 0.95),
+        "dispatch_overhead": max(statistics.mean(dispatch_ms) - tool_time_per_hop, 0.0) if dispatch_ms else 0.0,
+        "tool": statistics.mean(tool_ms) if tool_ms else 0.0,
+        "encode_p50": percentile(backend.encode_ms, 0.50),
+        "encode_p95": percentile(backend.encode_ms, 0.95),
+        "body_kb": backend.body_bytes[-1] / 1024,
+        "journal": statistics.mean(journal_ms),
+        "messages": len(brain.messages),
+        "compactions": brain.context.compactions,
+        "mem_growth_kb": (current - baseline) / 1024,
+        "mem_per_turn_kb": (current - baseline) / 1024 / turns,
+        "peak_kb": (peak - baseline) / 1024
+    }
+
+
+def main():
+    turns = [10, 100, 1000]
+    if "--turns" in sys.argv:
+        turns = [int(n) for n in sys.argv[sys.argv.index("--turns") + 1].split(",")]
+    tools_per_hop = int(sys.argv[sys.argv.index("--tools") + 1]) if "--tools" in sys.argv else 3
+    tool_hops = int(sys.argv[sys.argv.index("--hops") + 1]) if "--hops" in sys.argv else 1
+    stream = "--stream" in sys.argv
+    memory = "--no-memory" not in sys.argv
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # Real prompt and skills, throwaway memory/ and a small directory for list_files
+        for name in ("boot.md", "skills"):
+            source = ROOT / name
+            if source.exists():
+                os.symlink(source, Path(workdir) / name)
+        for i in range(20):
+            (Path(workdir) / f"file_{i}.txt").write_text("x" * 100)
+
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            # Load the SDK models up front so the first turn doesn't pay for the import
+            completion_response(completion_payload("warm-up"))
+            for n in turns:
+                result = run(n, tools_per_hop, tool_hops, stream)
+                if memory:
+                    memory_pass = run(n, tools_per_hop, tool_hops, stream, trace_memory=True)
+                    result.update({k: memory_pass[k] for k in ("mem_growth_kb", "mem_per_turn_kb", "peak_kb")})
+                results.append(result)
+        finally:
+            os.chdir(cwd)
+
+    print(f"Agent loop benchmark (mock model, {tool_hops} hop(s) x {tools_per_hop} tool(s) per turn, "
+          f"{'streamed' if stream else 'plain'} completions)")
+    print(f"{'turns':>6} {'turn p50':>9} {'turn p95':>9} {'dispatch':>9} {'tool':>7} "
+          f"{'encode p50':>11} {'encode p95':>11} {'body':>8} {'journal':>8} {'msgs':>5} {'compact':>8} "
+          f"{'mem/turn':>9} {'mem total':>10} {'mem peak':>9}")
+    for r in results:
+        print(f"{r['turns']:>6} {r['turn_p50']:>7.2f}ms {r['turn_p95']:>7.2f}ms {r['dispatch_overhead']:>7.3f}ms "
+              f"{r['tool']:>5.2f}ms {r['encode_p50']:>9.3f}ms {r['encode_p95']:>9.3f}ms {r['body_kb']:>6.1f}KB "
+              f"{r['journal']:>6.3f}ms {r['messages']:>5} {r['compactions']:>8} "
+              f"{r['mem_per_turn_kb']:>7.1f}KB {r['mem_growth_kb']:>8.0f}KB {r['peak_kb']:>7.0f}KB")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark - import time and time to first request of the headless entry point
+
+Runs `python main.py --headless` against a local stub of the Mistral API, so
+no API key or network is needed:
+
+    python benchmarks/startup.py [--runs 5]
+"""
+
+import os
+import re
+import sys
+import time
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from offline_llm import StubServer, completion_payload  # noqa: E402
+
+
+def import_time_ms() -> float:
+    """Cumulative import time of main.py as reported by -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    for line in reversed(result.stderr.splitlines()):
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| main$", line)
+        if match:
+            return int(match.group(1)) / 1000
+    raise RuntimeError(f"Could not read import time:\n{result.stderr[-500:]}")
+
+
+def brain_ready_ms(workdir: str) -> float:
+    """Process start until a CentralBrain is constructed and ready for a prompt"""
+    code = (
+        "import time; start = time.perf_counter(); import sys; sys.path.insert(0, %r); import main; "
+        "main.CentralBrain(api_key='bench', ui=main.QuietUI); print((time.perf_counter() - start) * 1000)"
+    ) % str(ROOT)
+    result = subprocess.run([sys.executable, "-c", code], cwd=workdir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"CentralBrain init failed:\n{result.stderr[-500:]}")
+    return float(result.stdout.strip())
+
+
+def headless_run(stub: StubServer, workdir: str) -> tuple:
+    """(time to first request, total wall time) of one headless run, in ms"""
+    env = dict(os.environ, MISTRAL_API_KEY="bench", MISTRAL_SERVER_URL=stub.url)
+    stub.requests.clear()
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, str(ROOT / "main.py"), "--headless", "ping"],
+        cwd=workdir, env=env, capture_output=True, text=True
+    )
+    total = time.perf_counter() - start
+
+    if result.returncode != 0 or not stub.requests:
+        raise RuntimeError(f"Headless run failed:\n{result.stderr[-500:]}")
+    return (stub.requests[0][0] - start) * 1000, total * 1000
+
+
+def report(name: str, samples: list):
+    print(f"{name:<28} median {statistics.median(samples):8.1f} ms   min {min(samples):8.1f} ms   max {max(samples):8.1f} ms")
+
+
+def main():
+    runs = int(sys.argv[sys.argv.index("--runs") + 1]) if "--runs" in sys.argv else 5
+
+    # Every completion is a fixed one-word reply
+    stub = StubServer(responder=lambda messages, tools: completion_payload("pong")).start()
+
+    imports = [import_time_ms() for _ in range(runs)]
+
+    ready = []
+    first_request = []
+    wall = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # Same prompt and skills as a real run, isolated memory/ and workspace/
+        for name in ("boot.md", "skills"):
+            source = ROOT / name
+            if source.exists():
+                os.symlink(source, Path(workdir) / name)
+        for _ in range(runs):
+            ready.append(brain_ready_ms(workdir))
+            ttfr, total = headless_run(stub, workdir)
+            first_request.append(ttfr)
+            wall.append(total)
+
+    stub.stop()
+
+    print(f"Startup benchmark ({runs} runs, {sys.executable})")
+    report("import main", imports)
+    report("CentralBrain ready", ready)
+    report("time to first request", first_request)
+    report("headless run total", wall)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -5,30 +5,60 @@ Uses actual Mistral AI API with tool calling and conversation memory
 """
 
 import os
+import re
+import importlib.util
 import json
+import math
+import fnmatch
+import hashlib
+import heapq
+import mmap
+import random
 import time
+import shlex
+import shutil
+import signal
+import tempfile
 import subprocess
-import requests
+import threading
+import uuid
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 import sys
 
 try:
-    from colorama import Fore, Back, Style, init
-    init(autoreset=True)
+    import fcntl
 except ImportError:
-    print("Installing colorama...")
-    subprocess.run([sys.executable, "-m", "pip", "install", "colorama"], check=True)
-    from colorama import Fore, Back, Style, init
-    init(autoreset=True)
+    # Windows: registry writes are still serialised within the process
+    fcntl = None
 
 try:
-    from mistralai import Mistral
+    from colorama import Fore, Back, Style, init
+    init(autoreset=True)
 except ImportError:
-    print("Installing mistralai...")
-    subprocess.run([sys.executable, "-m", "pip", "install", "mistralai"], check=True)
-    from mistralai import Mistral
+    # Plain output without colorama; nothing else depends on it
+    class _NoColor:
+        def __getattr__(self, name):
+            return ""
+    
+    Fore = Back = Style = _NoColor()
+
+
+def mistral_client(api_key: str, server_url: Optional[str] = None):
+    """Create a Mistral client, importing the SDK only when a client is needed"""
+    try:
+        from mistralai import Mistral
+    except ImportError:
+        raise ImportError("The mistralai package is not installed. Run: pip install mistralai") from None
+    
+    # MISTRAL_SERVER_URL points the client at a local stub server (benchmarks, tests)
+    return Mistral(api_key=api_key, server_url=server_url or os.getenv("MISTRAL_SERVER_URL"))
 
 
 class BeautifulUI:
@@ -65,7 +95,7 @@ class BeautifulUI:
         print(f"\n{Fore.MAGENTA}🧠 {text}{Style.RESET_ALL}")
     
     @staticmethod
-    def tool_call(tool_name: str, inputs: Dict):
+    def tool_call(tool_name: str, inputs: Dict, call_id: str = ""):
         """Display when AI decides to use a tool"""
         print(f"\n{Fore.GREEN}╔═══ AI CALLING TOOL: {tool_name.upper()} {'═'*(55-len(tool_name))}╗")
         params_str = json.dumps(inputs, indent=2)[:200]
@@ -75,7 +105,7 @@ class BeautifulUI:
         print(f"{Fore.GREEN}╚{'═'*78}╝")
     
     @staticmethod
-    def tool_result(result: str):
+    def tool_result(result: str, tool_name: str = "", call_id: str = ""):
         """Display tool result"""
         preview = result[:100] + "..." if len(result) > 100 else result
         print(f"{Fore.GREEN}║ {Fore.YELLOW}Result: {Style.RESET_ALL}{preview}")
@@ -95,6 +125,23 @@ class BeautifulUI:
     def ai_response(text: str):
         print(f"\n{Fore.CYAN}{Style.BRIGHT}AGENT >{Style.RESET_ALL} {text}\n")
     
+    @staticmethod
+    def stream_start():
+        print(f"\n{Fore.CYAN}{Style.BRIGHT}AGENT >{Style.RESET_ALL} ", end="", flush=True)
+    
+    @staticmethod
+    def stream_token(text: str):
+        print(text, end="", flush=True)
+    
+    @staticmethod
+    def stream_end():
+        print("\n")
+    
+    @staticmethod
+    def shell_output(text: str):
+        """Command output as it is produced"""
+        print(f"{Style.DIM}{text}{Style.RESET_ALL}", end="", flush=True)
+    
     @staticmethod
     def separator():
         print(f"{Fore.WHITE}{'─'*80}")
@@ -107,191 +154,3819 @@ class BeautifulUI:
         print(f"{Fore.RED}╚{'═'*76}╝\n")
 
 
-class ToolExecutor:
-    """Executes tools when called by the AI"""
+class LLMBackend:
+    """Where completions come from; the agent loop only talks to this interface
     
-    def __init__(self):
-        self.workspace = Path("./workspace")
-        self.workspace.mkdir(exist_ok=True)
+    Backends return Mistral-shaped responses (.choices[0].message, .usage)
+    and can wrap one another, e.g. to record or cache another backend.
+    """
     
-    def execute(self, tool_name: str, tool_input: Dict) -> str:
-        """Execute a tool and return result as string"""
-        try:
-            if tool_name == "read_file":
-                return self._read_file(tool_input.get("path", ""))
-            
-            elif tool_name == "write_file":
-                return self._write_file(
-                    tool_input.get("path", ""),
-                    tool_input.get("content", "")
-                )
-            
-            elif tool_name == "execute_shell":
-                return self._execute_shell(tool_input.get("command", ""))
-            
-            elif tool_name == "web_search":
-                results = self._web_search(tool_input.get("query", ""))
-                return json.dumps(results, indent=2)
-            
-            elif tool_name == "list_files":
-                files = self._list_files(tool_input.get("directory", "."))
-                return "\n".join(files)
-            
-            elif tool_name == "spawn_sub_agent":
-                return self._spawn_sub_agent(
-                    tool_input.get("name", ""),
-                    tool_input.get("role", ""),
-                    tool_input.get("tools", [])
-                )
-            
-            else:
-                return f"Error: Unknown tool '{tool_name}'"
-        
-        except Exception as e:
-            return f"Error executing {tool_name}: {str(e)}"
+    def complete(self, **request) -> Any:
+        raise NotImplementedError
     
-    def _read_file(self, filepath: str) -> str:
-        path = Path(filepath)
-        if not path.exists():
-            return f"Error: File not found: {filepath}"
+    def stream(self, **request) -> Any:
+        """Context manager yielding events whose .data is a completion chunk"""
+        raise NotImplementedError
+    
+    async def complete_async(self, **request) -> Any:
+        import asyncio
+        return await asyncio.to_thread(self.complete, **request)
+    
+    async def stream_async(self, **request) -> Any:
+        """Awaitable async context manager yielding completion events"""
+        raise NotImplementedError
+
+# Priority of the API requests made in the current thread or task; lower goes first
+_request_priority = contextvars.ContextVar("request_priority", default=0)
+
+
+class RequestScheduler:
+    """Admission, rate limiting and retries for every API request of the process
+    
+    Requests wait for a slot in two token buckets (requests per minute and
+    tokens per minute, both optional) and are admitted in priority order:
+    interactive turns ahead of sub-agents ahead of batch work. 429, 408 and
+    5xx responses and transport errors are retried with jittered exponential
+    backoff; a Retry-After header pauses every request, not just the one
+    that got it, so load degrades into waiting instead of errors.
+    """
+    
+    INTERACTIVE, BACKGROUND, BATCH = 0, 1, 2
+    
+    RETRY_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_cap: float = 30):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
         
-        with open(path, 'r') as f:
-            content = f.read()
+        # Buckets start full so a fresh process is not throttled
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
         
-        return f"File contents of {filepath}:\n\n{content}"
+        self._queue = []
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0, "wait_seconds": 0.0}
     
-    def _write_file(self, filepath: str, content: str) -> str:
-        path = Path(filepath)
-        path.parent.mkdir(parents=True, exist_ok=True)
+    @classmethod
+    def shared(cls) -> "RequestScheduler":
+        """The process-wide scheduler, configured from MISTRAL_RPM, MISTRAL_TPM and MISTRAL_MAX_RETRIES"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                rpm = os.getenv("MISTRAL_RPM")
+                tpm = os.getenv("MISTRAL_TPM")
+                cls._shared = cls(
+                    requests_per_minute=float(rpm) if rpm else None,
+                    tokens_per_minute=float(tpm) if tpm else None,
+                    max_retries=int(os.getenv("MISTRAL_MAX_RETRIES", "5"))
+                )
+            return cls._shared
+    
+    @staticmethod
+    @contextmanager
+    def priority(level: int):
+        """Requests made inside the block (and tasks/threads copying its context) use this priority"""
+        token = _request_priority.set(level)
+        try:
+            yield
+        finally:
+            _request_priority.reset(token)
+    
+    def estimate_tokens(self, request: Dict) -> int:
+        """Rough size of a request for the tokens-per-minute bucket"""
+        if not self.tpm:
+            return 0
+        size = len(encode_messages(request.get("messages") or [])) + len(json.dumps(request.get("tools")))
+        return size // 4 + int(request.get("max_tokens") or 0)
+    
+    def _refill(self, now: float):
+        elapsed = now - self._refilled
+        self._refilled = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+    
+    def _try_admit(self, ticket: tuple, tokens: int) -> float:
+        """0 if the ticket was admitted, else how long to wait before trying again (under _cond)"""
+        now = time.monotonic()
+        self._refill(now)
+        if self._queue[0] != ticket:
+            return 0.05
         
-        with open(path, 'w') as f:
-            f.write(content)
+        waits = [self._paused_until - now]
+        if self.rpm and self._requests < 1:
+            waits.append((1 - self._requests) * 60 / self.rpm)
+        if self.tpm:
+            # A request bigger than the whole bucket is let through once the bucket is full
+            needed = min(tokens, self.tpm)
+            if self._tokens < needed:
+                waits.append((needed - self._tokens) * 60 / self.tpm)
+        wait = max(waits)
+        if wait > 0:
+            return wait
         
-        return f"Successfully wrote {len(content)} characters to {filepath}"
+        if self.rpm:
+            self._requests -= 1
+        if self.tpm:
+            self._tokens -= tokens
+        heapq.heappop(self._queue)
+        self._cond.notify_all()
+        return 0
     
-    def _execute_shell(self, command: str) -> str:
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            timeout=30
+    def _enqueue(self) -> tuple:
+        with self._cond:
+            self._sequence += 1
+            ticket = (_request_priority.get(), self._sequence)
+            heapq.heappush(self._queue, ticket)
+            return ticket
+    
+    def _withdraw(self, ticket: tuple):
+        """Drop a ticket whose caller gave up waiting (cancelled task, interrupt)"""
+        with self._cond:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+    
+    def acquire(self, tokens: int = 0) -> float:
+        """Block until a request may be sent; returns the seconds waited"""
+        start = time.monotonic()
+        ticket = self._enqueue()
+        try:
+            with self._cond:
+                while True:
+                    wait = self._try_admit(ticket, tokens)
+                    if not wait:
+                        break
+                    self._cond.wait(wait)
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+        return self._admitted(start)
+    
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """acquire() for the event loop; polls instead of blocking a thread"""
+        import asyncio
+        start = time.monotonic()
+        ticket = self._enqueue()
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(ticket, tokens)
+                if not wait:
+                    break
+                await asyncio.sleep(min(wait, 0.25))
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+        return self._admitted(start)
+    
+    def _admitted(self, start: float) -> float:
+        waited = time.monotonic() - start
+        with self._cond:
+            self.stats["requests"] += 1
+            self.stats["wait_seconds"] += waited
+            if waited > 0.01:
+                self.stats["throttled"] += 1
+        return waited
+    
+    def settle(self, estimated: int, usage: Any):
+        """Correct the tokens bucket by the real size of a finished request"""
+        if not self.tpm or usage is None:
+            return
+        actual = getattr(usage, "total_tokens", None)
+        if actual is None and isinstance(usage, dict):
+            actual = usage.get("total_tokens")
+        if actual is not None:
+            with self._cond:
+                self._tokens = min(self.tpm, self._tokens + estimated - actual)
+    
+    @staticmethod
+    def _status(error: Exception) -> Optional[int]:
+        status = getattr(error, "status_code", None)
+        if status is None:
+            status = getattr(getattr(error, "response", None), "status_code", None)
+        return status
+    
+    def retryable(self, error: Exception) -> bool:
+        """Rate limits, server errors and dropped connections are worth another try"""
+        if self._status(error) in self.RETRY_STATUS:
+            return True
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return True
+        # httpx (used by the SDK) raises subclasses of TransportError for network failures
+        return any(cls.__name__ == "TransportError" for cls in type(error).__mro__)
+    
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        """Seconds from a Retry-After header (delta or HTTP date), if the server sent one"""
+        headers = getattr(error, "headers", None)
+        if headers is None:
+            headers = getattr(getattr(error, "response", None), "headers", None)
+        value = headers.get("retry-after") if headers is not None else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            from email.utils import parsedate_to_datetime
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+    
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Delay before retry number `attempt` (from 1); a Retry-After pauses all requests"""
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_cap * 4))
+            with self._cond:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        with self._cond:
+            self.stats["retries"] += 1
+        return delay
+    
+    def _give_up(self, attempt: int, error: Exception) -> bool:
+        if attempt > self.max_retries or not self.retryable(error):
+            with self._cond:
+                self.stats["failed"] += 1
+            return True
+        return False
+    
+    def call(self, send, request: Dict) -> Any:
+        """send(**request) once admitted, retrying transient failures"""
+        tokens = self.estimate_tokens(request)
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                response = send(**request)
+            except Exception as e:
+                attempt += 1
+                if self._give_up(attempt, e):
+                    raise
+                time.sleep(self.backoff(attempt, e))
+                continue
+            self.settle(tokens, getattr(response, "usage", None))
+            return response
+    
+    async def call_async(self, send, request: Dict) -> Any:
+        """call() for coroutine functions"""
+        import asyncio
+        tokens = self.estimate_tokens(request)
+        attempt = 0
+        while True:
+            await self.acquire_async(tokens)
+            try:
+                response = await send(**request)
+            except Exception as e:
+                attempt += 1
+                if self._give_up(attempt, e):
+                    raise
+                await asyncio.sleep(self.backoff(attempt, e))
+                continue
+            self.settle(tokens, getattr(response, "usage", None))
+            return response
+
+
+class SDKChatTransport:
+    """Posts chat requests through the Mistral SDK's internals, with a prebuilt body
+    
+    The one place that relies on private SDK code (the configured HTTP client,
+    do_request and its hooks, response matching, unmarshalling, event streams).
+    It is only used with the SDK series it was written for; with any other
+    SDK, missing() names what changed and MistralBackend warns once and goes
+    through chat.complete/chat.stream. tests/test_sdk.py fails on an SDK
+    upgrade that moves any of these internals.
+    """
+    
+    SDK_SERIES = "1.12."
+    ERROR_STATUS_CODES = ["422", "4XX", "5XX"]
+    UTILS = ("get_security", "get_security_from_env", "match_response", "unmarshal_json",
+             "stream_to_text", "stream_to_text_async")
+    
+    _missing: Optional[List[str]] = None
+    _warned = False
+    
+    def __init__(self, client: Any):
+        self.client = client
+    
+    @classmethod
+    def missing(cls) -> List[str]:
+        """What the installed SDK lacks of the internals used here; empty when all is there"""
+        if cls._missing is None:
+            missing = []
+            try:
+                from mistralai import _version, models, utils
+            except ImportError as e:
+                cls._missing = [f"mistralai ({e})"]
+                return cls._missing
+            if not _version.__version__.startswith(cls.SDK_SERIES):
+                missing.append(f"mistralai {_version.__version__} (written for {cls.SDK_SERIES}x)")
+            missing += [f"mistralai.utils.{name}" for name in cls.UTILS if not hasattr(utils, name)]
+            missing += [f"mistralai.models.{name}" for name in
+                        ("Security", "ChatCompletionResponse", "CompletionEvent", "HTTPValidationError",
+                         "HTTPValidationErrorData", "SDKError") if not hasattr(models, name)]
+            for module, name in (("mistralai._hooks", "HookContext"),
+                                 ("mistralai.utils.eventstreaming", "EventStream"),
+                                 ("mistralai.utils.eventstreaming", "EventStreamAsync"),
+                                 ("mistralai.utils.unmarshal_json_response", "unmarshal_json_response"),
+                                 ("mistralai.chat", "Chat")):
+                try:
+                    found = hasattr(importlib.import_module(module), name)
+                except ImportError:
+                    found = False
+                if not found:
+                    missing.append(f"{module}.{name}")
+            if not missing:
+                from mistralai.chat import Chat
+                missing += [f"mistralai.chat.Chat.{name}" for name in ("do_request", "do_request_async")
+                            if not hasattr(Chat, name)]
+            cls._missing = missing
+        return cls._missing
+    
+    def usable(self, asynchronous: bool = False) -> bool:
+        """Whether this client can take the raw path (a test double cannot)"""
+        config = getattr(self.client, "sdk_configuration", None)
+        if config is None:
+            return False
+        if self.missing():
+            if not SDKChatTransport._warned:
+                SDKChatTransport._warned = True
+                BeautifulUI.system_msg("Mistral SDK internals changed, sending requests the slower way: "
+                                       + ", ".join(self.missing()), "WARNING")
+            return False
+        http = getattr(config, "async_client" if asynchronous else "client", None)
+        return hasattr(http, "build_request") and hasattr(getattr(self.client, "chat", None), "do_request")
+    
+    def _build(self, http: Any, request: Dict, stream: bool) -> Any:
+        from mistralai import models, utils
+        config = self.client.sdk_configuration
+        headers = {
+            "user-agent": config.user_agent,
+            "content-type": "application/json",
+            "accept": "text/event-stream" if stream else "application/json"
+        }
+        security = config.security() if callable(config.security) else config.security
+        security = utils.get_security_from_env(security, models.Security)
+        if security is not None:
+            headers.update(utils.get_security(security)[0])
+        return http.build_request(
+            "POST",
+            config.get_server_details()[0].rstrip("/") + "/v1/chat/completions",
+            content=request_body(dict(request, stream=stream)),
+            headers=headers,
+            # Like the SDK: no client-side timeout unless one is configured
+            timeout=config.timeout_ms / 1000 if config.timeout_ms else None
         )
+    
+    def _hook_context(self, stream: bool) -> Any:
+        """What the SDK's request hooks get for this operation, as the SDK's own method passes it"""
+        from mistralai import models, utils
+        from mistralai._hooks import HookContext
+        config = self.client.sdk_configuration
+        return HookContext(
+            config=config,
+            base_url="",
+            operation_id="stream_chat" if stream else "chat_completion_v1_chat_completions_post",
+            oauth2_scopes=None,
+            security_source=utils.get_security_from_env(config.security, models.Security)
+        )
+    
+    def _decode(self, response: Any, text: str) -> Any:
+        """The completion, or the same typed error the SDK raises for this response"""
+        from mistralai import models, utils
+        from mistralai.utils.unmarshal_json_response import unmarshal_json_response
+        if utils.match_response(response, "200", "application/json"):
+            return unmarshal_json_response(models.ChatCompletionResponse, response, text)
+        if utils.match_response(response, "422", "application/json"):
+            data = unmarshal_json_response(models.HTTPValidationErrorData, response, text)
+            raise models.HTTPValidationError(data, response, text)
+        # Status and Retry-After stay on the error for the scheduler
+        if utils.match_response(response, ["4XX", "5XX"], "*"):
+            raise models.SDKError("API error occurred", response, text)
+        raise models.SDKError("Unexpected response received", response, text)
+    
+    def _events(self, response: Any, stream_class: Any) -> Any:
+        from mistralai import models, utils
+        return stream_class(response, lambda raw: utils.unmarshal_json(raw, models.CompletionEvent),
+                            sentinel="[DONE]", client_ref=self.client.chat)
+    
+    def post(self, stream: bool = False, **request) -> Any:
+        from mistralai import utils
+        from mistralai.utils import eventstreaming
+        http = self.client.sdk_configuration.client
+        # do_request runs the SDK's hooks; retries are left to the scheduler
+        response = self.client.chat.do_request(
+            hook_ctx=self._hook_context(stream),
+            request=self._build(http, request, stream),
+            error_status_codes=self.ERROR_STATUS_CODES,
+            stream=stream
+        )
+        if stream and utils.match_response(response, "200", "text/event-stream"):
+            return self._events(response, eventstreaming.EventStream)
+        return self._decode(response, utils.stream_to_text(response))
+    
+    async def post_async(self, stream: bool = False, **request) -> Any:
+        from mistralai import utils
+        from mistralai.utils import eventstreaming
+        http = self.client.sdk_configuration.async_client
+        response = await self.client.chat.do_request_async(
+            hook_ctx=self._hook_context(stream),
+            request=self._build(http, request, stream),
+            error_status_codes=self.ERROR_STATUS_CODES,
+            stream=stream
+        )
+        if stream and utils.match_response(response, "200", "text/event-stream"):
+            return self._events(response, eventstreaming.EventStreamAsync)
+        return self._decode(response, await utils.stream_to_text_async(response))
+
+
+class MistralBackend(LLMBackend):
+    """The Mistral API through the official SDK, paced and retried by a RequestScheduler
+    
+    Chat requests are posted by SDKChatTransport, through the SDK's own request
+    path but with a body joined from the history's cached JSON encodings
+    (request_body), so the SDK does not re-validate and re-encode the whole
+    history on every call. Another SDK series, or a client without that
+    machinery (e.g. a test double), is called through chat.complete/chat.stream.
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, client: Any = None, server_url: Optional[str] = None,
+                 scheduler: Optional[RequestScheduler] = None):
+        self.api_key = api_key
+        self.server_url = server_url
+        self._client = client
+        self._lock = threading.Lock()
+        # Shared by every backend in the process unless one is given
+        self.scheduler = scheduler or RequestScheduler.shared()
+    
+    @property
+    def client(self):
+        # Created on first use so the SDK import stays off the startup path
+        with self._lock:
+            if self._client is None:
+                self._client = mistral_client(self.api_key, self.server_url)
+            return self._client
+    
+    def _transport(self, asynchronous: bool = False) -> Optional["SDKChatTransport"]:
+        """The raw request path for this client, or None to go through the SDK methods"""
+        transport = SDKChatTransport(self.client)
+        return transport if transport.usable(asynchronous) else None
+    
+    def complete(self, **request) -> Any:
+        transport = self._transport()
+        return self.scheduler.call(transport.post if transport else self.client.chat.complete, request)
+    
+    def stream(self, **request) -> Any:
+        # Retries cover opening the stream; a stream that breaks midway is not replayed
+        transport = self._transport()
+        send = (lambda **r: transport.post(stream=True, **r)) if transport else self.client.chat.stream
+        return self.scheduler.call(send, request)
+    
+    async def complete_async(self, **request) -> Any:
+        transport = self._transport(asynchronous=True)
+        send = transport.post_async if transport else self.client.chat.complete_async
+        return await self.scheduler.call_async(send, request)
+    
+    async def stream_async(self, **request) -> Any:
+        transport = self._transport(asynchronous=True)
+        if transport:
+            async def send(**r):
+                return await transport.post_async(stream=True, **r)
+        else:
+            send = self.client.chat.stream_async
+        return await self.scheduler.call_async(send, request)
+
+
+class ModelRouter:
+    """Which model answers each completion of a turn, falling back across models
+    
+    Models are grouped in tiers. The first completion of a turn reads the
+    request and plans, so it goes to the "large" tier; the hops after tool
+    results mostly pick the next tool call and go to the "small" tier. A
+    small-tier reply that would end the turn is re-asked of the large tier
+    when it looks unsure (empty, hedging, malformed tool arguments), or always
+    with final_tier="large"; a streamed small-tier answer stays off the screen
+    until its opening shows it will stand. A model that errors or times out is
+    followed by the rest of its tier, then the other tiers. Latency is
+    averaged per model: a tier tries its faster models first, and a model that
+    keeps failing sits out a cooldown.
+    """
+    
+    SMALL, LARGE = "small", "large"
+    
+    # Consecutive failures before a model sits out COOLDOWN seconds
+    FAILURE_THRESHOLD = 3
+    COOLDOWN = 60.0
+    # Weight of the newest call in a model's latency average
+    ALPHA = 0.2
+    # A model this many times slower than the fastest of its tier goes after it
+    SLOW_FACTOR = 2.0
+    # Small-tier final answers shorter than this are re-asked of the large tier
+    MIN_ANSWER_CHARS = 20
+    # Hedging is looked for in this much of an answer; a streamed small-tier answer is shown
+    # once this much of it arrived without any, so nothing shown is ever re-asked
+    DECIDE_CHARS = 160
+    UNSURE = re.compile(
+        r"\b(i'?m not (?:sure|certain)|i am not (?:sure|certain)|i don'?t know|i do not know|"
+        r"i can(?:'|no)?t (?:tell|determine|find|answer)|unable to (?:determine|find|answer|complete))\b",
+        re.IGNORECASE
+    )
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, tiers: Optional[Dict[str, List[str]]] = None, final_tier: Optional[str] = None):
+        self.tiers = tiers or {self.SMALL: ["mistral-small-latest"], self.LARGE: ["mistral-large-latest"]}
+        self.final_tier = final_tier
+        self.models: Dict[str, Dict] = {}
+        self.stats = {"escalations": 0, "fallbacks": 0}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls) -> "ModelRouter":
+        """The process-wide router, configured from AGENT_MODEL_SMALL, AGENT_MODEL_LARGE,
+        AGENT_MODEL_ROUTING and AGENT_FINAL_TIER"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                def models(name: str, default: str) -> List[str]:
+                    return [m.strip() for m in os.getenv(name, default).split(",") if m.strip()]
+                
+                tiers = {cls.LARGE: models("AGENT_MODEL_LARGE", "mistral-large-latest")}
+                if os.getenv("AGENT_MODEL_ROUTING", "tiered").lower() not in ("off", "0", "false", "no"):
+                    tiers[cls.SMALL] = models("AGENT_MODEL_SMALL", "mistral-small-latest")
+                cls._shared = cls(tiers, final_tier=os.getenv("AGENT_FINAL_TIER") or None)
+            return cls._shared
+    
+    def resolve(self, tier: str) -> str:
+        """The tier itself, or the large tier when it is not configured"""
+        return tier if tier in self.tiers else self.LARGE
+    
+    def tier_for(self, hop: int) -> str:
+        """Tier of the hop-th completion of a turn (0 = the one answering the user message)"""
+        return self.LARGE if hop == 0 else self.resolve(self.SMALL)
+    
+    def may_escalate(self, tier: str) -> bool:
+        """Whether a reply from this tier may still be replaced by a large-tier one"""
+        return tier != self.LARGE and self.LARGE in self.tiers
+    
+    def settled(self, tier: str, text: str) -> bool:
+        """Whether an answer from this tier that starts with text will stand as is"""
+        if not self.may_escalate(tier):
+            return True
+        head = text.lstrip()
+        return (self.final_tier != self.LARGE and len(head) >= self.DECIDE_CHARS
+                and not self.UNSURE.search(head[:self.DECIDE_CHARS]))
+    
+    def holds_back(self, tier: str) -> bool:
+        """Whether every final answer from this tier is re-asked, so it is not worth streaming"""
+        return self.final_tier == self.LARGE and self.may_escalate(tier)
+    
+    def escalation(self, tier: str, message: Any) -> Optional[str]:
+        """The tier to re-ask when a reply from `tier` should not stand as is"""
+        if not self.may_escalate(tier):
+            return None
         
-        output = f"Command: {command}\n"
-        output += f"Exit Code: {result.returncode}\n"
-        output += f"Output:\n{result.stdout}\n"
-        if result.stderr:
-            output += f"Errors:\n{result.stderr}\n"
-        
-        return output
+        if message.tool_calls:
+            unsure = False
+            for call in message.tool_calls:
+                try:
+                    if isinstance(call.function.arguments, str):
+                        json.loads(call.function.arguments)
+                except json.JSONDecodeError:
+                    unsure = True
+        else:
+            text = message.content.strip() if isinstance(message.content, str) else ""
+            unsure = (self.final_tier == self.LARGE or len(text) < self.MIN_ANSWER_CHARS
+                      or bool(self.UNSURE.search(text[:self.DECIDE_CHARS])))
+        if not unsure:
+            return None
+        with self._lock:
+            self.stats["escalations"] += 1
+        return self.LARGE
     
-    def _web_search(self, query: str) -> List[Dict]:
-        try:
-            params = {
-                'q': query,
-                'format': 'json',
-                'no_html': 1
-            }
+    def candidates(self, tier: str) -> List[str]:
+        """Models to try for a tier, in order: its own (healthy and fast first), then the others"""
+        now = time.monotonic()
+        with self._lock:
+            def state(model: str) -> Dict:
+                return self.models.get(model) or {}
             
-            response = requests.get("https://api.duckduckgo.com/", params=params, timeout=10)
-            data = response.json()
-            
-            results = []
-            if data.get('AbstractText'):
-                results.append({
-                    'title': data.get('Heading', 'Result'),
-                    'snippet': data.get('AbstractText'),
-                    'url': data.get('AbstractURL', '')
-                })
+            own = list(dict.fromkeys(self.tiers[self.resolve(tier)]))
+            known = [state(m)["latency"] for m in own if state(m).get("latency")]
+            fastest = min(known) if known else None
             
-            if data.get('RelatedTopics'):
-                for topic in data['RelatedTopics'][:5]:
-                    if isinstance(topic, dict) and 'Text' in topic:
-                        results.append({
-                            'title': topic.get('Text', '')[:100],
-                            'snippet': topic.get('Text', ''),
-                            'url': topic.get('FirstURL', '')
-                        })
+            def rank(indexed: tuple) -> tuple:
+                index, model = indexed
+                latency = state(model).get("latency")
+                slow = fastest is not None and latency is not None and latency > fastest * self.SLOW_FACTOR
+                return (state(model).get("down_until", 0) > now, slow, index)
             
-            return results if results else [{"title": "No results", "snippet": "No results found for query", "url": ""}]
+            ordered = [model for _, model in sorted(enumerate(own), key=rank)]
+            others = [m for models in self.tiers.values() for m in models if m not in ordered]
+            others = sorted(dict.fromkeys(others), key=lambda m: state(m).get("down_until", 0) > now)
+        return ordered + others
+    
+    def record(self, model: str, seconds: float, error: Optional[BaseException] = None):
+        """Account one call to a model"""
+        with self._lock:
+            state = self.models.setdefault(
+                model, {"calls": 0, "errors": 0, "failures": 0, "latency": None, "down_until": 0.0}
+            )
+            state["calls"] += 1
+            if error is None:
+                state["failures"] = 0
+                state["latency"] = seconds if state["latency"] is None else (
+                    (1 - self.ALPHA) * state["latency"] + self.ALPHA * seconds
+                )
+                return
+            state["errors"] += 1
+            state["failures"] += 1
+            if state["failures"] >= self.FAILURE_THRESHOLD:
+                state["down_until"] = time.monotonic() + self.COOLDOWN
+    
+    def call(self, tier: str, send: Any, on_error: Any = None) -> tuple:
+        """(model, send(model)) from the first candidate of the tier that answers"""
+        error = None
+        for model in self.candidates(tier):
+            if error is not None:
+                with self._lock:
+                    self.stats["fallbacks"] += 1
+            start = time.perf_counter()
+            try:
+                result = send(model)
+            except Exception as e:
+                self.record(model, time.perf_counter() - start, e)
+                if on_error:
+                    on_error(model, e)
+                error = e
+                continue
+            self.record(model, time.perf_counter() - start)
+            return model, result
+        raise error
+    
+    async def call_async(self, tier: str, send: Any, on_error: Any = None) -> tuple:
+        """call() for a send(model) that returns an awaitable"""
+        error = None
+        for model in self.candidates(tier):
+            if error is not None:
+                with self._lock:
+                    self.stats["fallbacks"] += 1
+            start = time.perf_counter()
+            try:
+                result = await send(model)
+            except Exception as e:
+                self.record(model, time.perf_counter() - start, e)
+                if on_error:
+                    on_error(model, e)
+                error = e
+                continue
+            self.record(model, time.perf_counter() - start)
+            return model, result
+        raise error
+    
+    def summary(self) -> List[Dict]:
+        """Per model: calls, errors and average latency, most used first"""
+        with self._lock:
+            rows = [
+                {"model": model, "calls": s["calls"], "errors": s["errors"], "latency": s["latency"] or 0.0}
+                for model, s in self.models.items()
+            ]
+        return sorted(rows, key=lambda row: -row["calls"])
+
+
+class BudgetExceeded(Exception):
+    """A turn was refused because its session or tenant is over budget"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TurnBudget:
+    """What one turn has used so far, checked against its governor's limits"""
+    
+    def __init__(self, governor: "BudgetGovernor", tenant: str, session_tokens: int = 0):
+        self.governor = governor
+        self.tenant = tenant
+        self.session_tokens = session_tokens
+        self.tokens = 0
+        self.hops = 0
+        self.started = time.monotonic()
+    
+    def charge(self, usage: Any) -> int:
+        """Account the tokens of one completion to the turn, session and tenant"""
+        tokens = (_message_field(usage, "prompt_tokens") or 0) + (_message_field(usage, "completion_tokens") or 0)
+        self.tokens += tokens
+        self.governor.charge(self.tenant, tokens)
+        return tokens
+    
+    def exceeded(self) -> Optional[str]:
+        """Why the turn must stop asking the model for more tool calls, if it must"""
+        governor = self.governor
+        if governor.turn_hops and self.hops >= governor.turn_hops:
+            return f"{self.hops} model calls in this turn"
+        if governor.turn_seconds and time.monotonic() - self.started >= governor.turn_seconds:
+            return f"{governor.turn_seconds:.0f}s in this turn"
+        return self.out_of_tokens()
+    
+    def out_of_tokens(self) -> Optional[str]:
+        """Which token limit the turn has reached, if any; no further completion may be made then"""
+        governor = self.governor
+        if governor.turn_tokens and self.tokens >= governor.turn_tokens:
+            return f"{self.tokens} tokens in this turn"
+        if governor.session_tokens and self.session_tokens + self.tokens >= governor.session_tokens:
+            return f"the session's {governor.session_tokens} token budget"
+        if governor.over_quota(self.tenant):
+            return f"tenant {self.tenant}'s token quota"
+        return None
+
+
+class BudgetGovernor:
+    """Token, wall-time and model-call limits per turn, session and tenant.
+
+    A turn whose budget runs out stops calling tools and, unless a token
+    limit is what ran out, gets one last completion with tools disabled,
+    so the user still receives a partial answer. A tenant's tokens are
+    counted over a sliding window across all its sessions; a new turn of a
+    tenant over quota waits up to `queue_seconds` for the window to free up
+    and is refused after that, as is a turn of a session that has used its
+    whole budget. Unset limits (None or 0) are not enforced.
+    """
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, turn_hops: Optional[int] = 25, turn_tokens: Optional[int] = None,
+                 turn_seconds: Optional[float] = 600, session_tokens: Optional[int] = None,
+                 tenant_tokens: Optional[int] = None, tenant_window: float = 3600, queue_seconds: float = 30):
+        self.turn_hops = turn_hops
+        self.turn_tokens = turn_tokens
+        self.turn_seconds = turn_seconds
+        self.session_tokens = session_tokens
+        self.tenant_tokens = tenant_tokens
+        self.tenant_window = tenant_window
+        self.queue_seconds = queue_seconds
         
-        except Exception as e:
-            return [{"error": f"Search failed: {str(e)}"}]
+        self._usage: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self.stats = {"turns": 0, "stopped": 0, "queued": 0, "refused": 0}
     
-    def _list_files(self, directory: str) -> List[str]:
-        path = Path(directory)
-        if not path.exists():
-            return [f"Error: Directory not found: {directory}"]
+    @classmethod
+    def shared(cls) -> "BudgetGovernor":
+        """The process-wide governor, configured from AGENT_TURN_MAX_HOPS, AGENT_TURN_MAX_TOKENS,
+        AGENT_TURN_MAX_SECONDS, AGENT_SESSION_MAX_TOKENS, AGENT_TENANT_MAX_TOKENS,
+        AGENT_TENANT_WINDOW and AGENT_TENANT_QUEUE_SECONDS"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                def number(name: str, default: Optional[float] = None) -> Optional[float]:
+                    value = os.getenv(name)
+                    return float(value) if value else default
+                
+                cls._shared = cls(
+                    turn_hops=int(number("AGENT_TURN_MAX_HOPS", 25)),
+                    turn_tokens=int(number("AGENT_TURN_MAX_TOKENS", 0)),
+                    turn_seconds=number("AGENT_TURN_MAX_SECONDS", 600),
+                    session_tokens=int(number("AGENT_SESSION_MAX_TOKENS", 0)),
+                    tenant_tokens=int(number("AGENT_TENANT_MAX_TOKENS", 0)),
+                    tenant_window=number("AGENT_TENANT_WINDOW", 3600),
+                    queue_seconds=number("AGENT_TENANT_QUEUE_SECONDS", 30)
+                )
+            return cls._shared
+    
+    def _window(self, tenant: str, now: float) -> deque:
+        """The tenant's (time, tokens) records inside the window (lock held)"""
+        usage = self._usage.setdefault(tenant, deque())
+        while usage and usage[0][0] <= now - self.tenant_window:
+            usage.popleft()
+        return usage
+    
+    def charge(self, tenant: str, tokens: int):
+        if tokens and self.tenant_tokens:
+            with self._lock:
+                self._window(tenant, time.monotonic()).append((time.monotonic(), tokens))
+    
+    def tenant_usage(self, tenant: str) -> int:
+        """Tokens the tenant used inside the current window"""
+        with self._lock:
+            return sum(tokens for _, tokens in self._window(tenant, time.monotonic()))
+    
+    def over_quota(self, tenant: str) -> bool:
+        return bool(self.tenant_tokens) and self.tenant_usage(tenant) >= self.tenant_tokens
+    
+    def retry_after(self, tenant: str) -> float:
+        """Seconds until enough of the tenant's usage leaves the window to get it under quota"""
+        now = time.monotonic()
+        with self._lock:
+            usage = self._window(tenant, now)
+            excess = sum(tokens for _, tokens in usage) - self.tenant_tokens
+            for stamp, tokens in usage:
+                excess -= tokens
+                if excess < 0:
+                    return max(stamp + self.tenant_window - now, 0.0)
+        return 0.0
+    
+    def _check(self, tenant: str, session_tokens: int, patience: float) -> float:
+        """Seconds to wait before the turn may start (0 = now); raises if it may not"""
+        if self.session_tokens and session_tokens >= self.session_tokens:
+            with self._lock:
+                self.stats["refused"] += 1
+            raise BudgetExceeded(f"This session has used its {self.session_tokens} token budget; start a new session")
+        if not self.over_quota(tenant):
+            return 0.0
+        wait = self.retry_after(tenant)
+        if wait > patience:
+            with self._lock:
+                self.stats["refused"] += 1
+            raise BudgetExceeded(
+                f"Tenant {tenant} is over its {self.tenant_tokens} token quota for {self.tenant_window:.0f}s; "
+                f"retry in {wait:.0f}s", retry_after=wait
+            )
+        return wait
+    
+    def _admitted(self, tenant: str, session_tokens: int, queued: bool) -> TurnBudget:
+        with self._lock:
+            self.stats["turns"] += 1
+            if queued:
+                self.stats["queued"] += 1
+        return TurnBudget(self, tenant, session_tokens)
+    
+    def admit(self, tenant: str, session_tokens: int = 0) -> TurnBudget:
+        """The budget of a new turn, after waiting out a short quota overrun"""
+        deadline = time.monotonic() + self.queue_seconds
+        queued = False
+        while True:
+            wait = self._check(tenant, session_tokens, deadline - time.monotonic())
+            if not wait:
+                return self._admitted(tenant, session_tokens, queued)
+            queued = True
+            time.sleep(wait + 0.01)
+    
+    async def admit_async(self, tenant: str, session_tokens: int = 0) -> TurnBudget:
+        """admit() without blocking the event loop"""
+        import asyncio
+        deadline = time.monotonic() + self.queue_seconds
+        queued = False
+        while True:
+            wait = self._check(tenant, session_tokens, deadline - time.monotonic())
+            if not wait:
+                return self._admitted(tenant, session_tokens, queued)
+            queued = True
+            await asyncio.sleep(wait + 0.01)
+    
+    def stopped(self):
+        with self._lock:
+            self.stats["stopped"] += 1
+
+
+class QuietUI(BeautifulUI):
+    """Renders nothing - for headless sessions and many sessions in one process"""
+    
+    @staticmethod
+    def _silent(*args, **kwargs):
+        return None
+    
+    system_msg = ai_thinking = tool_call = tool_result = agent_spawn = _silent
+    ai_response = stream_start = stream_token = stream_end = separator = error_box = shell_output = _silent
+
+
+class StreamAccumulator:
+    """Rebuilds an assistant message from streamed completion chunks"""
+    
+    def __init__(self, ui=BeautifulUI, hold: Any = None):
+        self.ui = ui
+        self.text = []
+        self.calls = []
+        self.usage = None
+        self.rendering = False
+        self.render_seconds = 0.0
+        # Text stays off the screen while hold(text so far) is true; held is set if it never went out
+        self.hold = hold
+        self.held = False
+    
+    def add(self, chunk: Any):
+        """Fold one CompletionChunk into the message, rendering its text"""
+        if chunk.usage:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        delta = chunk.choices[0].delta
+        
+        content = delta.content
+        if isinstance(content, list):
+            content = "".join(getattr(part, "text", "") for part in content)
+        if content:
+            self.text.append(content)
+            if self.hold is not None and self.hold("".join(self.text)):
+                self.held = True
+            else:
+                # Past the hold, what was held back goes out first
+                self._render("".join(self.text) if self.held else content)
+                self.hold = None
+                self.held = False
         
-        return [str(f.name) for f in path.iterdir()]
+        # Tool calls arrive as deltas: a new id/index opens a call, the rest extends it
+        for delta_call in delta.tool_calls or []:
+            index = delta_call.index if delta_call.index is not None else len(self.calls)
+            new_id = delta_call.id if delta_call.id and delta_call.id != "null" else None
+            current = next((c for c in reversed(self.calls) if c["index"] == index), None)
+            if current is None or (new_id and current["id"] and new_id != current["id"]):
+                current = {"index": index, "id": None, "name": "", "arguments": ""}
+                self.calls.append(current)
+            if new_id:
+                current["id"] = new_id
+            if delta_call.function.name:
+                current["name"] = delta_call.function.name
+            arguments = delta_call.function.arguments
+            current["arguments"] += arguments if isinstance(arguments, str) else json.dumps(arguments)
     
-    def _spawn_sub_agent(self, name: str, role: str, tools: List[str]) -> str:
-        BeautifulUI.agent_spawn(f"{name} - {role}")
+    def _render(self, text: str):
+        start = time.perf_counter()
+        if not self.rendering:
+            self.ui.stream_start()
+            self.rendering = True
+        self.ui.stream_token(text)
+        self.render_seconds += time.perf_counter() - start
+    
+    def finish(self):
+        """The complete AssistantMessage and the reported usage"""
+        from mistralai.models import AssistantMessage, FunctionCall, ToolCall
         
-        # Save agent info
-        agents_file = Path("./memory/active_agents.json")
-        agents_file.parent.mkdir(exist_ok=True)
+        if self.rendering:
+            self.ui.stream_end()
         
-        agents = []
-        if agents_file.exists():
-            with open(agents_file, 'r') as f:
-                agents = json.load(f)
+        tool_calls = [
+            ToolCall(
+                id=call["id"] or f"call_{i}",
+                type="function",
+                function=FunctionCall(name=call["name"], arguments=call["arguments"]),
+                index=i
+            )
+            for i, call in enumerate(self.calls)
+        ]
+        return AssistantMessage(content="".join(self.text), tool_calls=tool_calls or None), self.usage
+
+
+def completion_chunks(payload: Dict, piece: int = 16) -> List[Dict]:
+    """Split a completion into the streamed chunks the API would send"""
+    message = payload["choices"][0]["message"]
+    content = message.get("content") or ""
+    chunks = []
+    for i in range(0, len(content), piece):
+        chunks.append({"delta": {"content": content[i:i + piece]}})
+    for i, call in enumerate(message.get("tool_calls") or []):
+        chunks.append({"delta": {"tool_calls": [dict(call, index=i)]}})
+    
+    events = []
+    for n, chunk in enumerate(chunks or [{"delta": {"content": ""}}]):
+        last = n == max(len(chunks), 1) - 1
+        events.append({
+            "id": payload["id"],
+            "model": payload["model"],
+            "object": "chat.completion.chunk",
+            "created": payload["created"],
+            "usage": payload["usage"] if last else None,
+            "choices": [{
+                "index": 0,
+                "delta": chunk["delta"],
+                "finish_reason": payload["choices"][0]["finish_reason"] if last else None
+            }]
+        })
+    return events
+
+
+def completion_response(payload: Dict) -> Any:
+    """A chat.completion body -> the SDK's ChatCompletionResponse, exactly like a live call"""
+    from mistralai.models import ChatCompletionResponse
+    return ChatCompletionResponse.model_validate(payload)
+
+
+class ReplayStream:
+    """A stored completion played back as stream events (sync and async context manager)"""
+    
+    def __init__(self, payload: Dict):
+        from mistralai.models import CompletionEvent
+        self.events = [CompletionEvent.model_validate({"data": c}) for c in completion_chunks(payload)]
+    
+    def __enter__(self):
+        return iter(self.events)
+    
+    def __exit__(self, *exc):
+        return False
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        return False
+    
+    def __aiter__(self):
+        return self._aiter()
+    
+    async def _aiter(self):
+        for event in self.events:
+            yield event
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a TTL and an optional on-disk tier
+    
+    Values must be JSON-serializable. The disk tier stores one file per key
+    under `disk_dir`, so entries survive restarts and are shared by every
+    process using the same directory. With `max_disk_bytes` the least
+    recently used files are pruned once the directory grows past it.
+    """
+    
+    def __init__(self, max_entries: int = 256, ttl: float = 3600, disk_dir: Optional[str] = None,
+                 max_disk_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self.max_disk_bytes = max_disk_bytes
+        self._disk_bytes = None
         
-        agent_info = {
-            "name": name,
-            "role": role,
-            "tools": tools,
-            "spawned_at": datetime.now().isoformat()
-        }
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+    
+    def get(self, key: str) -> Any:
+        """Cached value for key, or None if missing or expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
         
-        agents.append(agent_info)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, 'r') as f:
+                    record = json.load(f)
+                if record["key"] == key and now - record["stored_at"] <= self.ttl:
+                    if self.max_disk_bytes:
+                        # mtime is the recency used for pruning
+                        os.utime(path)
+                    self._remember(key, record["value"], record["stored_at"])
+                    with self._lock:
+                        self.disk_hits += 1
+                    return record["value"]
+                path.unlink()
+            except (OSError, ValueError, KeyError):
+                pass
         
-        with open(agents_file, 'w') as f:
-            json.dump(agents, f, indent=2)
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def set(self, key: str, value: Any):
+        """Store a value in memory and on disk"""
+        stored_at = time.time()
+        self._remember(key, value, stored_at)
         
-        return f"Successfully spawned sub-agent '{name}' with role: {role}. It has access to tools: {', '.join(tools)}"
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump({"key": key, "stored_at": stored_at, "value": value}, f)
+                size = f.tell()
+            os.replace(tmp_path, path)
+            if self.max_disk_bytes:
+                self._account_disk(size)
+    
+    def _account_disk(self, size: int):
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(f.stat().st_size for f in self.disk_dir.glob("*.json"))
+            else:
+                self._disk_bytes += size
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            
+            # Over the limit: rescan (other processes share the directory) and drop the oldest
+            files = []
+            for f in self.disk_dir.glob("*.json"):
+                try:
+                    stat = f.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, f))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            # Prune down to 90% so this doesn't run on every write
+            for _, size, f in files:
+                if total <= self.max_disk_bytes * 0.9:
+                    break
+                f.unlink(missing_ok=True)
+                total -= size
+                self.evictions += 1
+            self._disk_bytes = total
+    
+    def _remember(self, key: str, value: Any, stored_at: float):
+        with self._lock:
+            self._entries[key] = (stored_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries)
+            }
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+    """Process-wide requests session with keep-alive pooling and retries"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET"]),
+                respect_retry_after_header=True
+            )
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+# Session and turn of the work in progress; copied into tool threads and asyncio tasks
+_trace_context = contextvars.ContextVar("trace_context", default={})
+
+
+class Tracer:
+    """Timed spans for API calls, tool calls, persistence and rendering
+    
+    Every finished span is appended to `trace_path` as one JSONL record
+    (name, start, duration and attributes such as token counts and payload
+    sizes). Durations are also aggregated per span name (and tool) for
+    p50/p95, and written in Prometheus text format to `metrics_path`.
+    Without paths the tracer only aggregates in memory.
+    """
+    
+    # Latencies kept per metric for the percentiles
+    WINDOW = 4096
+    
+    def __init__(self, trace_path: Optional[str] = None, metrics_path: Optional[str] = None):
+        self.trace_path = Path(trace_path) if trace_path else None
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        
+        self._lock = threading.Lock()
+        # Sessions of one process may flush from different threads; one metrics rewrite at a time
+        self._flush_lock = threading.Lock()
+        self._handle = None
+        self.durations: Dict[tuple, deque] = {}
+        self.counts: Dict[tuple, int] = {}
+        self.totals: Dict[tuple, float] = {}
+        self.errors: Dict[tuple, int] = {}
+        self.payload_bytes: Dict[tuple, int] = {}
+        self.tokens = {"prompt": 0, "completion": 0}
+    
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block; attributes may be added to the yielded dict"""
+        record = dict(attributes)
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            self._finish(name, record, started_at, time.perf_counter() - start)
+    
+    def _finish(self, name: str, record: Dict, started_at: float, seconds: float):
+        key = (name, record.get("tool", ""))
+        
+        with self._lock:
+            if key not in self.durations:
+                self.durations[key] = deque(maxlen=self.WINDOW)
+                self.counts[key] = 0
+                self.totals[key] = 0.0
+                self.errors[key] = 0
+            self.durations[key].append(seconds)
+            self.counts[key] += 1
+            self.totals[key] += seconds
+            if record.get("error"):
+                self.errors[key] += 1
+            for direction in ("in", "out"):
+                size = record.get(f"bytes_{direction}")
+                if size:
+                    self.payload_bytes[key + (direction,)] = self.payload_bytes.get(key + (direction,), 0) + size
+            self.tokens["prompt"] += record.get("prompt_tokens") or 0
+            self.tokens["completion"] += record.get("completion_tokens") or 0
+            
+            if self.trace_path:
+                line = {"span": name, "start": round(started_at, 6), "ms": round(seconds * 1000, 3)}
+                line.update(_trace_context.get())
+                line.update(record)
+                if self._handle is None:
+                    self.trace_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._handle = open(self.trace_path, 'a')
+                self._handle.write(json.dumps(line, default=str) + "\n")
+    
+    @staticmethod
+    def _percentile(samples: List[float], p: float) -> float:
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)] if ordered else 0.0
+    
+    def summary(self) -> List[Dict]:
+        """Per span (and tool): count, errors, p50/p95 and total seconds"""
+        with self._lock:
+            rows = [
+                {
+                    "span": name,
+                    "tool": tool,
+                    "count": self.counts[(name, tool)],
+                    "errors": self.errors[(name, tool)],
+                    "p50": self._percentile(samples, 0.50),
+                    "p95": self._percentile(samples, 0.95),
+                    "total": self.totals[(name, tool)]
+                }
+                for (name, tool), samples in self.durations.items()
+            ]
+        return sorted(rows, key=lambda row: -row["total"])
+    
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP agent_span_seconds Duration of agent operations (API calls, tools, persistence, rendering)",
+            "# TYPE agent_span_seconds summary"
+        ]
+        for row in self.summary():
+            labels = f'span="{row["span"]}"' + (f',tool="{row["tool"]}"' if row["tool"] else "")
+            lines.append(f'agent_span_seconds{{{labels},quantile="0.5"}} {row["p50"]:.6f}')
+            lines.append(f'agent_span_seconds{{{labels},quantile="0.95"}} {row["p95"]:.6f}')
+            lines.append(f'agent_span_seconds_sum{{{labels}}} {row["total"]:.6f}')
+            lines.append(f'agent_span_seconds_count{{{labels}}} {row["count"]}')
+        
+        lines += ["# HELP agent_span_errors_total Operations that raised or returned an error",
+                  "# TYPE agent_span_errors_total counter"]
+        for row in self.summary():
+            labels = f'span="{row["span"]}"' + (f',tool="{row["tool"]}"' if row["tool"] else "")
+            lines.append(f'agent_span_errors_total{{{labels}}} {row["errors"]}')
+        
+        with self._lock:
+            tokens = dict(self.tokens)
+            payload = dict(self.payload_bytes)
+        lines += ["# HELP agent_tokens_total Tokens reported by the model API",
+                  "# TYPE agent_tokens_total counter"]
+        for kind, count in tokens.items():
+            lines.append(f'agent_tokens_total{{kind="{kind}"}} {count}')
+        
+        lines += ["# HELP agent_payload_bytes_total Bytes going into and out of agent operations",
+                  "# TYPE agent_payload_bytes_total counter"]
+        for (name, tool, direction), size in sorted(payload.items()):
+            labels = f'span="{name}"' + (f',tool="{tool}"' if tool else "") + f',direction="{direction}"'
+            lines.append(f'agent_payload_bytes_total{{{labels}}} {size}')
+        return "\n".join(lines) + "\n"
+    
+    def flush(self):
+        """Flush the JSONL trace and rewrite the metrics file"""
+        with self._lock:
+            if self._handle is not None:
+                self._handle.flush()
+        if self.metrics_path:
+            with self._flush_lock:
+                self.metrics_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.metrics_path.with_suffix(".prom.tmp")
+                with open(tmp_path, 'w') as f:
+                    f.write(self.prometheus())
+                os.replace(tmp_path, self.metrics_path)
+    
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class ShellJob:
+    """One command running in a shell session, its output streamed to a log file"""
+    
+    def __init__(self, job_id: str, command: str, session: str, process: subprocess.Popen,
+                 log_path: Path, state_dir: Path, on_output=None):
+        self.id = job_id
+        self.command = command
+        self.session = session
+        self.process = process
+        self.log_path = log_path
+        self.state_dir = state_dir
+        self.on_output = on_output
+        self.started = time.monotonic()
+        self.finished = None
+        self.returncode = None
+        self.killed = False
+        self.size = 0
+        self.polled = 0
+        self.watchdog = None
+        self.done = threading.Event()
+        self._reader = self._start_reader()
+    
+    def _start_reader(self) -> Any:
+        reader = threading.Thread(target=self._read, name=f"shell-{self.id}", daemon=True)
+        reader.start()
+        return reader
+    
+    def _read(self):
+        with open(self.log_path, 'wb') as log:
+            while True:
+                chunk = self.process.stdout.read1(65536)
+                if not chunk:
+                    break
+                self._output(log, chunk)
+        self._exited(self.process.wait())
+    
+    def _output(self, log, chunk: bytes):
+        log.write(chunk)
+        log.flush()
+        self.size += len(chunk)
+        on_output = self.on_output
+        if on_output is not None:
+            on_output(chunk.decode(errors="replace"))
+    
+    def _exited(self, returncode: int):
+        self.returncode = returncode
+        self.finished = time.monotonic()
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        self.done.set()
+    
+    def kill(self):
+        if self.done.is_set():
+            return
+        self.killed = True
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+    
+    def read(self, start: int, end: int) -> str:
+        with open(self.log_path, 'rb') as f:
+            f.seek(start)
+            return f.read(max(end - start, 0)).decode(errors="replace")
+    
+    def status(self) -> str:
+        if not self.done.is_set():
+            return f"running for {time.monotonic() - self.started:.0f}s"
+        if self.killed:
+            return f"killed after {self.finished - self.started:.0f}s"
+        return f"exited with code {self.returncode} after {self.finished - self.started:.1f}s"
+
+
+class ShellManager:
+    """Shell sessions that keep cwd and exported env between commands
+    
+    Each command runs in its own process group, starting from its session's
+    last working directory and environment; when it exits in the foreground
+    its final cwd and `export -p` become the session's new state. Output goes
+    to memory/shell/<job>.log as it is produced, and only the head and tail
+    of it are returned. A command still running when its wait runs out keeps
+    going as a background job that can be polled.
+    """
+    
+    # Longest a single execute_shell call waits before handing back a job id
+    MAX_WAIT = 600
+    # Background jobs are killed after this many seconds
+    MAX_RUNTIME = 3600
+    
+    def __init__(self, log_dir: str = "./memory/shell", head_bytes: int = 4000, tail_bytes: int = 4000,
+                 ui=BeautifulUI):
+        self.log_dir = Path(log_dir)
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.ui = ui
+        self.shell = None if os.name == "nt" else (shutil.which("bash") or "/bin/sh")
+        
+        self._state_root = None
+        self.sessions: Dict[str, Dict] = {}
+        self.jobs: Dict[str, ShellJob] = {}
+        self._lock = threading.Lock()
+    
+    def _session(self, name: str) -> Dict:
+        with self._lock:
+            if self._state_root is None:
+                self._state_root = Path(tempfile.mkdtemp(prefix="agent-shell-"))
+            if name not in self.sessions:
+                self.sessions[name] = {"cwd": os.getcwd(), "env_file": None}
+            return self.sessions[name]
+    
+    def prepare(self, command: str, session: str = "default") -> tuple:
+        """(job_id, cwd, state_dir, script): what a new job of the session runs, and where
+        
+        The script is run with `self.shell -c` (as is, through the system
+        shell, when there is no POSIX shell).
+        """
+        state = self._session(session)
+        job_id = uuid.uuid4().hex[:8]
+        state_dir = self._state_root / job_id
+        state_dir.mkdir()
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        
+        if not self.shell:
+            return job_id, state["cwd"], state_dir, command
+        # Restore the session, run the command, save the session on the way out
+        script = ""
+        if state["env_file"]:
+            script += f". {shlex.quote(state['env_file'])} 2>/dev/null\n"
+        script += f"cd {shlex.quote(state['cwd'])} || exit 1\n"
+        script += (f"trap 'pwd > {shlex.quote(str(state_dir / 'cwd'))}; "
+                   f"export -p > {shlex.quote(str(state_dir / 'env'))}' EXIT\n")
+        script += command + "\n"
+        return job_id, state["cwd"], state_dir, script
+    
+    def start(self, command: str, session: str = "default", stream: bool = True) -> ShellJob:
+        """Launch a command in a session and return its job right away"""
+        job_id, cwd, state_dir, script = self.prepare(command, session)
+        process = subprocess.Popen(
+            [self.shell, "-c", script] if self.shell else script,
+            shell=self.shell is None,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=self.shell is not None
+        )
+        job = ShellJob(job_id, command, session, process, self.log_dir / f"{job_id}.log", state_dir,
+                       on_output=self.ui.shell_output if stream else None)
+        return self.track(job)
+    
+    def track(self, job: ShellJob) -> ShellJob:
+        """Put a started job under the runtime limit and in the job list"""
+        job.watchdog = threading.Timer(self.MAX_RUNTIME, job.kill)
+        job.watchdog.daemon = True
+        job.watchdog.start()
+        with self._lock:
+            self.jobs[job.id] = job
+        return job
+    
+    def finish(self, job: ShellJob) -> str:
+        """Result of a foreground command after its wait, whether or not it has exited"""
+        job.on_output = None
+        
+        if not job.done.is_set():
+            job.polled = job.size
+            return (
+                f"Command: {job.command}\n"
+                f"Status: still running as background job {job.id} ({job.status()})\n"
+                f"Output so far:\n{self._excerpt(job, 0, job.polled)}\n"
+                f"Use check_shell_job with job_id '{job.id}' to follow it or kill it."
+            )
+        
+        self._adopt_state(job)
+        job.polled = job.size
+        output = self._excerpt(job, 0, job.size)
+        with self._lock:
+            self.jobs.pop(job.id, None)
+        if job.size <= self.head_bytes + self.tail_bytes:
+            # Everything was returned; no need to keep the log
+            job.log_path.unlink(missing_ok=True)
+        
+        return f"Command: {job.command}\nExit Code: {job.returncode}\nOutput:\n{output}\n"
+    
+    def run(self, command: str, session: str = "default", timeout: float = 30, background: bool = False) -> str:
+        """Run a command; returns its output, or a job id once `timeout` seconds pass"""
+        job = self.start(command, session, stream=not background)
+        if background:
+            return (f"Started background job {job.id} in session '{session}': {command}\n"
+                    f"Output is written to {job.log_path}. Use check_shell_job to follow it.")
+        job.done.wait(min(max(timeout, 0), self.MAX_WAIT))
+        return self.finish(job)
+    
+    def poll(self, job_id: Optional[str] = None, wait: float = 0, kill: bool = False) -> str:
+        """Status and new output of a background job, or a list of all jobs"""
+        with self._lock:
+            jobs = dict(self.jobs)
+        
+        if not job_id:
+            if not jobs:
+                return "No background shell jobs."
+            return "\n".join(f"{job.id}: {job.command} [{job.status()}]" for job in jobs.values())
+        
+        job = jobs.get(job_id)
+        if job is None:
+            return f"Error: Unknown shell job '{job_id}'"
+        
+        if kill:
+            job.kill()
+            job.done.wait(5)
+        elif wait:
+            job.done.wait(min(wait, self.MAX_WAIT))
+        
+        start, end = job.polled, job.size
+        job.polled = end
+        if job.done.is_set():
+            with self._lock:
+                self.jobs.pop(job.id, None)
+        
+        new_output = self._excerpt(job, start, end) if end > start else "(no new output)"
+        return (f"Job {job.id}: {job.command}\nStatus: {job.status()}\n"
+                f"New output:\n{new_output}\nFull log: {job.log_path}")
+    
+    def _excerpt(self, job: ShellJob, start: int, end: int) -> str:
+        """Output between two offsets, keeping only the head and tail if it is long"""
+        if end - start <= self.head_bytes + self.tail_bytes:
+            return job.read(start, end)
+        
+        # Cut at line boundaries unless the lines are very long
+        head = job.read(start, start + self.head_bytes)
+        if head.rfind("\n") > len(head) // 2:
+            head = head[:head.rfind("\n") + 1]
+        tail = job.read(end - self.tail_bytes, end)
+        if -1 < tail.find("\n") < len(tail) // 2:
+            tail = tail[tail.find("\n") + 1:]
+        
+        omitted = end - start - len(head.encode()) - len(tail.encode())
+        return (
+            head
+            + f"... [{omitted} bytes omitted - full output ({job.size} bytes) in {job.log_path}; "
+              f"use read_file or search_file on it] ...\n"
+            + tail
+        )
+    
+    def _adopt_state(self, job: ShellJob):
+        """Carry a finished command's cwd and env over to its session"""
+        cwd_file = job.state_dir / "cwd"
+        env_file = job.state_dir / "env"
+        if not cwd_file.exists():
+            return
+        cwd = cwd_file.read_text().strip()
+        with self._lock:
+            state = self.sessions.get(job.session)
+            if state is None:
+                return
+            if os.path.isdir(cwd):
+                state["cwd"] = cwd
+            if env_file.exists():
+                previous, state["env_file"] = state["env_file"], str(env_file)
+                if previous:
+                    shutil.rmtree(Path(previous).parent, ignore_errors=True)
+    
+    def close(self):
+        """Kill running jobs and drop session state"""
+        with self._lock:
+            jobs = list(self.jobs.values())
+            self.jobs.clear()
+            self.sessions.clear()
+            state_root, self._state_root = self._state_root, None
+        for job in jobs:
+            job.kill()
+        if state_root is not None:
+            shutil.rmtree(state_root, ignore_errors=True)
+
+
+class WorkspaceIndex:
+    """Cached, ignore-aware view of directory trees for list_files and search_files
+    
+    Listings come from os.scandir and are kept per directory along with the
+    directory's mtime, so a walk only rescans directories whose entries
+    changed since the last one. File contents read by searches are kept by
+    (mtime, size) up to a byte budget. .gitignore and .agentignore files
+    are honored in the directory they sit in and below.
+    """
+    
+    DEFAULT_IGNORE = (".git/", "__pycache__/", "node_modules/", ".venv/", "venv/", "*.pyc", ".DS_Store")
+    IGNORE_FILES = (".gitignore", ".agentignore")
+    
+    # Files above this size are skipped by searches
+    MAX_SEARCH_BYTES = 4 * 1024 * 1024
+    # A listing taken this soon after the directory changed may miss a same-tick change
+    RACY_SECONDS = 1.0
+    
+    def __init__(self, max_cached_bytes: int = 64 * 1024 * 1024):
+        self.max_cached_bytes = max_cached_bytes
+        self._dirs: Dict[str, tuple] = {}
+        self._ignore_files: Dict[str, tuple] = {}
+        self._contents: Dict[str, tuple] = {}
+        self._content_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"scans": 0, "cached_scans": 0, "reads": 0, "cached_reads": 0}
+        self._default_rules = [self._rule("", line) for line in self.DEFAULT_IGNORE]
+    
+    @staticmethod
+    def _rule(base: str, line: str) -> Optional[tuple]:
+        """(base, pattern, negate, dir_only, anchored) for one gitignore-style line"""
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            return None
+        negate = line.startswith("!")
+        line = line[1:] if negate else line
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        anchored = "/" in line
+        return (base, line.lstrip("/"), negate, dir_only, anchored)
+    
+    @staticmethod
+    def _matches(rule: tuple, rel_path: str, is_dir: bool) -> bool:
+        base, pattern, _, dir_only, anchored = rule
+        if dir_only and not is_dir:
+            return False
+        path = rel_path[len(base) + 1:] if base else rel_path
+        target = path if anchored else path.rsplit("/", 1)[-1]
+        if fnmatch.fnmatchcase(target, pattern):
+            return True
+        return pattern.startswith("**/") and fnmatch.fnmatchcase(target, pattern[3:])
+    
+    def _ignored(self, rel_path: str, is_dir: bool, rules: List[tuple]) -> bool:
+        # Like git, the last matching rule wins
+        ignored = False
+        for rule in rules:
+            if rule[2] == ignored and self._matches(rule, rel_path, is_dir):
+                ignored = not rule[2]
+        return ignored
+    
+    def _scan(self, path: str) -> List[tuple]:
+        """Sorted (name, is_dir) entries of a directory, rescanned only when it changed"""
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._dirs.get(path)
+            if cached and cached[0] == mtime:
+                self.stats["cached_scans"] += 1
+                return cached[1]
+        
+        scanned_at = time.time_ns()
+        with os.scandir(path) as it:
+            entries = sorted((entry.name, entry.is_dir(follow_symlinks=False)) for entry in it)
+        with self._lock:
+            self.stats["scans"] += 1
+            if (scanned_at - mtime) / 1e9 > self.RACY_SECONDS:
+                self._dirs[path] = (mtime, entries)
+        return entries
+    
+    def _local_rules(self, path: str, base: str, names: set) -> List[tuple]:
+        rules = []
+        for name in self.IGNORE_FILES:
+            if name not in names:
+                continue
+            ignore_path = os.path.join(path, name)
+            try:
+                mtime = os.stat(ignore_path).st_mtime_ns
+            except OSError:
+                continue
+            with self._lock:
+                cached = self._ignore_files.get(ignore_path)
+            if not cached or cached[0] != mtime:
+                with open(ignore_path, 'r', errors='replace') as f:
+                    parsed = [r for r in (self._rule(base, line) for line in f) if r]
+                cached = (mtime, parsed)
+                with self._lock:
+                    self._ignore_files[ignore_path] = cached
+            rules.extend(cached[1])
+        return rules
+    
+    def walk(self, root: str, recursive: bool = True, include_ignored: bool = False):
+        """(relative path, absolute path, is_dir) in tree order; ignored directories are not entered"""
+        stack = [("", os.path.abspath(root), list(self._default_rules))]
+        while stack:
+            rel_dir, abs_dir, rules = stack.pop()
+            try:
+                entries = self._scan(abs_dir)
+            except OSError:
+                continue
+            if not include_ignored:
+                rules = rules + self._local_rules(abs_dir, rel_dir, {name for name, _ in entries})
+            
+            children = []
+            for name, is_dir in entries:
+                rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                if not include_ignored and self._ignored(rel_path, is_dir, rules):
+                    continue
+                abs_path = os.path.join(abs_dir, name)
+                yield rel_path, abs_path, is_dir
+                if is_dir and recursive:
+                    children.append((rel_path, abs_path, rules))
+            # Subdirectories come after their parent's files, in name order
+            stack.extend(reversed(children))
+    
+    @staticmethod
+    def _glob_match(rel_path: str, pattern: Optional[str]) -> bool:
+        if not pattern:
+            return True
+        if "/" not in pattern:
+            return fnmatch.fnmatchcase(rel_path.rsplit("/", 1)[-1], pattern)
+        return fnmatch.fnmatchcase(rel_path, pattern) or (
+            pattern.startswith("**/") and fnmatch.fnmatchcase(rel_path, pattern[3:])
+        )
+    
+    def list(self, directory: str, recursive: bool = False, pattern: Optional[str] = None, offset: int = 0,
+             limit: int = 200, include_ignored: bool = False) -> str:
+        """One page of entries with size and modification time"""
+        if not os.path.isdir(directory):
+            if os.path.exists(directory):
+                return f"Error: Not a directory: {directory}"
+            return f"Error: Directory not found: {directory}"
+        
+        offset = max(int(offset or 0), 0)
+        limit = max(int(limit or 200), 1)
+        page = []
+        total = 0
+        for rel_path, abs_path, is_dir in self.walk(directory, recursive, include_ignored):
+            # A glob selects files; directories are listed only without one
+            if pattern and (is_dir or not self._glob_match(rel_path, pattern)):
+                continue
+            if offset <= total < offset + limit:
+                page.append((rel_path, abs_path, is_dir))
+            total += 1
+        
+        if not total:
+            return f"No entries in {directory}" + (f" matching '{pattern}'" if pattern else "")
+        if not page:
+            return f"{directory} has only {total} entries (offset {offset})"
+        
+        lines = [f"{directory}: entries {offset + 1}-{offset + len(page)} of {total} (path, bytes, modified)"]
+        for rel_path, abs_path, is_dir in page:
+            try:
+                stat = os.stat(abs_path)
+            except OSError:
+                continue
+            modified = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M')
+            if is_dir:
+                lines.append(f"{rel_path}/\t-\t{modified}")
+            else:
+                lines.append(f"{rel_path}\t{stat.st_size}\t{modified}")
+        if offset + len(page) < total:
+            lines.append(f"[{total - offset - len(page)} more entries - continue with offset={offset + len(page)}]")
+        return "\n".join(lines)
+    
+    def _content(self, path: str, stat: os.stat_result) -> Optional[bytes]:
+        """File bytes from the cache while mtime and size match; None for binary files"""
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._contents.get(path)
+            if cached and cached[0] == signature:
+                self.stats["cached_reads"] += 1
+                return cached[1]
+        
+        with open(path, 'rb') as f:
+            data = f.read()
+        if b"\0" in data[:8192]:
+            data = None
+        
+        with self._lock:
+            self.stats["reads"] += 1
+            old = self._contents.pop(path, None)
+            if old and old[1]:
+                self._content_bytes -= len(old[1])
+            # Once full, new files are not kept: searches scan whole trees in the same
+            # order, so evicting the oldest would throw away every entry before its next use
+            if self._content_bytes + len(data or b"") <= self.max_cached_bytes:
+                self._contents[path] = (signature, data)
+                self._content_bytes += len(data or b"")
+        return data
+    
+    def search(self, query: str, directory: str = ".", pattern: Optional[str] = None, ignore_case: bool = False,
+               max_matches: int = 100, max_line_chars: int = 500) -> str:
+        """Matching lines of every indexed text file under directory, as path:line: text"""
+        if not query:
+            return "Error: No search query given"
+        if not os.path.isdir(directory):
+            return f"Error: Directory not found: {directory}"
+        
+        flags = re.IGNORECASE if ignore_case else 0
+        try:
+            regex = re.compile(query.encode(), flags | re.MULTILINE)
+        except re.error:
+            regex = re.compile(re.escape(query.encode()), flags)
+        
+        max_matches = max(int(max_matches or 100), 1)
+        hits = []
+        searched = skipped = 0
+        for rel_path, abs_path, is_dir in self.walk(directory):
+            if is_dir or not self._glob_match(rel_path, pattern):
+                continue
+            try:
+                stat = os.stat(abs_path)
+                if stat.st_size > self.MAX_SEARCH_BYTES:
+                    skipped += 1
+                    continue
+                data = self._content(abs_path, stat)
+            except OSError:
+                continue
+            if data is None:
+                continue
+            searched += 1
+            
+            line_no = 1
+            counted_to = 0
+            pos = 0
+            while len(hits) < max_matches:
+                match = regex.search(data, pos)
+                if not match:
+                    break
+                line_start = data.rfind(b"\n", 0, match.start()) + 1
+                line_no += data.count(b"\n", counted_to, line_start)
+                counted_to = line_start
+                line_end = data.find(b"\n", line_start)
+                line_end = len(data) if line_end == -1 else line_end
+                text = data[line_start:line_end].decode('utf-8', errors='replace')
+                hits.append(f"{rel_path}:{line_no}: {text[:max_line_chars]}")
+                # One hit per line is enough
+                pos = line_end + 1
+                if pos >= len(data):
+                    break
+            if len(hits) >= max_matches:
+                break
+        
+        scope = f"'{query}' under {directory}" + (f" in {pattern}" if pattern else "")
+        if not hits:
+            return f"No matches for {scope} ({searched} files searched)"
+        output = [f"Matches for {scope}:"] + hits
+        if len(hits) >= max_matches:
+            output.append(f"[Stopped after {max_matches} matches - narrow the query or the file pattern]")
+        if skipped:
+            output.append(f"[{skipped} files over {self.MAX_SEARCH_BYTES // (1024 * 1024)} MB not searched - "
+                          f"use search_file on them]")
+        return "\n".join(output)
+
+
+class ToolExecutor:
+    """Executes tools when called by the AI"""
+    
+    # Seconds to wait for a single tool when calls run concurrently
+    DEFAULT_TIMEOUTS = {
+        "execute_shell": 35,
+        "web_search": 15,
+    }
+    
+    # Files above this size are not returned whole; the model gets a handle instead
+    MAX_READ_BYTES = 256 * 1024
+    # Longest line returned by search_file
+    MAX_LINE_CHARS = 500
+    # search_file counts lines through windows of this size, so a hit deep in a huge file copies little
+    COUNT_WINDOW = 1024 * 1024
+    
+    # Search endpoint; point AGENT_SEARCH_URL at a local stub server for testing
+    SEARCH_URL = "https://api.duckduckgo.com/"
+    
+    # Read-only tools whose repeated results are memoized, with the argument naming their target
+    MEMO_TOOLS = {"read_file": "path", "search_file": "path", "list_files": "directory", "search_files": "directory"}
+    # Tools that may change files; every memoized result is forgotten after one
+    MUTATING_TOOLS = frozenset({"write_file", "edit_file", "execute_shell", "check_shell_job"})
+    # Start of the short reference returned instead of a repeated result
+    UNCHANGED = "[Unchanged since "
+    
+    def __init__(self, max_workers: int = 4, default_timeout: float = 60, timeouts: Optional[Dict[str, float]] = None,
+                 search_url: Optional[str] = None, search_cache: Optional[TTLCache] = None, ui=BeautifulUI,
+                 allowed_tools: Optional[List[str]] = None, tracer: Optional[Tracer] = None):
+        self.workspace = Path("./workspace")
+        self.workspace.mkdir(exist_ok=True)
+        self.ui = ui
+        self.tracer = tracer or Tracer()
+        # Persistent shell sessions and background jobs for execute_shell
+        self.shell = ShellManager(ui=ui)
+        # Directory listings and file contents for list_files and search_files
+        self.index = WorkspaceIndex()
+        # Past sessions for search_memory; the database is opened on first search
+        self.memory = MemoryIndex()
+        
+        # None means every tool; sub-agents get the list they were spawned with
+        self.allowed_tools = set(allowed_tools) if allowed_tools is not None else None
+        # Set by CentralBrain; without a pool, spawn_sub_agent only registers the agent
+        self.sub_agents = None
+        
+        self.search_url = search_url or os.getenv("AGENT_SEARCH_URL", self.SEARCH_URL)
+        self.search_cache = search_cache or TTLCache(
+            max_entries=256,
+            ttl=6 * 3600,
+            disk_dir="./memory/cache/web_search"
+        )
+        
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self.timeouts = dict(self.DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        
+        # (tool, arguments) -> turn, file stamp and digest of the result the model already has
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+        self.memo_hits = 0
+    
+    def execute_many(self, calls: List[tuple]) -> List[str]:
+        """Execute (tool_name, tool_input) pairs concurrently, results in call order"""
+        if len(calls) <= 1 or self.max_workers <= 1:
+            return [self.execute(name, args) for name, args in calls]
+        
+        started = {}
+        
+        def run(index: int, name: str, args: Dict) -> str:
+            started[index] = time.monotonic()
+            return self.execute(name, args)
+        
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(calls)))
+        try:
+            # Each worker runs in a copy of this context, so its spans know the turn
+            futures = [
+                pool.submit(contextvars.copy_context().run, run, i, name, args)
+                for i, (name, args) in enumerate(calls)
+            ]
+            
+            results = []
+            for i, future in enumerate(futures):
+                name = calls[i][0]
+                timeout = self.call_timeout(name, calls[i][1])
+                while True:
+                    # The clock starts when a worker picks the call up, not while it is queued
+                    start = started.get(i)
+                    remaining = timeout if start is None else start + timeout - time.monotonic()
+                    try:
+                        results.append(future.result(timeout=max(remaining, 0)))
+                        break
+                    except FutureTimeout:
+                        start = started.get(i)
+                        if start is not None and time.monotonic() >= start + timeout:
+                            future.cancel()
+                            results.append(f"Error executing {name}: timed out after {timeout}s")
+                            break
+            return results
+        finally:
+            # Don't block the turn on calls that overran their timeout
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    def call_timeout(self, tool_name: str, tool_input: Dict) -> float:
+        """Seconds a concurrent call may take before it is abandoned"""
+        timeout = self.timeouts.get(tool_name, self.default_timeout)
+        if tool_name == "execute_shell":
+            # The command's own wait (after which it carries on as a job) plus some slack
+            wait = min(float(tool_input.get("timeout") or 30), ShellManager.MAX_WAIT)
+            timeout = max(timeout, wait + 5)
+        elif tool_name == "check_shell_job":
+            timeout = max(timeout, min(float(tool_input.get("wait") or 0), ShellManager.MAX_WAIT) + 5)
+        return timeout
+    
+    def execute(self, tool_name: str, tool_input: Dict) -> str:
+        """Execute a tool and return result as string"""
+        with self.tracer.span("tool", tool=tool_name) as span:
+            if tool_name in self.MEMO_TOOLS:
+                result = self._memoized(tool_name, tool_input, span)
+            else:
+                result = self._dispatch(tool_name, tool_input)
+                if tool_name in self.MUTATING_TOOLS:
+                    self.forget_results()
+            self._trace_result(span, tool_input, result)
+            return result
+    
+    def forget_results(self):
+        """Drop every memoized result (files may have changed, or the model no longer has them)"""
+        with self._memo_lock:
+            self._memo.clear()
+    
+    def _stamp(self, tool_name: str, tool_input: Dict) -> Optional[tuple]:
+        """(mtime_ns, size) of a file tool's target; None if it cannot vouch for the content"""
+        if self.MEMO_TOOLS[tool_name] != "path":
+            return None
+        try:
+            stat = os.stat(tool_input.get("path", ""))
+        except (OSError, ValueError):
+            return None
+        # A file modified this recently could change again without its mtime moving
+        if time.time() - stat.st_mtime < WorkspaceIndex.RACY_SECONDS:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+    
+    def _memoized(self, tool_name: str, tool_input: Dict, span: Dict) -> str:
+        """Run a read-only tool, or point at the identical result returned earlier"""
+        key = (tool_name, json.dumps(tool_input, sort_keys=True, default=str))
+        stamp = self._stamp(tool_name, tool_input)
+        with self._memo_lock:
+            entry = self._memo.get(key)
+        
+        # An unchanged file is not even read again
+        if entry is not None and stamp is not None and entry["stamp"] == stamp:
+            return self._unchanged(tool_name, tool_input, entry, span)
+        
+        result = self._dispatch(tool_name, tool_input)
+        if result.startswith("Error"):
+            with self._memo_lock:
+                self._memo.pop(key, None)
+            return result
+        
+        digest = hashlib.sha256(result.encode('utf-8', errors='replace')).hexdigest()
+        if entry is not None and entry["digest"] == digest:
+            with self._memo_lock:
+                entry["stamp"] = stamp
+            return self._unchanged(tool_name, tool_input, entry, span)
+        
+        with self._memo_lock:
+            self._memo[key] = {"turn": _trace_context.get().get("turn"), "stamp": stamp, "digest": digest}
+        return result
+    
+    def _unchanged(self, tool_name: str, tool_input: Dict, entry: Dict, span: Dict) -> str:
+        with self._memo_lock:
+            self.memo_hits += 1
+        span["memo"] = True
+        since = f"turn {entry['turn']}" if entry["turn"] else "an earlier call"
+        target = tool_input.get(self.MEMO_TOOLS[tool_name]) or "."
+        # No hash here: the one read_file shows (and edit_file checks) is in that earlier output
+        return (f"{self.UNCHANGED}{since}: {tool_name} on {target} returns the same result "
+                f"as then; use that output from earlier in the conversation]")
+    
+    @staticmethod
+    def _trace_result(span: Dict, tool_input: Dict, result: str):
+        span["bytes_in"] = len(json.dumps(tool_input))
+        span["bytes_out"] = len(result)
+        if result.startswith("Error"):
+            span["error"] = "tool_error"
+    
+    def _dispatch(self, tool_name: str, tool_input: Dict) -> str:
+        if self.allowed_tools is not None and tool_name not in self.allowed_tools:
+            return f"Error: Tool '{tool_name}' is not available to this agent"
+        
+        try:
+            if tool_name == "read_file":
+                return self._read_file(
+                    tool_input.get("path", ""),
+                    tool_input.get("offset"),
+                    tool_input.get("limit")
+                )
+            
+            elif tool_name == "search_file":
+                return self._search_file(
+                    tool_input.get("path", ""),
+                    tool_input.get("pattern", ""),
+                    tool_input.get("context", 2),
+                    tool_input.get("max_matches", 50),
+                    tool_input.get("ignore_case", False)
+                )
+            
+            elif tool_name == "write_file":
+                return self._write_file(
+                    tool_input.get("path", ""),
+                    tool_input.get("content", "")
+                )
+            
+            elif tool_name == "edit_file":
+                return self._edit_file(
+                    tool_input.get("path", ""),
+                    tool_input.get("edits"),
+                    tool_input.get("patch"),
+                    tool_input.get("expected_sha256")
+                )
+            
+            elif tool_name == "execute_shell":
+                return self._execute_shell(
+                    tool_input.get("command", ""),
+                    tool_input.get("timeout"),
+                    tool_input.get("background", False),
+                    tool_input.get("session")
+                )
+            
+            elif tool_name == "check_shell_job":
+                return self.shell.poll(
+                    tool_input.get("job_id"),
+                    float(tool_input.get("wait") or 0),
+                    bool(tool_input.get("kill", False))
+                )
+            
+            elif tool_name == "web_search":
+                results = self._web_search(tool_input.get("query", ""))
+                return json.dumps(results, indent=2)
+            
+            elif tool_name == "list_files":
+                return self.index.list(
+                    tool_input.get("directory", "."),
+                    bool(tool_input.get("recursive", False)),
+                    tool_input.get("pattern"),
+                    tool_input.get("offset", 0),
+                    tool_input.get("limit", 200),
+                    bool(tool_input.get("include_ignored", False))
+                )
+            
+            elif tool_name == "search_files":
+                return self.index.search(
+                    tool_input.get("query", ""),
+                    tool_input.get("directory", "."),
+                    tool_input.get("pattern"),
+                    bool(tool_input.get("ignore_case", False)),
+                    tool_input.get("max_matches", 100),
+                    self.MAX_LINE_CHARS
+                )
+            
+            elif tool_name == "search_memory":
+                return self._search_memory(
+                    tool_input.get("query", ""),
+                    tool_input.get("limit", 5),
+                    tool_input.get("session")
+                )
+            
+            elif tool_name == "spawn_sub_agent":
+                return self._spawn_sub_agent(
+                    tool_input.get("name", ""),
+                    tool_input.get("role", ""),
+                    tool_input.get("tools", []),
+                    tool_input.get("task", "")
+                )
+            
+            elif tool_name == "check_sub_agent":
+                return self._check_sub_agent(
+                    tool_input.get("agent_id"),
+                    tool_input.get("wait", 0)
+                )
+            
+            else:
+                return f"Error: Unknown tool '{tool_name}'"
+        
+        except Exception as e:
+            return f"Error executing {tool_name}: {str(e)}"
+    
+    @staticmethod
+    def _is_binary(path: Path) -> bool:
+        with open(path, 'rb') as f:
+            return b"\0" in f.read(8192)
+    
+    def _read_file(self, filepath: str, offset: Optional[int] = None, limit: Optional[int] = None) -> str:
+        path = Path(filepath)
+        if not path.exists():
+            return f"Error: File not found: {filepath}"
+        if not path.is_file():
+            return f"Error: Not a file: {filepath}"
+        
+        size = path.stat().st_size
+        if self._is_binary(path):
+            return f"Error: {filepath} looks like a binary file ({size} bytes); not returning its contents"
+        
+        if offset is None and limit is None:
+            if size <= self.MAX_READ_BYTES:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                content = data.decode('utf-8', errors='replace').replace("\r\n", "\n")
+                return f"File contents of {filepath} (sha256 {self._content_hash(data)}):\n\n{content}"
+            
+            # Too large to return whole: hand back a handle with a preview
+            with open(path, 'rb') as f:
+                preview = b"".join(islice(f, 20)).decode('utf-8', errors='replace')
+            return (
+                f"File handle: {filepath}\n"
+                f"Size: {size} bytes (over the {self.MAX_READ_BYTES} byte limit for a full read)\n"
+                f"Use read_file with offset/limit to page through it, or search_file to find lines.\n\n"
+                f"First lines:\n{preview}"
+            )
+        
+        # Line paging: offset is the 1-based first line, limit the number of lines
+        start = max(int(offset or 1), 1)
+        count = max(int(limit or 200), 1)
+        lines = []
+        read_bytes = 0
+        more = False
+        with open(path, 'rb') as f:
+            for line in islice(f, start - 1, None):
+                if len(lines) >= count or read_bytes + len(line) > self.MAX_READ_BYTES:
+                    more = True
+                    break
+                lines.append(line)
+                read_bytes += len(line)
+        
+        if not lines:
+            return f"File {filepath} has fewer than {start} lines"
+        
+        content = b"".join(lines).decode('utf-8', errors='replace')
+        end = start + len(lines) - 1
+        footer = f"\n[More lines follow - continue with offset={end + 1}]" if more else "\n[End of file]"
+        return f"File contents of {filepath} (lines {start}-{end}):\n\n{content}{footer}"
+    
+    @classmethod
+    def _count_lines(cls, mm: mmap.mmap, start: int, end: int) -> int:
+        """Newlines in mm[start:end], without copying more than a window of it at a time"""
+        return sum(
+            mm[offset:min(offset + cls.COUNT_WINDOW, end)].count(b"\n")
+            for offset in range(start, end, cls.COUNT_WINDOW)
+        )
+    
+    def _search_file(self, filepath: str, pattern: str, context: int = 2, max_matches: int = 50,
+                     ignore_case: bool = False) -> str:
+        path = Path(filepath)
+        if not path.is_file():
+            return f"Error: File not found: {filepath}"
+        if not pattern:
+            return "Error: No search pattern given"
+        if self._is_binary(path):
+            return f"Error: {filepath} looks like a binary file; not searching it"
+        if path.stat().st_size == 0:
+            return f"No matches for '{pattern}' in {filepath} (empty file)"
+        
+        flags = re.IGNORECASE if ignore_case else 0
+        try:
+            regex = re.compile(pattern.encode(), flags | re.MULTILINE)
+        except re.error:
+            regex = re.compile(re.escape(pattern.encode()), flags)
+        
+        context = max(int(context), 0)
+        windows = []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            line_no = 1
+            counted_to = 0
+            pos = 0
+            while len(windows) < max_matches:
+                match = regex.search(mm, pos)
+                if not match:
+                    break
+                
+                line_start = mm.rfind(b"\n", 0, match.start()) + 1
+                line_no += self._count_lines(mm, counted_to, line_start)
+                counted_to = line_start
+                
+                # Walk back and forward for the context lines
+                window_start = line_start
+                for _ in range(context):
+                    if window_start == 0:
+                        break
+                    window_start = mm.rfind(b"\n", 0, window_start - 1) + 1
+                window_end = line_start
+                for _ in range(context + 1):
+                    newline = mm.find(b"\n", window_end)
+                    if newline == -1:
+                        window_end = len(mm)
+                        break
+                    window_end = newline + 1
+                
+                first_line = line_no - self._count_lines(mm, window_start, line_start)
+                windows.append((first_line, line_no, mm[window_start:window_end]))
+                
+                # One hit per line is enough
+                line_end = mm.find(b"\n", line_start)
+                pos = len(mm) if line_end == -1 else line_end + 1
+                if pos >= len(mm):
+                    break
+        
+        if not windows:
+            return f"No matches for '{pattern}' in {filepath}"
+        
+        output = [f"Matches for '{pattern}' in {filepath}:"]
+        for first_line, hit_line, chunk in windows:
+            output.append("--")
+            for n, line in enumerate(chunk.decode('utf-8', errors='replace').splitlines(), start=first_line):
+                marker = ">" if n == hit_line else " "
+                output.append(f"{marker}{n}: {line[:self.MAX_LINE_CHARS]}")
+        if len(windows) >= max_matches:
+            output.append(f"[Stopped after {max_matches} matches]")
+        return "\n".join(output)
+    
+    def _write_file(self, filepath: str, content: str) -> str:
+        path = Path(filepath)
+        data = content.encode('utf-8')
+        self._atomic_write(path, data)
+        return f"Successfully wrote {len(content)} characters to {filepath} (sha256 {self._content_hash(data)})"
+    
+    @staticmethod
+    def _content_hash(data: bytes) -> str:
+        """Short content hash shown by read_file and checked by edit_file's expected_sha256"""
+        return hashlib.sha256(data).hexdigest()[:16]
+    
+    @staticmethod
+    def _atomic_write(path: Path, data: bytes):
+        """Write through a temp file in the same directory and rename, so readers never see half a file"""
+        # Through a symlink: replace its target, not the link
+        path = path.resolve()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_name = str(path.parent / f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        # Created like open() creates files: 0666 less the umask, applied by the kernel
+        fd = os.open(tmp_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if path.exists():
+                shutil.copymode(path, tmp_name)
+            os.replace(tmp_name, path)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+    
+    def _edit_file(self, filepath: str, edits: Optional[List[Dict]] = None, patch: Optional[str] = None,
+                   expected_sha256: Optional[str] = None) -> str:
+        path = Path(filepath)
+        if not path.is_file():
+            return f"Error: File not found: {filepath} (use write_file to create it)"
+        if not edits and not patch:
+            return "Error: Give either edits (search/replace pairs) or a unified diff patch"
+        
+        with open(path, 'rb') as f:
+            data = f.read()
+        current_hash = self._content_hash(data)
+        if expected_sha256:
+            expected = expected_sha256.strip().lower()
+            if len(expected) < 8 or not current_hash.startswith(expected[:16]):
+                return (f"Error: {filepath} changed since you read it (sha256 is now {current_hash}, "
+                        f"expected {expected_sha256}); read it again before editing")
+        if b"\0" in data[:8192]:
+            return f"Error: {filepath} looks like a binary file; not editing it"
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return f"Error: {filepath} is not valid UTF-8; not editing it"
+        
+        # Edits are written with \n; match them against a CRLF file in its own line endings
+        newline = "\r\n" if "\r\n" in text else "\n"
+        try:
+            if patch:
+                text, changed = self._apply_patch(text, patch, newline)
+            else:
+                text, changed = self._apply_edits(text, edits, newline)
+        except ValueError as e:
+            return f"Error: {e}. {filepath} was not changed"
+        
+        new_data = text.encode('utf-8')
+        if new_data == data:
+            return f"No changes: {filepath} already has that content (sha256 {current_hash})"
+        self._atomic_write(path, new_data)
+        
+        # The changed regions with a little context, so the result can be checked without a re-read
+        lines = text.split(newline)
+        if text.endswith(newline):
+            lines.pop()
+        output = [f"Edited {filepath}: {len(changed)} change(s), sha256 {self._content_hash(new_data)}"]
+        for first, last in changed[:10]:
+            start = max(first - 2, 1)
+            end = min(last + 2, len(lines))
+            output.append("--")
+            for n in range(start, end + 1):
+                output.append(f"{n}: {lines[n - 1][:self.MAX_LINE_CHARS]}")
+        if len(changed) > 10:
+            output.append(f"[{len(changed) - 10} more changes not shown]")
+        return "\n".join(output)
+    
+    @staticmethod
+    def _apply_edits(text: str, edits: List[Dict], newline: str) -> tuple:
+        """Apply search/replace pairs in order; each search must match exactly once unless all is set"""
+        changed = []
+        for number, edit in enumerate(edits, 1):
+            search = (edit.get("search") or "").replace("\r\n", "\n")
+            replace = (edit.get("replace") or "").replace("\r\n", "\n")
+            if not search:
+                raise ValueError(f"Edit {number} has an empty search string")
+            search, replace = search.replace("\n", newline), replace.replace("\n", newline)
+            
+            count = text.count(search)
+            if count == 0:
+                raise ValueError(f"Edit {number}: search text not found (it must match the file exactly, "
+                                 f"including indentation)")
+            if count > 1 and not edit.get("all"):
+                lines = []
+                pos = text.find(search)
+                while pos != -1 and len(lines) < 5:
+                    lines.append(str(text.count(newline, 0, pos) + 1))
+                    pos = text.find(search, pos + 1)
+                more = ", ..." if count > len(lines) else ""
+                raise ValueError(f"Edit {number}: search text matches {count} times (lines {', '.join(lines)}{more}); "
+                                 f"add surrounding lines to make it unique, or set all: true")
+            
+            pos = text.find(search)
+            while pos != -1:
+                first = text.count(newline, 0, pos) + 1
+                changed.append((first, first + replace.count(newline)))
+                text = text[:pos] + replace + text[pos + len(search):]
+                if not edit.get("all"):
+                    break
+                pos = text.find(search, pos + len(replace))
+        return text, changed
+    
+    @staticmethod
+    def _apply_patch(text: str, patch: str, newline: str) -> tuple:
+        """Apply the hunks of a unified diff; a hunk may have moved, its context must still match"""
+        hunks = []
+        for line in patch.replace("\r\n", "\n").split("\n"):
+            header = re.match(r"@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@", line)
+            if header:
+                hunks.append({"start": int(header.group(1)), "old": [], "new": []})
+            elif not hunks or line.startswith(("--- ", "+++ ", "\\")):
+                continue
+            elif line.startswith("-"):
+                hunks[-1]["old"].append(line[1:])
+            elif line.startswith("+"):
+                hunks[-1]["new"].append(line[1:])
+            else:
+                # Context; some tools strip the leading space of empty context lines
+                hunks[-1]["old"].append(line[1:])
+                hunks[-1]["new"].append(line[1:])
+        if not hunks:
+            raise ValueError("The patch has no @@ hunks")
+        
+        # A trailing empty context line is usually just the end of the patch text
+        for hunk in hunks:
+            while hunk["old"] and hunk["new"] and hunk["old"][-1] == "" and hunk["new"][-1] == "":
+                hunk["old"].pop()
+                hunk["new"].pop()
+        
+        lines = text.split(newline)
+        changed = []
+        shift = 0
+        for number, hunk in enumerate(hunks, 1):
+            old, new = hunk["old"], hunk["new"]
+            expected = max(hunk["start"] - 1 + shift, 0)
+            if not old:
+                at = min(hunk["start"] + shift, len(lines)) if hunk["start"] else 0
+            else:
+                # Nearest match to where the hunk says it starts
+                candidates = [
+                    i for i in range(len(lines) - len(old) + 1)
+                    if lines[i:i + len(old)] == old
+                ]
+                if not candidates:
+                    raise ValueError(f"Hunk {number} (@@ -{hunk['start']}) does not match the file; "
+                                     f"its context and removed lines must be exact")
+                at = min(candidates, key=lambda i: abs(i - expected))
+            lines[at:at + len(old)] = new
+            changed.append((at + 1, at + max(len(new), 1)))
+            shift += len(new) - len(old)
+        return newline.join(lines), changed
+    
+    def _execute_shell(self, command: str, timeout: Optional[float] = None, background: bool = False,
+                       session: Optional[str] = None) -> str:
+        return self.shell.run(
+            command,
+            session=session or "default",
+            timeout=30 if timeout is None else float(timeout),
+            background=bool(background)
+        )
+    
+    @staticmethod
+    def _search_key(query: str) -> str:
+        # Same query in different casing/spacing is the same search
+        return " ".join(query.lower().split())
+    
+    def _web_search(self, query: str) -> List[Dict]:
+        import requests
+        
+        key = self._search_key(query)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        try:
+            params = {
+                'q': query,
+                'format': 'json',
+                'no_html': 1
+            }
+            
+            response = http_session().get(self.search_url, params=params, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+        
+        except requests.exceptions.Timeout:
+            return [{"error": "Search failed: the search service timed out", "type": "timeout"}]
+        except requests.exceptions.HTTPError as e:
+            return [{"error": f"Search failed: HTTP {e.response.status_code} from search service", "type": "http_error"}]
+        except requests.exceptions.ConnectionError as e:
+            return [{"error": f"Search failed: could not connect ({e})", "type": "connection_error"}]
+        except ValueError:
+            return [{"error": "Search failed: search service returned invalid JSON", "type": "invalid_response"}]
+        except Exception as e:
+            return [{"error": f"Search failed: {str(e)}", "type": "unknown"}]
+        
+        results = self._search_results(data)
+        # Only successful searches are cached
+        self.search_cache.set(key, results)
+        return results
+    
+    @staticmethod
+    def _search_results(data: Dict) -> List[Dict]:
+        """Turn a DuckDuckGo instant answer payload into search results"""
+        results = []
+        if data.get('AbstractText'):
+            results.append({
+                'title': data.get('Heading', 'Result'),
+                'snippet': data.get('AbstractText'),
+                'url': data.get('AbstractURL', '')
+            })
+        
+        if data.get('RelatedTopics'):
+            for topic in data['RelatedTopics'][:5]:
+                if isinstance(topic, dict) and 'Text' in topic:
+                    results.append({
+                        'title': topic.get('Text', '')[:100],
+                        'snippet': topic.get('Text', ''),
+                        'url': topic.get('FirstURL', '')
+                    })
+        
+        return results if results else [{"title": "No results", "snippet": "No results found for query", "url": ""}]
+    
+    def _search_memory(self, query: str, limit: int = 5, session: Optional[str] = None) -> str:
+        if not query:
+            return "Error: No search query given"
+        hits = self.memory.search(query, limit=min(max(int(limit or 5), 1), 20), session=session)
+        if not hits:
+            return f"No past conversations mention '{query}'"
+        
+        lines = [f"Memory matches for '{query}' (best first):"]
+        for hit in hits:
+            lines.append(f"- session {hit['session']}, turn {hit['turn']}, message {hit['message']} "
+                         f"({hit['role']}): {' '.join(hit['snippet'].split())}")
+        lines.append("[Use search_file on memory/session_<session>.json to see the surrounding messages]")
+        return "\n".join(lines)
+    
+    def _spawn_sub_agent(self, name: str, role: str, tools: List[str], task: str = "") -> str:
+        self.ui.agent_spawn(f"{name} - {role}")
+        
+        if self.sub_agents is None:
+            # Save agent info
+            AgentRegistry().add({
+                "name": name,
+                "role": role,
+                "tools": tools,
+                "spawned_at": datetime.now().isoformat()
+            })
+            return f"Successfully spawned sub-agent '{name}' with role: {role}. It has access to tools: {', '.join(tools)}"
+        
+        if not task:
+            return "Error: spawn_sub_agent needs a task for the sub-agent to work on"
+        
+        agent_id = self.sub_agents.spawn(name, role, tools, task)
+        return (
+            f"Successfully spawned sub-agent '{name}' (id: {agent_id}) with role: {role}. "
+            f"It has access to tools: {', '.join(tools)} and is working on its task in the background. "
+            f"Use check_sub_agent with agent_id '{agent_id}' to wait for or poll its result."
+        )
+    
+    def _check_sub_agent(self, agent_id: Optional[str], wait: float = 0) -> str:
+        if self.sub_agents is None:
+            return "Error: No sub-agents are running in this session"
+        
+        if not agent_id:
+            agents = self.sub_agents.list()
+            if not agents:
+                return "No sub-agents have been spawned in this session"
+            return "\n".join(f"{a['id']}: {a['name']} - {a['status']}" for a in agents)
+        
+        agent = self.sub_agents.wait(agent_id, timeout=min(float(wait or 0), SubAgentPool.MAX_WAIT))
+        if agent is None:
+            return f"Error: Unknown sub-agent id: {agent_id}"
+        
+        output = f"Sub-agent '{agent['name']}' ({agent_id}) status: {agent['status']}"
+        if agent["status"] in ("done", "failed"):
+            output += f"\n\nResult:\n{agent.get('result', '')}"
+        return output
+
+
+def _serializable(obj):
+    """Helper to serialize Mistral objects"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return obj
+
+
+class WireMessage(dict):
+    """A history message in the form it is sent to the API, JSON-encoded once
+    
+    Messages enter the history as plain dicts or SDK message objects. They
+    are converted once into canonical dicts (the fields the SDK would send,
+    unset ones dropped) and never mutated afterwards, so the encoding cached
+    on first use serves every later request body, the journal and snapshots.
+    """
+    
+    __slots__ = ("_encoded",)
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._encoded = None
+    
+    @classmethod
+    def of(cls, message: Any) -> "WireMessage":
+        """The message itself if already canonical, else its canonical copy"""
+        if isinstance(message, cls):
+            return message
+        if hasattr(message, "model_dump"):
+            return cls(message.model_dump(exclude_none=True))
+        return cls({key: value for key, value in message.items() if value is not None})
+    
+    def encoded(self) -> str:
+        """Compact JSON of the message, computed on first use"""
+        if self._encoded is None:
+            self._encoded = json.dumps(self, separators=(",", ":"), default=_serializable)
+        return self._encoded
+
+
+def encode_messages(messages: List[Any]) -> str:
+    """JSON array of messages, joined from their cached encodings"""
+    return "[" + ",".join(WireMessage.of(m).encoded() for m in messages) + "]"
+
+
+def request_body(request: Dict) -> bytes:
+    """The JSON body of a chat request; the history is not re-encoded, only joined"""
+    fields = []
+    for key, value in request.items():
+        if value is None:
+            continue
+        encoded = encode_messages(value) if key == "messages" else json.dumps(
+            value, separators=(",", ":"), default=_serializable
+        )
+        fields.append(f'"{key}":{encoded}')
+    return ("{" + ",".join(fields) + "}").encode()
+
+
+class SessionJournal:
+    """Append-only JSONL journal of a session with periodic compacted snapshots
+    
+    Every message is appended to session_<id>.jsonl as soon as it enters the
+    history. Every `snapshot_every` records the journal is folded into
+    session_<id>.json (the full message list, one message per line) and
+    truncated. Folding appends the new records' cached encodings to the
+    snapshot in place, so it neither re-reads, re-encodes nor copies the
+    earlier history. A fold cut short by a crash leaves whole messages
+    before the cut: reads keep those, the journal (truncated only after a
+    fold completes) still holds the rest, and the next fold continues after
+    the last whole message.
+    """
+    
+    def __init__(self, session_id: str, memory_dir: str = "./memory", fsync: bool = False,
+                 atomic: bool = True, snapshot_every: int = 50, tracer: Optional[Tracer] = None):
+        self.session_id = session_id
+        self.tracer = tracer or Tracer()
+        self.memory_dir = Path(memory_dir)
+        self.memory_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshot_file = self.memory_dir / f"session_{session_id}.json"
+        self.journal_file = self.memory_dir / f"session_{session_id}.jsonl"
+        self.fsync = fsync
+        self.atomic = atomic
+        self.snapshot_every = snapshot_every
+        
+        self._lock = threading.Lock()
+        self._since_snapshot = 0
+        self._snapshotted, messages = self._read()
+        self._seq = len(messages)
+        # Encodings of the records not yet folded into the snapshot
+        self._pending = [WireMessage.of(m).encoded() for m in messages[self._snapshotted:]]
+        self._handle = None
+    
+    @staticmethod
+    def new_session_id(memory_dir: str = "./memory") -> str:
+        """Today's session id, without clobbering an earlier session from today"""
+        session_id = datetime.now().strftime('%Y%m%d')
+        memory = Path(memory_dir)
+        if (memory / f"session_{session_id}.json").exists() or (memory / f"session_{session_id}.jsonl").exists():
+            session_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        return session_id
+    
+    @staticmethod
+    def latest_session_id(memory_dir: str = "./memory") -> Optional[str]:
+        """Id of the most recently written session, if any"""
+        files = [f for f in Path(memory_dir).glob("session_*.json*") if f.suffix in (".json", ".jsonl")]
+        if not files:
+            return None
+        latest = max(files, key=lambda f: f.stat().st_mtime)
+        return latest.stem[len("session_"):]
+    
+    def load(self) -> List[Dict]:
+        """Rebuild the full message history from snapshot + journal"""
+        return self._read()[1]
+    
+    def _read(self) -> tuple:
+        """(messages in the snapshot, full history)"""
+        messages = []
+        if self.snapshot_file.exists():
+            with open(self.snapshot_file, 'rb') as f:
+                data = f.read()
+            try:
+                messages = json.loads(data)
+            except json.JSONDecodeError:
+                messages = self._salvage(data)[0]
+        snapshotted = len(messages)
+        
+        # Bytes of whole records; appends start here, past a line torn by a crash
+        self._journal_end = 0
+        if self.journal_file.exists():
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self._journal_end += len(line)
+                    # Records already folded into the snapshot are skipped
+                    if record["seq"] >= len(messages):
+                        messages.append(record["message"])
+        return snapshotted, messages
+    
+    @staticmethod
+    def _salvage(data: bytes) -> tuple:
+        """(whole messages, byte offset after the last one) of a snapshot a crash cut short"""
+        messages = []
+        end = None
+        offset = 0
+        for line in data.splitlines(keepends=True):
+            start, offset = offset, offset + len(line)
+            item = line.strip()
+            if end is None:
+                if item != b"[":
+                    break
+                end = offset
+                continue
+            try:
+                messages.append(json.loads(item.rstrip(b",")))
+            except json.JSONDecodeError:
+                break
+            end = start + len(line.rstrip().rstrip(b","))
+        return messages, end
+    
+    def record(self, message: Any):
+        """Append one message to the journal"""
+        with self.tracer.span("persist.journal") as span:
+            encoded = WireMessage.of(message).encoded()
+            with self._lock:
+                line = f'{{"seq": {self._seq}, "message": {encoded}}}\n'
+                span["bytes_out"] = len(line)
+                if self._handle is None:
+                    self._handle = self._open_journal()
+                self._handle.write(line)
+                self._handle.flush()
+                if self.fsync:
+                    os.fsync(self._handle.fileno())
+                self._pending.append(encoded)
+                self._seq += 1
+                self._since_snapshot += 1
+                due = self.snapshot_every and self._since_snapshot >= self.snapshot_every
+        
+        if due:
+            self.snapshot()
+    
+    def _open_journal(self):
+        """Open the journal for appending, without a torn last line (lock held)"""
+        handle = open(self.journal_file, 'a')
+        if os.path.getsize(self.journal_file) > self._journal_end:
+            handle.truncate(self._journal_end)
+        return handle
+    
+    def snapshot(self):
+        """Fold the journal into the snapshot file and truncate it"""
+        with self.tracer.span("persist.snapshot") as span:
+            with self._lock:
+                if self._pending or not self.snapshot_file.exists():
+                    self._fold()
+                
+                # Safe to truncate: load() skips records the snapshot already holds
+                if self._handle is not None:
+                    self._handle.close()
+                self._handle = open(self.journal_file, 'w')
+                self._journal_end = 0
+                self._since_snapshot = 0
+                span["messages"] = self._snapshotted
+                span["bytes_out"] = self.snapshot_file.stat().st_size
+    
+    def _fold(self):
+        """Append the pending records to the snapshot's JSON array (lock held)"""
+        # Byte offset of the closing bracket of the existing array, if it holds anything
+        end = None
+        if self._snapshotted and self.snapshot_file.exists():
+            with open(self.snapshot_file, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(size - 64, 0))
+                tail = f.read()
+            body = tail.rstrip()
+            if body.endswith(b"]"):
+                end = size - len(tail) + len(body[:-1].rstrip())
+            else:
+                # The last fold was cut short: carry on after its last whole message
+                end = self._salvage(self.snapshot_file.read_bytes())[1]
+        
+        added = ",\n".join(self._pending).encode()
+        if end is None:
+            data = b"[\n" + added + b"\n]"
+        else:
+            data = (b",\n" + added if added else b"") + b"\n]"
+        
+        # Only a fresh snapshot goes through a temporary file; folds append in place
+        target = self.snapshot_file
+        if self.atomic and end is None:
+            target = self.snapshot_file.with_suffix(".json.tmp")
+        with open(target, 'wb' if end is None else 'r+b') as f:
+            if end is not None:
+                f.seek(end)
+                f.truncate()
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        if target != self.snapshot_file:
+            os.replace(target, self.snapshot_file)
+        
+        self._snapshotted += len(self._pending)
+        self._pending = []
+    
+    def close(self):
+        """Write a final snapshot and release the journal"""
+        self.snapshot()
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            if self.journal_file.exists() and self.journal_file.stat().st_size == 0:
+                self.journal_file.unlink()
+
+
+class MemoryIndex:
+    """Full-text index of past sessions for search_memory
+    
+    Session snapshots and journals in memory/ are indexed into an SQLite
+    FTS5 table, one row per chunk of a user, assistant or tool message,
+    tagged with its session, turn and position. Indexing is incremental:
+    a session is re-read only when its files changed, and only messages
+    past the last indexed one are added.
+    """
+    
+    # Long messages are split so a hit points at the relevant part
+    CHUNK_CHARS = 800
+    # Tool output is indexed only up to this size; the full text stays in the session file
+    MAX_TOOL_CHARS = 2000
+    
+    # Left out of queries unless nothing else is left
+    STOPWORDS = frozenset({
+        "a", "an", "and", "are", "as", "at", "be", "by", "did", "do", "for", "from", "how", "i", "in", "is",
+        "it", "me", "my", "of", "on", "or", "that", "the", "this", "to", "was", "we", "what", "when", "with", "you"
+    })
+    
+    def __init__(self, memory_dir: str = "./memory", db_path: Optional[str] = None):
+        self.memory_dir = Path(memory_dir)
+        self.db_path = Path(db_path) if db_path else self.memory_dir / "memory_index.sqlite"
+        self._lock = threading.Lock()
+        self._db = None
+    
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(session TEXT PRIMARY KEY, signature TEXT, messages INTEGER, turns INTEGER)"
+            )
+            db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+                "content, session UNINDEXED, turn UNINDEXED, seq UNINDEXED, role UNINDEXED, "
+                "tokenize='porter unicode61')"
+            )
+            self._db = db
+        return self._db
+    
+    def _session_files(self) -> Dict[str, List[Path]]:
+        sessions = {}
+        for path in self.memory_dir.glob("session_*.json*"):
+            if path.suffix in (".json", ".jsonl"):
+                sessions.setdefault(path.name[len("session_"):].rsplit(".", 1)[0], []).append(path)
+        return sessions
+    
+    @staticmethod
+    def _signature(paths: List[Path]) -> str:
+        parts = []
+        for path in sorted(paths):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            parts.append(f"{path.name}:{stat.st_mtime_ns}:{stat.st_size}")
+        return ";".join(parts)
+    
+    def _chunks(self, message: Dict) -> List[str]:
+        role = message.get("role")
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = json.dumps(content, default=_serializable)
+        if role == "assistant" and message.get("tool_calls"):
+            calls = ", ".join(
+                f"{_tool_call_name(call)}({json.dumps(_tool_call_arguments(call))})" for call in message["tool_calls"]
+            )
+            content = f"{content}\n[called {calls}]".strip()
+        elif role == "tool":
+            content = f"[{message.get('name', 'tool')}] {content[:self.MAX_TOOL_CHARS]}"
+        content = content.strip()
+        return [content[i:i + self.CHUNK_CHARS] for i in range(0, len(content), self.CHUNK_CHARS)]
+    
+    def refresh(self) -> int:
+        """Index sessions written since the last refresh; returns the number of new chunks"""
+        added = 0
+        with self._lock:
+            db = self._connect()
+            known = {row[0]: row[1:] for row in db.execute("SELECT session, signature, messages, turns FROM sessions")}
+            files = self._session_files()
+            
+            with db:
+                for session in set(known) - set(files):
+                    db.execute("DELETE FROM chunks WHERE session = ?", (session,))
+                    db.execute("DELETE FROM sessions WHERE session = ?", (session,))
+                
+                for session, paths in files.items():
+                    signature = self._signature(paths)
+                    indexed_signature, indexed, turn = known.get(session, (None, 0, 0))
+                    if signature == indexed_signature:
+                        continue
+                    try:
+                        messages = SessionJournal(session, str(self.memory_dir)).load()
+                    except (OSError, ValueError):
+                        continue
+                    if len(messages) < indexed:
+                        # Rewritten rather than appended to: start over
+                        db.execute("DELETE FROM chunks WHERE session = ?", (session,))
+                        indexed, turn = 0, 0
+                    
+                    rows = []
+                    for seq in range(indexed, len(messages)):
+                        message = messages[seq]
+                        if not isinstance(message, dict):
+                            continue
+                        if message.get("role") == "user":
+                            turn += 1
+                        if message.get("role") in ("user", "assistant", "tool"):
+                            rows.extend(
+                                (chunk, session, turn, seq, message["role"]) for chunk in self._chunks(message)
+                            )
+                    db.executemany("INSERT INTO chunks (content, session, turn, seq, role) VALUES (?, ?, ?, ?, ?)", rows)
+                    db.execute(
+                        "INSERT OR REPLACE INTO sessions (session, signature, messages, turns) VALUES (?, ?, ?, ?)",
+                        (session, signature, len(messages), turn)
+                    )
+                    added += len(rows)
+        return added
+    
+    @classmethod
+    def _match_query(cls, query: str) -> str:
+        # Plain words OR'ed together, so free text never trips the FTS5 query syntax
+        terms = re.findall(r"\w+", query.lower())
+        terms = [t for t in terms if t not in cls.STOPWORDS] or terms
+        return " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
+    
+    def search(self, query: str, limit: int = 5, session: Optional[str] = None,
+               exclude_session: Optional[str] = None) -> List[Dict]:
+        """Best-matching chunks (BM25) with their session, turn and a highlighted snippet"""
+        match = self._match_query(query)
+        if not match:
+            return []
+        self.refresh()
+        
+        sql = ("SELECT session, turn, seq, role, snippet(chunks, 0, '[', ']', '...', 32), bm25(chunks) "
+               "FROM chunks WHERE chunks MATCH ?")
+        params = [match]
+        if session:
+            sql += " AND session = ?"
+            params.append(session)
+        if exclude_session:
+            sql += " AND session != ?"
+            params.append(exclude_session)
+        sql += " ORDER BY bm25(chunks) LIMIT ?"
+        params.append(max(int(limit), 1))
+        
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [
+            {"session": row[0], "turn": row[1], "message": row[2], "role": row[3], "snippet": row[4],
+             "score": round(-row[5], 3)}
+            for row in rows
+        ]
+    
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def _message_field(message: Any, key: str, default: Any = None) -> Any:
+    """Read a field from a plain dict or a Mistral message object"""
+    if isinstance(message, dict):
+        return message.get(key, default)
+    value = getattr(message, key, default)
+    return default if value is None else value
+
+
+class ContextManager:
+    """Keeps the history sent to the model under a token budget
+    
+    Token counts are estimated from message size and calibrated against the
+    usage the API reports. When the budget is crossed, older turns are
+    compacted: superseded tool outputs are dropped first, then whole turns
+    are folded into a summary kept in the system message. An assistant
+    message with tool_calls always stays together with its tool replies.
+    """
+    
+    SUMMARY_MARKER = "\n\n## Summary of Earlier Conversation\n\n"
+    
+    # Tools whose output is superseded by a later identical call on the same path
+    PATH_TOOLS = {"read_file": "path", "list_files": "directory", "search_file": "path", "search_files": "directory"}
+    
+    def __init__(self, budget: int = 32000, keep_recent_turns: int = 3, summarizer=None):
+        self.budget = budget
+        self.keep_recent_turns = keep_recent_turns
+        self.summarizer = summarizer or self.extractive_summary
+        self.chars_per_token = 4.0
+        self._tokens = {}
+        self._sizes = {}
+        self.compactions = 0
+    
+    def _size(self, message: Any) -> int:
+        cached = self._sizes.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        size = self._measure(message)
+        self._sizes[id(message)] = (message, size)
+        return size
+    
+    @staticmethod
+    def _measure(message: Any) -> int:
+        content = _message_field(message, "content", "") or ""
+        if not isinstance(content, str):
+            content = json.dumps(content, default=_serializable)
+        size = len(content)
+        for call in _message_field(message, "tool_calls", []) or []:
+            size += len(_tool_call_name(call)) + len(str(_tool_call_arguments(call)))
+        return size
+    
+    def tokens(self, message: Any) -> int:
+        """Reported token count of a message, or an estimate"""
+        cached = self._tokens.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        estimate = int(self._size(message) / self.chars_per_token) + 4
+        self._tokens[id(message)] = (message, estimate)
+        return estimate
+    
+    def record(self, message: Any, tokens: int):
+        """Store a reported token count for a message (e.g. completion_tokens)"""
+        self._tokens[id(message)] = (message, tokens)
+    
+    def adopt(self, original: Any, stored: Any):
+        """Carry a reported token count over to the copy of a message kept in the history"""
+        cached = self._tokens.get(id(original))
+        if stored is not original and cached is not None and cached[0] is original:
+            self._tokens[id(stored)] = (stored, cached[1])
+            del self._tokens[id(original)]
+    
+    def observe_usage(self, usage: Any, messages: List[Any], tools: Optional[List[Dict]] = None):
+        """Calibrate the chars-per-token ratio against reported prompt tokens"""
+        prompt_tokens = _message_field(usage, "prompt_tokens")
+        if not prompt_tokens:
+            return
+        chars = sum(self._size(m) for m in messages) + len(json.dumps(tools or []))
+        observed = chars / prompt_tokens
+        if 1.0 <= observed <= 8.0:
+            self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * observed
+    
+    def total(self, messages: List[Any]) -> int:
+        return sum(self.tokens(m) for m in messages)
+    
+    def fit(self, messages: List[Any]) -> List[Any]:
+        """Return the history, compacted if it is over budget"""
+        if self.total(messages) <= self.budget:
+            return messages
+        
+        compacted = self._drop_stale_tool_outputs(messages)
+        if self.total(compacted) > self.budget:
+            compacted = self._summarize_old_turns(compacted)
+        
+        if len(compacted) == len(messages) and all(a is b for a, b in zip(compacted, messages)):
+            return messages
+        
+        self.compactions += 1
+        live = {id(m) for m in compacted}
+        self._tokens = {k: v for k, v in self._tokens.items() if k in live}
+        self._sizes = {k: v for k, v in self._sizes.items() if k in live}
+        return compacted
+    
+    def _drop_stale_tool_outputs(self, messages: List[Any]) -> List[Any]:
+        """Keep only the latest result per file; older tool outputs become stubs"""
+        calls = {}
+        for message in messages:
+            for call in _message_field(message, "tool_calls", []) or []:
+                calls[_tool_call_id(call)] = (_tool_call_name(call), _tool_call_arguments(call))
+        
+        # Results the model has not answered yet are never touched
+        last_assistant = max((i for i, m in enumerate(messages) if _message_field(m, "role") == "assistant"), default=0)
+        recent_start = self._recent_start(messages)
+        
+        latest = {}
+        for i, message in enumerate(messages):
+            if _message_field(message, "role") != "tool":
+                continue
+            name, args = calls.get(_message_field(message, "tool_call_id"), ("", {}))
+            # A memoized "unchanged" reference points at the earlier output, which must stay
+            if name in self.PATH_TOOLS and not str(_message_field(message, "content", "")).startswith(
+                    ToolExecutor.UNCHANGED):
+                latest[(name, json.dumps(args, sort_keys=True))] = i
+        
+        result = []
+        for i, message in enumerate(messages):
+            if _message_field(message, "role") != "tool" or i > last_assistant:
+                result.append(message)
+                continue
+            
+            name, args = calls.get(_message_field(message, "tool_call_id"), ("", {}))
+            stub = None
+            if name in self.PATH_TOOLS:
+                if latest.get((name, json.dumps(args, sort_keys=True))) != i:
+                    target = args.get(self.PATH_TOOLS[name], "")
+                    stub = f"[Stale {name} output for {target} dropped - a newer result appears later]"
+            elif i < recent_start:
+                stub = f"[Earlier {name} output dropped to save context]"
+            
+            if stub and self._size(message) > len(stub):
+                result.append({
+                    "role": "tool",
+                    "name": _message_field(message, "name", name),
+                    "content": stub,
+                    "tool_call_id": _message_field(message, "tool_call_id")
+                })
+            else:
+                result.append(message)
+        return result
+    
+    def _recent_start(self, messages: List[Any]) -> int:
+        """Index of the first message of the turns that are never compacted"""
+        user_turns = [i for i, m in enumerate(messages) if _message_field(m, "role") == "user"]
+        if len(user_turns) <= self.keep_recent_turns:
+            return user_turns[0] if user_turns else len(messages)
+        return user_turns[-self.keep_recent_turns]
+    
+    def _summarize_old_turns(self, messages: List[Any]) -> List[Any]:
+        """Fold every turn before the recent window into the system message"""
+        has_system = bool(messages) and _message_field(messages[0], "role") == "system"
+        start = 1 if has_system else 0
+        # Turns start at user messages, so the cut never separates tool_calls from tool replies
+        cut = self._recent_start(messages)
+        if cut <= start:
+            return messages
+        
+        old = messages[start:cut]
+        try:
+            summary = self.summarizer(old)
+        except Exception:
+            summary = self.extractive_summary(old)
+        
+        system = _message_field(messages[0], "content", "") if has_system else ""
+        base, _, previous = system.partition(self.SUMMARY_MARKER)
+        summary = f"{previous.strip()}\n\n{summary.strip()}".strip()
+        
+        return [{"role": "system", "content": base + self.SUMMARY_MARKER + summary}] + messages[cut:]
+    
+    @staticmethod
+    def extractive_summary(messages: List[Any]) -> str:
+        """Cheap local summary: one line per user request and answer"""
+        lines = []
+        for message in messages:
+            role = _message_field(message, "role")
+            content = _message_field(message, "content", "") or ""
+            if not isinstance(content, str):
+                content = json.dumps(content, default=_serializable)
+            content = " ".join(content.split())
+            if role == "user":
+                lines.append(f"- User asked: {content[:200]}")
+            elif role == "assistant" and content:
+                lines.append(f"- Agent answered: {content[:200]}")
+            for call in _message_field(message, "tool_calls", []) or []:
+                lines.append(f"- Agent used {_tool_call_name(call)} {json.dumps(_tool_call_arguments(call))[:120]}")
+        return "\n".join(lines)
+
+
+def _tool_call_id(call: Any) -> str:
+    return _message_field(call, "id", "")
+
+
+def _tool_call_name(call: Any) -> str:
+    return _message_field(_message_field(call, "function", {}), "name", "")
+
+
+def _tool_call_arguments(call: Any) -> Dict:
+    arguments = _message_field(_message_field(call, "function", {}), "arguments", {})
+    if isinstance(arguments, str):
+        try:
+            arguments = json.loads(arguments)
+        except json.JSONDecodeError:
+            return {}
+    return arguments if isinstance(arguments, dict) else {}
+
+
+class CachedBackend(LLMBackend):
+    """Content-addressed response cache in front of another backend
+    
+    The key is a hash of the model, request options, tool schema and the
+    normalized messages (roles, text, tool names and arguments; not the
+    random tool call ids), so a rerun of the same conversation is answered
+    from the cache. Requests whose history holds output of a
+    non-deterministic tool are passed through and never stored.
+    """
+    
+    # Tools whose output differs from run to run; a history containing it won't repeat
+    BYPASS_TOOLS = frozenset({"execute_shell", "check_shell_job", "web_search", "check_sub_agent", "search_memory"})
+    
+    def __init__(self, inner: LLMBackend, cache: Optional[TTLCache] = None,
+                 bypass_tools: Optional[set] = None):
+        self.inner = inner
+        self.cache = cache or TTLCache(
+            max_entries=1024,
+            ttl=7 * 24 * 3600,
+            disk_dir="./memory/cache/llm",
+            max_disk_bytes=512 * 1024 * 1024
+        )
+        self.bypass_tools = self.BYPASS_TOOLS if bypass_tools is None else frozenset(bypass_tools)
+        self.bypassed = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _normalized(message: Any) -> Dict:
+        content = _message_field(message, "content", "")
+        if isinstance(content, list):
+            content = "".join(_message_field(part, "text", "") for part in content)
+        normalized = {"role": _message_field(message, "role"), "content": content or ""}
+        if _message_field(message, "name"):
+            normalized["name"] = _message_field(message, "name")
+        calls = _message_field(message, "tool_calls")
+        if calls:
+            normalized["tool_calls"] = [
+                {"name": _tool_call_name(call), "arguments": _tool_call_arguments(call)} for call in calls
+            ]
+        return normalized
+    
+    def key(self, request: Dict) -> Optional[str]:
+        """Cache key of a request, or None if it must not be cached"""
+        messages = [self._normalized(m) for m in request.get("messages") or []]
+        if any(m["role"] == "tool" and m.get("name") in self.bypass_tools for m in messages):
+            return None
+        options = {k: v for k, v in request.items() if k not in ("messages", "tools")}
+        canonical = json.dumps(
+            {"options": options, "tools": request.get("tools"), "messages": messages},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=_serializable
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+    
+    def _lookup(self, request: Dict) -> tuple:
+        key = self.key(request)
+        if key is None:
+            with self._lock:
+                self.bypassed += 1
+            return None, None
+        return key, self.cache.get(key)
+    
+    def _store(self, key: Optional[str], response: Any):
+        if key is not None:
+            self.cache.set(key, _serializable(response))
+    
+    def _store_streamed(self, key: Optional[str], accumulator: "StreamAccumulator"):
+        if key is None:
+            return
+        message, usage = accumulator.finish()
+        self.cache.set(key, {
+            "id": f"cached-{key[:12]}",
+            "object": "chat.completion",
+            "model": "cached",
+            "created": int(time.time()),
+            "usage": _serializable(usage) or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            "choices": [{
+                "index": 0,
+                "finish_reason": "tool_calls" if message.tool_calls else "stop",
+                "message": _serializable(message)
+            }]
+        })
+    
+    def complete(self, **request) -> Any:
+        key, payload = self._lookup(request)
+        if payload is not None:
+            return completion_response(payload)
+        response = self.inner.complete(**request)
+        self._store(key, response)
+        return response
+    
+    def stream(self, **request) -> Any:
+        key, payload = self._lookup(request)
+        if payload is not None:
+            return ReplayStream(payload)
+        return _RecordingStream(self.inner.stream(**request), lambda acc: self._store_streamed(key, acc))
+    
+    async def complete_async(self, **request) -> Any:
+        key, payload = self._lookup(request)
+        if payload is not None:
+            return completion_response(payload)
+        response = await self.inner.complete_async(**request)
+        self._store(key, response)
+        return response
+    
+    async def stream_async(self, **request) -> Any:
+        key, payload = self._lookup(request)
+        if payload is not None:
+            return ReplayStream(payload)
+        stream = await self.inner.stream_async(**request)
+        return _RecordingStream(stream, lambda acc: self._store_streamed(key, acc))
+    
+    def stats(self) -> Dict[str, int]:
+        stats = self.cache.stats()
+        stats["bypassed"] = self.bypassed
+        return stats
+
+
+class _RecordingStream:
+    """Passes a live stream through and hands the rebuilt message to on_complete"""
+    
+    def __init__(self, stream: Any, on_complete):
+        self.stream = stream
+        self.on_complete = on_complete
+        self.accumulator = StreamAccumulator(QuietUI)
+    
+    def _record(self, event: Any):
+        self.accumulator.add(event.data)
+    
+    def __enter__(self):
+        events = self.stream.__enter__()
+        
+        def replay():
+            for event in events:
+                self._record(event)
+                yield event
+            # Only a stream read to the end is stored
+            self.on_complete(self.accumulator)
+        
+        return replay()
+    
+    def __exit__(self, *exc):
+        return self.stream.__exit__(*exc)
+    
+    async def __aenter__(self):
+        await self.stream.__aenter__()
+        return self
+    
+    async def __aexit__(self, *exc):
+        return await self.stream.__aexit__(*exc)
+    
+    async def __aiter__(self):
+        async for event in self.stream:
+            self._record(event)
+            yield event
+        self.on_complete(self.accumulator)
+
+
+class SkillRegistry:
+    """Validated, BM25-indexed view of the skills/ folder
+    
+    skills/skills.json lists the skills; each entry's markdown file holds the
+    instructions. Parsed skills are cached and re-read only when the
+    modification time of skills.json or a skill file changes.
+    """
+    
+    STOPWORDS = {
+        "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "get", "how",
+        "i", "in", "is", "it", "me", "my", "of", "on", "or", "please", "the", "this", "to", "use",
+        "using", "what", "whats", "with", "you", "your", "skill", "tool", "teach", "fetch"
+    }
+    
+    def __init__(self, skills_dir: str = "./skills", k1: float = 1.5, b: float = 0.75):
+        self.skills_dir = Path(skills_dir)
+        self.k1 = k1
+        self.b = b
+        self.skills = []
+        self.problems = []
+        self._signature = None
+        self._doc_freq = {}
+        self._avg_len = 0.0
+    
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        tokens = []
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            word = cls.fold(word)
+            if word not in cls.STOPWORDS:
+                tokens.append(word)
+        return tokens
+    
+    @staticmethod
+    def fold(word: str) -> str:
+        """Plural folding: "temperatures", "queries", "teaches" match their singular"""
+        if len(word) > 4 and word.endswith("ies"):
+            return word[:-3] + "y"
+        if len(word) > 4 and word.endswith("es") and word[:-2].endswith(("ch", "sh", "ss", "us", "x", "z")):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+            word = word[:-1]
+        # "caches" just lost its "es", so "cache" drops the "e" to meet it
+        if len(word) > 4 and word.endswith(("che", "she")):
+            word = word[:-1]
+        return word
+    
+    def _current_signature(self) -> tuple:
+        files = [self.skills_dir / "skills.json"] + [self.skills_dir / s["file"] for s in self.skills]
+        signature = []
+        for f in files:
+            try:
+                signature.append((str(f), f.stat().st_mtime_ns))
+            except OSError:
+                signature.append((str(f), None))
+        return tuple(signature)
+    
+    def refresh(self) -> bool:
+        """Re-read the skills folder if anything changed; True if it was reloaded"""
+        if self._signature is not None and self._current_signature() == self._signature:
+            return False
+        
+        self.skills = []
+        self.problems = []
+        index_file = self.skills_dir / "skills.json"
+        try:
+            with open(index_file, 'r') as f:
+                entries = json.load(f).get("skills", [])
+        except FileNotFoundError:
+            entries = []
+        except (json.JSONDecodeError, AttributeError) as e:
+            self.problems.append(f"{index_file} is not valid: {e}")
+            entries = []
+        
+        for entry in entries:
+            if not isinstance(entry, dict) or not entry.get("name") or not entry.get("file"):
+                self.problems.append(f"Skill entry without name/file skipped: {entry}")
+                continue
+            skill_file = self.skills_dir / entry["file"]
+            if not skill_file.is_file():
+                self.problems.append(f"Skill '{entry['name']}' lists missing file {skill_file}")
+                continue
+            with open(skill_file, 'r') as f:
+                body = f.read()
+            
+            # Name, description and title describe the skill; the body itself is too noisy to rank on
+            title = next((line.lstrip("# ") for line in body.splitlines() if line.startswith("# ")), "")
+            tokens = self.tokenize(f"{entry['name']} {entry['name']} {entry.get('description', '')} {title}")
+            self.skills.append({
+                "name": entry["name"],
+                "file": entry["file"],
+                "description": entry.get("description", ""),
+                "body": body,
+                "tokens": tokens
+            })
+        
+        self._doc_freq = {}
+        for skill in self.skills:
+            for token in set(skill["tokens"]):
+                self._doc_freq[token] = self._doc_freq.get(token, 0) + 1
+        self._avg_len = sum(len(s["tokens"]) for s in self.skills) / len(self.skills) if self.skills else 0.0
+        self._signature = self._current_signature()
+        return True
+    
+    def match(self, query: str, limit: int = 2, min_score: float = 1.0) -> List[Dict]:
+        """Skills relevant to a user message, best first"""
+        self.refresh()
+        terms = set(self.tokenize(query))
+        if not terms or not self.skills:
+            return []
+        
+        n = len(self.skills)
+        scored = []
+        for skill in self.skills:
+            score = 0.0
+            length_norm = 1 - self.b + self.b * len(skill["tokens"]) / (self._avg_len or 1)
+            for term in terms:
+                tf = skill["tokens"].count(term)
+                if not tf:
+                    continue
+                df = self._doc_freq[term]
+                idf = math.log((n - df + 0.5) / (df + 0.5) + 1)
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+            if score >= min_score:
+                scored.append((score, skill))
+        
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return [skill for _, skill in scored[:limit]]
+
+
+class PromptCompiler:
+    """boot.md compiled into a compact core plus sections sent only when a turn needs them
+    
+    The core is boot.md without its examples and tool notes. Each tool's
+    notes (its ### entry under "Your Tools") and the sections tied to a
+    tool or to skills are added to the system message only on turns that
+    offer that tool or use a skill. Compiled prompts are cached per file
+    and rebuilt when its mtime or size changes.
+    """
+    
+    TOOLS_SECTION = "Your Tools"
+    # Sections that only matter when their tool is offered
+    SECTION_TOOLS = {"How to Spawn Sub-Agents": "spawn_sub_agent"}
+    SKILL_SECTIONS = {"Skills Management"}
+    DROPPED_SECTIONS = {"Example Interactions"}
+    
+    # Offered on every turn
+    BASE_TOOLS = ("read_file", "write_file", "edit_file", "list_files", "search_files")
+    # Other tools are offered when the user message hints at them
+    TOOL_TRIGGERS = {
+        "search_file": r"\b(logs?|grep|lines?|occurrences?|errors?|traceback)\b",
+        "execute_shell": r"\b(run|command|shell|terminal|install|pip|npm|git|python|script|build|tests?|compile|"
+                         r"date|time|process|disk|memory usage|ls|cd|mkdir|delete|move|copy|zip|curl)\b",
+        "check_shell_job": r"\b(job|background|still running|done yet|finished)\b",
+        "web_search": r"\b(search|web|internet|online|news|latest|current|today|weather|price|look up|google|"
+                      r"who is|what is|find out)\b",
+        "search_memory": r"\b(remember|recall|earlier|before|previous(ly)?|last (time|week|month|session)|"
+                         r"we (discussed|talked|decided|did))\b",
+        "spawn_sub_agent": r"\b(agents?|spawn|delegate|parallel|team|specialists?)\b",
+    }
+    # Tools that follow another one around
+    COMPANION_TOOLS = {"execute_shell": "check_shell_job", "spawn_sub_agent": "check_sub_agent"}
+    # Tools called in this many recent turns stay offered for follow-ups
+    STICKY_TURNS = 3
+    
+    _cache: Dict[str, tuple] = {}
+    _cache_lock = threading.Lock()
+    
+    def __init__(self, path: str = "./boot.md"):
+        self.path = Path(path)
+        self._triggers = {tool: re.compile(pattern, re.IGNORECASE) for tool, pattern in self.TOOL_TRIGGERS.items()}
+    
+    def compiled(self) -> Optional[Dict]:
+        """The compiled prompt, or None without a boot.md"""
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        key = str(self.path.resolve())
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached and cached[0] == signature:
+            return cached[1]
+        
+        compiled = self.compile(self.path.read_text())
+        with self._cache_lock:
+            self._cache[key] = (signature, compiled)
+        return compiled
+    
+    @staticmethod
+    def _compact_lines(text: str) -> List[str]:
+        """Lines without code blocks, examples, emphasis markup and repeated blank lines"""
+        lines = []
+        in_code = False
+        for line in text.splitlines():
+            if line.lstrip().startswith("```"):
+                in_code = not in_code
+                continue
+            if in_code or re.match(r"\s*(- )?\*\*Example", line) or line.strip() == "---":
+                continue
+            line = line.replace("**", "").rstrip()
+            if not line and (not lines or not lines[-1]):
+                continue
+            lines.append(line)
+        return lines
+    
+    @classmethod
+    def compile(cls, text: str) -> Dict:
+        """Split boot.md into core text, per-tool notes and optional sections"""
+        core, tool_notes, sections = [], {}, {}
+        current = core
+        heading = None
+        for line in cls._compact_lines(text):
+            if line.startswith("## "):
+                heading = line[3:].strip()
+                if heading in cls.DROPPED_SECTIONS:
+                    current = None
+                elif heading in cls.SECTION_TOOLS or heading in cls.SKILL_SECTIONS:
+                    current = sections.setdefault(heading, [])
+                    current.append(line)
+                else:
+                    current = core
+                    current.append(line)
+                continue
+            if line.startswith("### ") and heading == cls.TOOLS_SECTION:
+                # "### 1b. search_file" -> notes for search_file
+                match = re.match(r"###\s+\S+\s+(\w+)", line)
+                current = tool_notes.setdefault(match.group(1), []) if match else core
+                continue
+            if current is not None:
+                current.append(line)
+        
+        def joined(lines: List[str]) -> str:
+            return "\n".join(lines).strip()
+        
+        return {
+            "core": joined(core),
+            "tool_notes": {tool: joined(lines) for tool, lines in tool_notes.items() if joined(lines)},
+            "sections": {name: joined(lines) for name, lines in sections.items()}
+        }
+    
+    def core(self) -> Optional[str]:
+        compiled = self.compiled()
+        return compiled["core"] if compiled else None
+    
+    def turn_sections(self, tools: List[str], skills: bool = False) -> str:
+        """Notes for the tools offered this turn and the sections that go with them"""
+        compiled = self.compiled()
+        if not compiled:
+            return ""
+        parts = []
+        notes = [f"### {tool}\n{compiled['tool_notes'][tool]}" for tool in tools if tool in compiled["tool_notes"]]
+        if notes:
+            parts.append("## Notes on Your Tools\n\n" + "\n\n".join(notes))
+        for name, text in compiled["sections"].items():
+            if self.SECTION_TOOLS.get(name) in tools or (skills and name in self.SKILL_SECTIONS):
+                parts.append(text)
+        return "\n\n".join(parts)
+    
+    def select_tools(self, user_message: str, messages: List[Any], available: List[str],
+                     skills: Optional[List[Dict]] = None) -> List[str]:
+        """The tools worth offering for this turn, in their usual order"""
+        wanted = set(self.BASE_TOOLS)
+        wanted.update(tool for tool, trigger in self._triggers.items() if trigger.search(user_message))
+        
+        # Whatever was used lately stays available for follow-ups ("now do the same for ...")
+        turns = 0
+        for message in reversed(messages):
+            role = _message_field(message, "role")
+            if role == "user":
+                turns += 1
+                if turns > self.STICKY_TURNS:
+                    break
+            elif role == "assistant":
+                wanted.update(_tool_call_name(call) for call in _message_field(message, "tool_calls") or [])
+        
+        # A skill's instructions may name the tools it needs
+        for skill in skills or []:
+            wanted.update(tool for tool in available if tool in skill.get("body", ""))
+        
+        for tool, companion in self.COMPANION_TOOLS.items():
+            if tool in wanted:
+                wanted.add(companion)
+        return [tool for tool in available if tool in wanted]
 
 
 class CentralBrain:
     """Main AI brain using Mistral AI API"""
     
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, parallel_tools: bool = True, max_tool_workers: int = 4,
+                 tool_timeouts: Optional[Dict[str, float]] = None, resume: bool = False,
+                 session_id: Optional[str] = None, fsync: bool = False, snapshot_every: int = 50,
+                 stream: bool = False, context_budget: int = 32000, keep_recent_turns: int = 3,
+                 client: Any = None, tool_executor: Optional[ToolExecutor] = None, ui=BeautifulUI,
+                 backend: Optional[LLMBackend] = None,
+                 system_prompt: Optional[str] = None, allowed_tools: Optional[List[str]] = None,
+                 sub_agent_workers: int = 4, skills_dir: Optional[str] = "./skills",
+                 tracer: Optional[Tracer] = None, response_cache: Optional[bool] = None,
+                 prompt_mode: Optional[str] = None, router: Optional[ModelRouter] = None,
+                 tenant: Optional[str] = None, governor: Optional[BudgetGovernor] = None,
+                 journal_dir: str = "./memory"):
         self.api_key = api_key or os.getenv("MISTRAL_API_KEY")
+        self.ui = ui
         
-        if not self.api_key:
+        if not self.api_key and client is None and backend is None:
             raise ValueError(
                 "No API key found! Set MISTRAL_API_KEY environment variable or pass api_key parameter.\n"
                 "Get your key from: https://console.mistral.ai/"
             )
         
-        # Initialize Mistral Client
-        self.client = Mistral(api_key=self.api_key)
-        self.tool_executor = ToolExecutor()
+        # Completion backend (sessions in one process can share one); the real API by default
+        if backend is None and client is None and importlib.util.find_spec("mistralai") is None:
+            raise ImportError("The mistralai package is not installed. Run: pip install mistralai")
+        self.backend = backend or MistralBackend(self.api_key, client=client)
+        
+        # Reruns of the same conversation are answered from memory/cache/llm (AGENT_LLM_CACHE=1 or --cache)
+        if response_cache is None:
+            response_cache = os.getenv("AGENT_LLM_CACHE", "").lower() in ("1", "true", "yes")
+        if response_cache and not isinstance(self.backend, CachedBackend):
+            self.backend = CachedBackend(self.backend)
+        
+        # Which model answers each completion; shared by the process so latencies are learned once
+        self.router = router or ModelRouter.shared()
+        self._hop = 0
+        
+        # Limits on each turn, this session and the tenant (team, customer) it is billed to
+        self.governor = governor or BudgetGovernor.shared()
+        self.tenant = tenant or os.getenv("AGENT_TENANT", "default")
+        self.session_tokens = 0
+        self._budget = None
+        
+        # The journal and the trace are both named after the session
+        if resume and not session_id:
+            session_id = SessionJournal.latest_session_id(journal_dir)
+        if not session_id:
+            session_id = SessionJournal.new_session_id(journal_dir)
+        
+        # Spans for API calls, tools, persistence and rendering; shared with sub-agents
+        self.tracer = tracer or Tracer(f"./memory/traces/{session_id}.jsonl", "./memory/metrics.prom")
+        self.turns = 0
+        
+        self.tool_executor = tool_executor or ToolExecutor(
+            max_workers=max_tool_workers if parallel_tools else 1,
+            timeouts=tool_timeouts,
+            ui=ui,
+            allowed_tools=allowed_tools
+        )
+        self.tool_executor.tracer = self.tracer
+        
+        # Sub-agents run on their own thread pool and share this client
+        if sub_agent_workers and self.tool_executor.sub_agents is None:
+            self.tool_executor.sub_agents = SubAgentPool(
+                self.backend,
+                max_workers=sub_agent_workers,
+                tracer=self.tracer,
+                tenant=self.tenant
+            )
+        
+        # Compacts older turns once the history outgrows the token budget
+        self.context = ContextManager(
+            budget=context_budget,
+            keep_recent_turns=keep_recent_turns,
+            summarizer=self._summarize
+        )
         
-        # Conversation history
+        # Conversation history, journaled to ./memory (sub-agents and batches: a folder of their own) as it grows
         self.messages = []
+        self._injected = None
+        self.journal = SessionJournal(session_id, journal_dir, fsync=fsync, snapshot_every=snapshot_every,
+                                      tracer=self.tracer)
+        
+        # "compact": boot.md's core only, with notes for the tools offered each turn;
+        # "verbose" (AGENT_PROMPT_MODE=verbose or --verbose-prompt): all of boot.md and every tool on every call
+        self.prompt_mode = prompt_mode or os.getenv("AGENT_PROMPT_MODE", "compact")
+        self.prompt = None
+        if system_prompt is None and self.prompt_mode == "compact" and Path("./boot.md").exists():
+            self.prompt = PromptCompiler("./boot.md")
         
         # Load system prompt and initialize conversation
-        self.system_prompt = self._load_system_prompt()
-        self.messages.append({"role": "system", "content": self.system_prompt})
+        self.system_prompt = system_prompt or (self.prompt and self.prompt.core()) or self._load_system_prompt()
+        history = self.journal.load() if resume else []
+        if history:
+            # Resume the previous session but always run with the current prompt
+            self.messages = [WireMessage.of(m) for m in history]
+            if self.messages[0].get("role") == "system":
+                self.messages[0] = WireMessage({"role": "system", "content": self.system_prompt})
+            self.ui.system_msg(f"Resumed session {session_id} ({len(history)} messages)", "MEMORY")
+        else:
+            self._append_message({"role": "system", "content": self.system_prompt})
         
         # Define tools available to the AI
         self.tools = self._define_tools()
+        if allowed_tools is not None:
+            self.tools = [t for t in self.tools if t["function"]["name"] in allowed_tools]
+        # The subset offered on the current turn
+        self.turn_tools = self.tools
+        
+        # Render tokens as they arrive instead of waiting for the full reply
+        self.stream = stream
         
-        BeautifulUI.system_msg("Central Brain initialized with Mistral API", "SUCCESS")
+        # Skills are indexed once here and matched against each user message
+        self.skills = SkillRegistry(skills_dir) if skills_dir else None
+        self._turn_skills = []
+        if self.skills:
+            self.skills.refresh()
+            for problem in self.skills.problems:
+                self.ui.system_msg(problem, "WARNING")
+            if self.skills.skills:
+                self.ui.system_msg(f"Indexed {len(self.skills.skills)} skills", "SUCCESS")
+        
+        self.ui.system_msg("Central Brain initialized with Mistral API", "SUCCESS")
     
     def _load_system_prompt(self) -> str:
         """Load system prompt from boot.md"""
         boot_file = Path("./boot.md")
         if boot_file.exists():
-            BeautifulUI.system_msg("Loading system prompt from boot.md...", "PROCESS")
+            self.ui.system_msg("Loading system prompt from boot.md...", "PROCESS")
             with open(boot_file, 'r') as f:
                 content = f.read()
-            BeautifulUI.system_msg("System prompt loaded", "SUCCESS")
+            self.ui.system_msg("System prompt loaded", "SUCCESS")
             return content
         else:
-            BeautifulUI.system_msg("boot.md not found - using default", "WARNING")
+            self.ui.system_msg("boot.md not found - using default", "WARNING")
             return "You are AI Agent Level 5, a helpful AI assistant with access to tools."
     
     def _define_tools(self) -> List[Dict]:
@@ -301,19 +3976,60 @@ class CentralBrain:
                 "type": "function",
                 "function": {
                     "name": "read_file",
-                    "description": "Read the contents of a file. Returns the full text content of the file.",
+                    "description": "Read the contents of a file. Returns the full text of small files; large files return a handle and must be paged with offset/limit.",
                     "parameters": {
                         "type": "object",
                         "properties": {
                             "path": {
                                 "type": "string",
                                 "description": "Path to the file to read (e.g., './workspace/data.txt', 'boot.md')"
+                            },
+                            "offset": {
+                                "type": "integer",
+                                "description": "Line number to start reading from (1 = first line)"
+                            },
+                            "limit": {
+                                "type": "integer",
+                                "description": "Maximum number of lines to return (default 200 when paging)"
                             }
                         },
                         "required": ["path"]
                     }
                 }
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "search_file",
+                    "description": "Search a (possibly very large) file for a regex or text and return only the matching lines with surrounding context. Use for logs instead of reading them whole.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "path": {
+                                "type": "string",
+                                "description": "Path to the file to search"
+                            },
+                            "pattern": {
+                                "type": "string",
+                                "description": "Regular expression or plain text to look for (e.g., 'ERROR', 'timeout after \\d+s')"
+                            },
+                            "context": {
+                                "type": "integer",
+                                "description": "Lines of context before and after each match (default 2)"
+                            },
+                            "max_matches": {
+                                "type": "integer",
+                                "description": "Maximum number of matches to return (default 50)"
+                            },
+                            "ignore_case": {
+                                "type": "boolean",
+                                "description": "Case-insensitive search"
+                            }
+                        },
+                        "required": ["path", "pattern"]
+                    }
+                }
+            },
             {
                 "type": "function",
                 "function": {
@@ -335,23 +4051,98 @@ class CentralBrain:
                     }
                 }
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "edit_file",
+                    "description": "Change part of an existing file without resending all of it: either search/replace edits or a unified diff. The file is written atomically; nothing changes if any edit does not apply. Prefer this over write_file for changes to existing files.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "path": {
+                                "type": "string",
+                                "description": "Path of the file to edit"
+                            },
+                            "edits": {
+                                "type": "array",
+                                "description": "Applied in order. Each search must match the file exactly (indentation included) and only once, unless all is true",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "search": {"type": "string", "description": "Exact text to replace"},
+                                        "replace": {"type": "string", "description": "Replacement text"},
+                                        "all": {"type": "boolean", "description": "Replace every occurrence"}
+                                    },
+                                    "required": ["search", "replace"]
+                                }
+                            },
+                            "patch": {
+                                "type": "string",
+                                "description": "Unified diff (@@ -start,count +start,count @@ hunks) to apply instead of edits"
+                            },
+                            "expected_sha256": {
+                                "type": "string",
+                                "description": "The sha256 read_file reported; the edit is refused if the file changed since"
+                            }
+                        },
+                        "required": ["path"]
+                    }
+                }
+            },
             {
                 "type": "function",
                 "function": {
                     "name": "execute_shell",
-                    "description": "Execute a shell command and return its output. Use for running system commands.",
+                    "description": "Execute a shell command and return its output. The working directory and exported environment variables carry over between commands of the same session. Long output is cut to its head and tail, with the full output saved to a log file. Commands still running after `timeout` seconds continue as background jobs.",
                     "parameters": {
                         "type": "object",
                         "properties": {
                             "command": {
                                 "type": "string",
                                 "description": "Shell command to execute (e.g., 'ls -la', 'python script.py')"
+                            },
+                            "timeout": {
+                                "type": "number",
+                                "description": "Seconds to wait for the command before returning a job id instead (default 30, max 600)"
+                            },
+                            "background": {
+                                "type": "boolean",
+                                "description": "Start the command as a background job and return immediately (builds, servers, long tests)"
+                            },
+                            "session": {
+                                "type": "string",
+                                "description": "Shell session name; each keeps its own cwd and env (default 'default')"
                             }
                         },
                         "required": ["command"]
                     }
                 }
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "check_shell_job",
+                    "description": "Check on background shell jobs. With a job_id, returns its status and the output produced since the last check, optionally waiting for it to finish or killing it. Without one, lists all jobs.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "job_id": {
+                                "type": "string",
+                                "description": "Id returned by execute_shell"
+                            },
+                            "wait": {
+                                "type": "number",
+                                "description": "Seconds to wait for the job to finish (0 = just poll, max 600)"
+                            },
+                            "kill": {
+                                "type": "boolean",
+                                "description": "Kill the job"
+                            }
+                        },
+                        "required": []
+                    }
+                }
+            },
             {
                 "type": "function",
                 "function": {
@@ -373,24 +4164,102 @@ class CentralBrain:
                 "type": "function",
                 "function": {
                     "name": "list_files",
-                    "description": "List all files and directories in a given directory.",
+                    "description": "List files and directories with size and modification time. Set recursive and a glob pattern to see a whole tree in one call; results are paged. Skips .gitignore'd files, .git, __pycache__ and the like.",
                     "parameters": {
                         "type": "object",
                         "properties": {
                             "directory": {
                                 "type": "string",
                                 "description": "Directory to list (e.g., '.', './workspace', './memory')"
+                            },
+                            "recursive": {
+                                "type": "boolean",
+                                "description": "Include everything below the directory, not just its direct entries"
+                            },
+                            "pattern": {
+                                "type": "string",
+                                "description": "Only files matching this glob, on the name ('*.py') or the relative path ('src/**/*.ts')"
+                            },
+                            "offset": {
+                                "type": "integer",
+                                "description": "Entries to skip, to continue a long listing (default 0)"
+                            },
+                            "limit": {
+                                "type": "integer",
+                                "description": "Entries per page (default 200)"
+                            },
+                            "include_ignored": {
+                                "type": "boolean",
+                                "description": "Also list files excluded by .gitignore/.agentignore and the default ignores"
                             }
                         },
                         "required": ["directory"]
                     }
                 }
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "search_files",
+                    "description": "Search the contents of every text file under a directory for a regex or text and return path:line: text for each matching line. Use it to find where something is defined or mentioned instead of reading files one by one.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "query": {
+                                "type": "string",
+                                "description": "Regular expression or plain text to look for (e.g., 'def parse_', 'TODO')"
+                            },
+                            "directory": {
+                                "type": "string",
+                                "description": "Directory to search recursively (default '.')"
+                            },
+                            "pattern": {
+                                "type": "string",
+                                "description": "Only search files matching this glob (e.g., '*.py', 'docs/**/*.md')"
+                            },
+                            "ignore_case": {
+                                "type": "boolean",
+                                "description": "Case-insensitive search"
+                            },
+                            "max_matches": {
+                                "type": "integer",
+                                "description": "Maximum number of matching lines to return (default 100)"
+                            }
+                        },
+                        "required": ["query"]
+                    }
+                }
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "search_memory",
+                    "description": "Search all past conversations (earlier sessions and the parts of this one that were compacted away) and return the most relevant snippets with their session and turn. Use it when the user refers to something discussed before.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "query": {
+                                "type": "string",
+                                "description": "Words to look for (e.g., 'database migration plan', 'API key rotation')"
+                            },
+                            "limit": {
+                                "type": "integer",
+                                "description": "Number of snippets to return (default 5, at most 20)"
+                            },
+                            "session": {
+                                "type": "string",
+                                "description": "Only search this session id"
+                            }
+                        },
+                        "required": ["query"]
+                    }
+                }
+            },
             {
                 "type": "function",
                 "function": {
                     "name": "spawn_sub_agent",
-                    "description": "Spawn a specialized sub-agent with a specific role and tools. Use this to delegate specialized tasks.",
+                    "description": "Spawn a specialized sub-agent with a specific role and tools that works on a subtask in the background. Spawn several to work in parallel, then collect results with check_sub_agent.",
                     "parameters": {
                         "type": "object",
                         "properties": {
@@ -406,9 +4275,34 @@ class CentralBrain:
                                 "type": "array",
                                 "items": {"type": "string"},
                                 "description": "List of tool names this agent should have access to"
+                            },
+                            "task": {
+                                "type": "string",
+                                "description": "The concrete subtask the sub-agent should work on and report back about"
+                            }
+                        },
+                        "required": ["name", "role", "tools", "task"]
+                    }
+                }
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "check_sub_agent",
+                    "description": "Check on sub-agents. With an agent_id, returns its status and result, optionally waiting for it to finish. Without one, lists all sub-agents.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "agent_id": {
+                                "type": "string",
+                                "description": "Id returned by spawn_sub_agent"
+                            },
+                            "wait": {
+                                "type": "number",
+                                "description": "Seconds to wait for the sub-agent to finish (0 = just poll, max 300)"
                             }
                         },
-                        "required": ["name", "role", "tools"]
+                        "required": []
                     }
                 }
             }
@@ -416,85 +4310,312 @@ class CentralBrain:
     
     def chat(self, user_message: str) -> str:
         """Send message to AI and get response"""
-        
-        # Add user message to history
-        self.messages.append({
-            "role": "user",
-            "content": user_message
-        })
-        
-        # Save to file
-        self._save_conversation()
-        
-        BeautifulUI.ai_thinking()
-        
-        # Call Mistral API
-        response = self.client.chat.complete(
-            model="mistral-large-latest",
-            messages=self.messages,
-            tools=self.tools
-        )
-        
-        # Process response and handle tool calls
-        final_response = self._process_response(response)
+        # Raises BudgetExceeded before anything is added to the history
+        self._budget = self.governor.admit(self.tenant, self.session_tokens)
+        with self._turn(user_message):
+            # Add user message to history
+            self._append_message({
+                "role": "user",
+                "content": user_message
+            })
+            self._select_skills(user_message)
+            self._select_tools(user_message)
+            
+            self.ui.ai_thinking()
+            
+            # Call Mistral API
+            message = self._complete()
+            
+            # Process response and handle tool calls
+            final_response = self._process_response(message)
         
         # Add assistant response to history (text content)
         # Note: Tool use handling adds messages inside _process_response
         if final_response:
              # Only add if we haven't already added a final text response in process
              pass 
-
-        self._save_conversation()
         
         return final_response
     
-    def _process_response(self, response) -> str:
-        """Process API response and handle tool calls"""
+    @contextmanager
+    def _turn(self, user_message: str):
+        """Trace one user turn; every span inside it is tagged with the session and turn"""
+        self.turns += 1
+        self._hop = 0
+        token = _trace_context.set({"session": self.journal.session_id, "turn": self.turns})
+        try:
+            with self.tracer.span("turn", bytes_in=len(user_message)) as span:
+                yield span
+        finally:
+            _trace_context.reset(token)
+            self._flush()
+    
+    def _flush(self):
+        """Write out the traces and metrics of the turn that just ended"""
+        self.tracer.flush()
+    
+    def _complete(self, final: bool = False):
+        """Ask the model for the next assistant message (with tools disabled if final)"""
+        self._fit_context()
+        
+        tier = self.router.tier_for(self._hop)
+        self._hop += 1
+        options = {"tool_choice": "none"} if final else {}
+        message, usage, shown = self._complete_on(tier, options)
+        escalation = self.router.escalation(tier, message)
+        if escalation:
+            self.ui.system_msg(f"Asking the {escalation} model", "PROCESS")
+            message, usage, shown = self._complete_on(escalation, options)
+        if self.stream and not shown:
+            self._show_reply(message)
+        
+        self._observe_completion(message, usage)
+        return message
+    
+    def _complete_on(self, tier: str, options: Optional[Dict] = None) -> tuple:
+        """(message, usage, shown) from the first model of the tier that answers"""
+        # Small-tier replies stream too, held back until their opening shows they will not be re-asked
+        stream = self.stream and not self.router.holds_back(tier)
+        
+        def send(model: str) -> tuple:
+            with self._completion_span(model, tier, stream) as span:
+                if stream:
+                    message, usage, shown = self._stream_complete(span, model, tier, options)
+                else:
+                    response = self.backend.complete(
+                        model=model,
+                        messages=self._request_messages(),
+                        tools=self.turn_tools,
+                        **(options or {})
+                    )
+                    message, usage, shown = response.choices[0].message, response.usage, False
+                self._trace_completion(span, message, usage)
+            return message, usage, shown
+        
+        _, (message, usage, shown) = self.router.call(tier, send, self._model_failed)
+        self._charge(usage)
+        return message, usage, shown
+    
+    def _charge(self, usage: Any):
+        """Count a completion against the turn's budget"""
+        if self._budget is not None:
+            self._budget.hops += 1
+            if usage:
+                self.session_tokens += self._budget.charge(usage)
+    
+    def _out_of_budget(self) -> Optional[str]:
+        """Why the turn must not make another tool round trip, if it must not"""
+        reason = self._budget.exceeded() if self._budget is not None else None
+        if reason:
+            self.governor.stopped()
+            self.ui.system_msg(f"Turn budget reached ({reason}); answering with what I have", "WARNING")
+        return reason
+    
+    def _partial_answer(self, reason: str, message: Any = None) -> str:
+        """Record the answer of a turn its budget stopped"""
+        text = ""
+        if message is not None and not message.tool_calls and isinstance(message.content, str):
+            text = message.content.strip()
+        text = (text or "I had to stop before finishing this request.") + f"\n\n(Stopped early: {reason}.)"
+        self._append_message({"role": "assistant", "content": text})
+        return text
+    
+    def _model_failed(self, model: str, error: Exception):
+        self.ui.system_msg(f"{model} failed ({type(error).__name__}: {error})", "WARNING")
+    
+    def _show_reply(self, message: Any):
+        """Print a reply that was not streamed the way streamed replies are printed"""
+        if isinstance(message.content, str) and message.content:
+            with self.tracer.span("render", view="stream"):
+                self.ui.stream_start()
+                self.ui.stream_token(message.content)
+                self.ui.stream_end()
+    
+    def _completion_span(self, model: str, tier: str, stream: bool):
+        return self.tracer.span(
+            "llm.complete",
+            model=model,
+            tier=tier,
+            hop=self._hop - 1,
+            stream=stream,
+            messages=len(self.messages),
+            context_tokens=self.context.total(self.messages)
+        )
+    
+    @staticmethod
+    def _trace_completion(span: Dict, message: Any, usage: Any):
+        """Token counts and reply size of a completion"""
+        if usage:
+            span["prompt_tokens"] = usage.prompt_tokens
+            span["completion_tokens"] = usage.completion_tokens
+        span["tool_calls"] = len(message.tool_calls or [])
+        span["bytes_out"] = len(message.content or "") if isinstance(message.content, str) else 0
+    
+    def _select_skills(self, user_message: str):
+        """Pick the skills whose instructions go with this turn's requests"""
+        self._turn_skills = self.skills.match(user_message) if self.skills else []
+        for skill in self._turn_skills:
+            self.ui.system_msg(f"Using skill: {skill['name']}", "MEMORY")
+    
+    def _select_tools(self, user_message: str):
+        """Offer only the tools this turn is likely to need (compact prompt mode)"""
+        if self.prompt is None:
+            self.turn_tools = self.tools
+            return
+        names = self.prompt.select_tools(
+            user_message,
+            self.messages,
+            [t["function"]["name"] for t in self.tools],
+            self._turn_skills
+        )
+        self.turn_tools = [t for t in self.tools if t["function"]["name"] in names]
+    
+    def _request_messages(self) -> List[Any]:
+        """The history as sent to the model, with this turn's tool notes and skills injected"""
+        sections = []
+        if self.prompt is not None:
+            notes = self.prompt.turn_sections(
+                [t["function"]["name"] for t in self.turn_tools],
+                skills=bool(self._turn_skills)
+            )
+            if notes:
+                sections.append(notes)
+        if self._turn_skills:
+            sections.append("## Relevant Skills\n\n" + "\n\n".join(skill["body"] for skill in self._turn_skills))
+        if not sections or not self.messages:
+            return self.messages
+        
+        system = self.messages[0]
+        content = _message_field(system, "content", "") + "\n\n" + "\n\n".join(sections)
+        # Kept while the turn's sections stay the same, so it is encoded once too
+        if self._injected is None or self._injected["content"] != content:
+            self._injected = WireMessage({"role": "system", "content": content})
+        return [self._injected] + self.messages[1:]
+    
+    def _observe_completion(self, message: Any, usage: Any):
+        """Feed reported token usage back into the context manager"""
+        if usage:
+            self.context.observe_usage(usage, self.messages, self.turn_tools)
+            if usage.completion_tokens:
+                self.context.record(message, usage.completion_tokens)
+    
+    def _fit_context(self):
+        """Compact the history if it no longer fits the token budget"""
+        before = len(self.messages)
+        compactions = self.context.compactions
+        self.messages = self.context.fit(self.messages)
+        if self.context.compactions != compactions:
+            self.messages = [WireMessage.of(m) for m in self.messages]
+            # Earlier tool outputs may be gone, so "unchanged since" references could dangle
+            self.tool_executor.forget_results()
+            self.ui.system_msg(
+                f"Context compacted: {before} -> {len(self.messages)} messages "
+                f"(~{self.context.total(self.messages)} tokens)", "MEMORY"
+            )
+    
+    def _summarize(self, messages: List[Any]) -> str:
+        """Summarize older turns with the model"""
+        def send(model: str) -> Any:
+            with self.tracer.span("llm.summarize", model=model, messages=len(messages)) as span:
+                response = self.backend.complete(
+                    model=model,
+                    messages=self._summary_request(messages)
+                )
+                self._trace_completion(span, response.choices[0].message, response.usage)
+            return response
         
-        message = response.choices[0].message
+        # Summaries are a small-model job
+        _, response = self.router.call(self.router.resolve(ModelRouter.SMALL), send, self._model_failed)
+        return response.choices[0].message.content or ContextManager.extractive_summary(messages)
+    
+    @staticmethod
+    def _summary_request(messages: List[Any]) -> List[Dict]:
+        return [
+            {"role": "system", "content": "Summarize this conversation log in a few bullet points. "
+                                          "Keep facts, file names, decisions and open tasks."},
+            {"role": "user", "content": ContextManager.extractive_summary(messages)}
+        ]
+    
+    def _stream_complete(self, span: Dict, model: str, tier: str, options: Optional[Dict] = None) -> tuple:
+        """(message, usage, shown): stream the next assistant message, rendering text as it arrives"""
+        accumulator = self._accumulator(tier)
+        with self.backend.stream(
+            model=model,
+            messages=self._request_messages(),
+            tools=self.turn_tools,
+            **(options or {})
+        ) as events:
+            for event in events:
+                accumulator.add(event.data)
+        span["render_ms"] = round(accumulator.render_seconds * 1000, 3)
+        return accumulator.finish() + (not accumulator.held,)
+    
+    def _accumulator(self, tier: str) -> StreamAccumulator:
+        """Stream reader that keeps a reply off the screen until the router knows it stands"""
+        if not self.router.may_escalate(tier):
+            return StreamAccumulator(self.ui)
+        return StreamAccumulator(self.ui, hold=lambda text: not self.router.settled(tier, text))
+    
+    def _process_response(self, message) -> str:
+        """Process an assistant message and handle tool calls"""
         
         # Check if AI wants to use tools
         while message.tool_calls:
-            # Add the assistant's request to history
-            self.messages.append(message)
+            calls = self._begin_tool_calls(message)
             
-            # Execute all tools requested
-            for tool_call in message.tool_calls:
-                tool_name = tool_call.function.name
-                
-                # Mistral arguments come as a JSON string
-                try:
-                    tool_input = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError:
-                    tool_input = {}
-
-                BeautifulUI.tool_call(tool_name, tool_input)
-                
-                # Execute the tool
-                result = self.tool_executor.execute(tool_name, tool_input)
-                BeautifulUI.tool_result(str(result))
-                
-                # Append result to messages with role "tool"
-                self.messages.append({
-                    "role": "tool",
-                    "name": tool_name,
-                    "content": str(result),
-                    "tool_call_id": tool_call.id
-                })
+            # Execute them concurrently; results come back in call order
+            results = self.tool_executor.execute_many(calls)
+            self._record_tool_results(message, calls, results)
+            
+            # Out of budget: one last reply without tools (unless tokens ran out), then stop
+            reason = self._out_of_budget()
+            if reason:
+                final = None if self._budget.out_of_tokens() else self._complete(final=True)
+                return self._partial_answer(reason, final)
 
             # Get next response from AI
-            BeautifulUI.ai_thinking("AI is processing tool results...")
+            self.ui.ai_thinking("AI is processing tool results...")
             
-            response = self.client.chat.complete(
-                model="mistral-large-latest",
-                messages=self.messages,
-                tools=self.tools
-            )
-            message = response.choices[0].message
+            message = self._complete()
+        
+        return self._finish_response(message)
+    
+    def _begin_tool_calls(self, message) -> List[tuple]:
+        """Add the assistant's tool request to history and parse its calls"""
+        self._append_message(message)
         
+        calls = []
+        for tool_call in message.tool_calls:
+            tool_name = tool_call.function.name
+            
+            # Mistral arguments come as a JSON string
+            try:
+                tool_input = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError:
+                tool_input = {}
+
+            self._render("tool_call", tool_name, tool_input, tool_call.id)
+            calls.append((tool_name, tool_input))
+        return calls
+    
+    def _record_tool_results(self, message, calls: List[tuple], results: List[str]):
+        """Append tool results to history in tool_call order"""
+        for tool_call, (tool_name, _), result in zip(message.tool_calls, calls, results):
+            self._render("tool_result", str(result), tool_name, tool_call.id)
+            
+            # Append result to messages with role "tool"
+            self._append_message({
+                "role": "tool",
+                "name": tool_name,
+                "content": str(result),
+                "tool_call_id": tool_call.id
+            })
+    
+    def _finish_response(self, message) -> str:
+        """Record the final text response"""
         # If no tools, or after tools are done, we have a text response
         if message.content:
-            self.messages.append({
+            self._append_message({
                 "role": "assistant",
                 "content": message.content
             })
@@ -502,33 +4623,34 @@ class CentralBrain:
             
         return "No response generated."
     
+    def _render(self, view: str, *args):
+        """Draw a UI element, timed as a render span"""
+        with self.tracer.span("render", view=view):
+            getattr(self.ui, view)(*args)
+    
+    def _append_message(self, message: Any):
+        """Add a message to the history and journal it"""
+        # Stored in wire form: converted and encoded once for every later request and the journal
+        stored = WireMessage.of(message)
+        self.context.adopt(message, stored)
+        self.messages.append(stored)
+        self._persist(stored)
+    
+    def _persist(self, message: WireMessage):
+        """Journal a message that just entered the history"""
+        self.journal.record(message)
+    
     def _save_conversation(self):
-        """Save conversation to file"""
-        memory_dir = Path("./memory")
-        memory_dir.mkdir(exist_ok=True)
-        
-        session_file = memory_dir / f"session_{datetime.now().strftime('%Y%m%d')}.json"
-        
-        # Helper to serialize Mistral objects
-        def serializable(obj):
-            if hasattr(obj, "model_dump"):
-                return obj.model_dump()
-            return obj
-
-        with open(session_file, 'w') as f:
-            json.dump(self.messages, f, indent=2, default=serializable)
+        """Compact the session journal into its snapshot file"""
+        self.journal.close()
     
     def get_active_agents(self) -> List[Dict]:
         """Get list of active sub-agents"""
-        agents_file = Path("./memory/active_agents.json")
-        if agents_file.exists():
-            with open(agents_file, 'r') as f:
-                return json.load(f)
-        return []
+        return AgentRegistry().load()
     
     def shutdown(self):
         """Graceful shutdown"""
-        BeautifulUI.system_msg("Initiating shutdown...", "WARNING")
+        self.ui.system_msg("Initiating shutdown...", "WARNING")
         
         print(f"\n{Fore.CYAN}{'='*80}")
         print(f"{Fore.YELLOW}SESSION SUMMARY{Style.RESET_ALL}")
@@ -538,14 +4660,232 @@ class CentralBrain:
         agents = self.get_active_agents()
         print(f"Sub-agents spawned: {len(agents)}")
         
+        search = self.tool_executor.search_cache.stats()
+        print(f"Web search cache: {search['hits'] + search['disk_hits']} hits, {search['misses']} misses")
+        budgets = self.governor.stats
+        if budgets["stopped"] or budgets["queued"] or budgets["refused"]:
+            print(f"Budgets: {budgets['stopped']} turns stopped early, {budgets['queued']} queued, "
+                  f"{budgets['refused']} refused")
+        if self.tool_executor.memo_hits:
+            print(f"Repeated file/listing results replaced by references: {self.tool_executor.memo_hits}")
+        
+        if isinstance(self.backend, CachedBackend):
+            cache = self.backend.stats()
+            print(f"Response cache: {cache['hits'] + cache['disk_hits']} hits, {cache['misses']} misses, "
+                  f"{cache['bypassed']} bypassed")
+        
+        scheduler = getattr(getattr(self.backend, "inner", self.backend), "scheduler", None)
+        if scheduler and (scheduler.stats["retries"] or scheduler.stats["throttled"]):
+            pacing = scheduler.stats
+            print(f"API pacing: {pacing['throttled']} requests throttled ({pacing['wait_seconds']:.1f}s waiting), "
+                  f"{pacing['retries']} retries, {pacing['failed']} failed")
+        
+        models = self.router.summary()
+        if models:
+            routing = self.router.stats
+            print(f"Models ({routing['escalations']} escalations, {routing['fallbacks']} fallbacks): " + ", ".join(
+                f"{row['model']} {row['calls']} calls {row['latency'] * 1000:.0f} ms avg"
+                + (f" {row['errors']} errors" if row["errors"] else "")
+                for row in models
+            ))
+        
+        tokens = self.tracer.tokens
+        print(f"Tokens: {tokens['prompt']} prompt + {tokens['completion']} completion "
+              f"= {tokens['prompt'] + tokens['completion']}")
+        
+        timings = self.tracer.summary()
+        if timings:
+            print(f"\n{Fore.YELLOW}Latency (p50 / p95):")
+            for row in timings:
+                name = f"{row['span']} {row['tool']}".strip()
+                errors = f", {row['errors']} errors" if row["errors"] else ""
+                print(f"  {Fore.CYAN}• {name:<28}{Fore.WHITE} {row['p50'] * 1000:8.1f} / {row['p95'] * 1000:8.1f} ms"
+                      f"  ({row['count']} calls, {row['total']:.2f}s total{errors})")
+        
         if agents:
             print(f"\n{Fore.YELLOW}Active Sub-Agents:")
             for agent in agents:
-                print(f"  {Fore.CYAN}• {agent['name']}: {agent['role']}")
+                status = f" [{agent['status']}]" if agent.get("status") else ""
+                print(f"  {Fore.CYAN}• {agent['name']}: {agent['role']}{status}")
+        
+        self.close()
         
         print(f"\n{Fore.CYAN}{'='*80}\n")
         
         BeautifulUI.system_msg("Shutdown complete", "SUCCESS")
+    
+    def close(self):
+        """Persist the session and stop background work, without the summary"""
+        self._save_conversation()
+        if self.tool_executor.sub_agents is not None:
+            self.tool_executor.sub_agents.shutdown()
+        self.tool_executor.shell.close()
+        self.tool_executor.memory.close()
+        self.tracer.close()
+
+
+class AgentRegistry:
+    """memory/active_agents.json, safe under concurrent writers
+    
+    Writes are serialised by a process-wide lock plus an fcntl lock file
+    (where available) and land through an atomic rename.
+    """
+    
+    _lock = threading.Lock()
+    
+    def __init__(self, path: str = "./memory/active_agents.json"):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True)
+        self.lock_path = self.path.with_suffix(".lock")
+    
+    def load(self) -> List[Dict]:
+        if not self.path.exists():
+            return []
+        with open(self.path, 'r') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return []
+    
+    def update(self, change) -> List[Dict]:
+        """Apply change(agents) to the registry as one read-modify-write"""
+        with self._lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                agents = self.load()
+                change(agents)
+                tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, 'w') as f:
+                    json.dump(agents, f, indent=2)
+                os.replace(tmp_path, self.path)
+                return agents
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def add(self, agent: Dict):
+        self.update(lambda agents: agents.append(agent))
+    
+    def set_fields(self, agent_id: str, **fields):
+        def change(agents):
+            for agent in agents:
+                if agent.get("id") == agent_id:
+                    agent.update(fields)
+        self.update(change)
+
+
+class SubAgentPool:
+    """Runs sub-agents on a thread pool, each with its own history and tools"""
+    
+    # Longest a single check_sub_agent call may block the parent
+    MAX_WAIT = 300
+    
+    # Sub-agents never get these, so they cannot fan out further
+    PARENT_ONLY_TOOLS = {"spawn_sub_agent", "check_sub_agent"}
+    
+    # Sub-agent sessions are journaled here, outside the user's sessions in ./memory
+    JOURNAL_DIR = "./memory/agents"
+    
+    def __init__(self, backend: LLMBackend, max_workers: int = 4, registry: Optional[AgentRegistry] = None,
+                 tracer: Optional[Tracer] = None, tenant: Optional[str] = None):
+        self.backend = backend
+        self.tracer = tracer
+        # Sub-agents spend their parent's tenant quota
+        self.tenant = tenant
+        self.registry = registry or AgentRegistry()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sub-agent")
+        self._agents = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+    
+    def spawn(self, name: str, role: str, tools: List[str], task: str) -> str:
+        """Start a sub-agent on its task and return its id"""
+        agent_id = uuid.uuid4().hex[:8]
+        agent = {
+            "id": agent_id,
+            "name": name,
+            "role": role,
+            "tools": tools,
+            "task": task,
+            "status": "running",
+            "spawned_at": datetime.now().isoformat()
+        }
+        self.registry.add(dict(agent))
+        with self._lock:
+            self._agents[agent_id] = agent
+            self._futures[agent_id] = self.pool.submit(self._run, agent)
+        return agent_id
+    
+    def _run(self, agent: Dict) -> str:
+        tools = [t for t in agent["tools"] if t not in self.PARENT_ONLY_TOOLS]
+        if "execute_shell" in tools and "check_shell_job" not in tools:
+            # Commands that outlive their wait come back as jobs; let the agent follow them
+            tools.append("check_shell_job")
+        system_prompt = (
+            f"You are {agent['name']}, a specialized sub-agent of AI Agent Level 5.\n"
+            f"Your role: {agent['role']}\n"
+            f"Your tools: {', '.join(tools) or 'none'}\n\n"
+            "Work on the task you are given using your tools, then reply with a concise, "
+            "self-contained report of what you found or did. Your reply is returned to the main agent."
+        )
+        brain = None
+        try:
+            # Behind the parent's turns in the API request queue
+            _request_priority.set(RequestScheduler.BACKGROUND)
+            brain = CentralBrain(
+                backend=self.backend,
+                ui=QuietUI,
+                system_prompt=system_prompt,
+                allowed_tools=tools,
+                sub_agent_workers=0,
+                session_id=f"agent_{agent['id']}",
+                # Kept apart from the user's sessions (--resume, search_memory)
+                journal_dir=self.JOURNAL_DIR,
+                tracer=self.tracer,
+                tenant=self.tenant
+            )
+            result = brain.chat(agent["task"])
+            status = "done"
+        except Exception as e:
+            result = f"Sub-agent failed: {str(e)}"
+            status = "failed"
+        finally:
+            if brain is not None:
+                brain.close()
+        
+        with self._lock:
+            agent.update(status=status, result=result, finished_at=datetime.now().isoformat())
+        self.registry.set_fields(agent["id"], status=status, result=result, finished_at=agent["finished_at"])
+        return result
+    
+    def wait(self, agent_id: str, timeout: float = 0) -> Optional[Dict]:
+        """The agent record, after waiting up to timeout seconds for it to finish"""
+        with self._lock:
+            future = self._futures.get(agent_id)
+        if future is None:
+            return None
+        if timeout > 0:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+        with self._lock:
+            return dict(self._agents[agent_id])
+    
+    def list(self) -> List[Dict]:
+        with self._lock:
+            return [dict(agent) for agent in self._agents.values()]
+    
+    def shutdown(self):
+        # Running sub-agents finish in the background; queued ones never start
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            cancelled = [agent_id for agent_id, future in self._futures.items() if future.cancelled()]
+            for agent_id in cancelled:
+                self._agents[agent_id]["status"] = "cancelled"
+        for agent_id in cancelled:
+            self.registry.set_fields(agent_id, status="cancelled")
 
 
 def verify_system():
@@ -569,9 +4909,49 @@ def verify_system():
     BeautifulUI.system_msg("System ready", "SUCCESS")
 
 
+def run_headless(prompt: str, resume: bool = False, response_cache: Optional[bool] = None,
+                 prompt_mode: Optional[str] = None) -> int:
+    """Answer one prompt with no terminal UI: answer on stdout, errors on stderr"""
+    if not prompt.strip():
+        print("Error: no prompt given (pass it as an argument or on stdin)", file=sys.stderr)
+        return 2
+    
+    try:
+        brain = CentralBrain(resume=resume, ui=QuietUI, response_cache=response_cache, prompt_mode=prompt_mode)
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    
+    try:
+        print(brain.chat(prompt))
+        return 0
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        brain.close()
+
+
 def main():
     """Main entry point"""
     
+    args = sys.argv[1:]
+    resume = "--resume" in args
+    stream = "--stream" in args
+    response_cache = True if "--cache" in args else None
+    prompt_mode = "verbose" if "--verbose-prompt" in args else None
+    
+    # Scripts and cron: python main.py --headless "prompt"  (or the prompt on stdin)
+    if "--headless" in args:
+        prompt = " ".join(a for a in args if not a.startswith("--"))
+        if not prompt and not sys.stdin.isatty():
+            prompt = sys.stdin.read()
+        return run_headless(prompt, resume=resume, response_cache=response_cache, prompt_mode=prompt_mode)
+    
+    # Warm the SDK import up while the banner shows and the user types
+    if importlib.util.find_spec("mistralai") is not None:
+        threading.Thread(target=importlib.import_module, args=("mistralai",), daemon=True).start()
+    
     os.system('clear' if os.name != 'nt' else 'cls')
     
     BeautifulUI.header()
@@ -585,7 +4965,7 @@ def main():
     BeautifulUI.separator()
     
     try:
-        brain = CentralBrain()
+        brain = CentralBrain(resume=resume, stream=stream, response_cache=response_cache, prompt_mode=prompt_mode)
         BeautifulUI.system_msg("All systems operational", "SUCCESS")
         BeautifulUI.separator()
         
@@ -604,12 +4984,16 @@ def main():
                 
                 # Get AI response
                 response = brain.chat(user_input)
-                BeautifulUI.ai_response(response)
+                if not brain.stream:
+                    with brain.tracer.span("render", view="ai_response"):
+                        BeautifulUI.ai_response(response)
                 
             except KeyboardInterrupt:
                 print(f"\n{Fore.YELLOW}Interrupt received{Style.RESET_ALL}")
                 brain.shutdown()
                 break
+            except BudgetExceeded as e:
+                BeautifulUI.error_box("BUDGET", str(e))
             except Exception as e:
                 BeautifulUI.error_box("ERROR", str(e))
                 import traceback
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+AI Agent Level 5 - Offline LLM Backends
+Scripted mock model, local stub API server and record/replay of real API calls
+
+    python offline_llm.py serve [--port 8765]     # stub of the Mistral chat API
+"""
+
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Any
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from main import LLMBackend, ReplayStream, _serializable, _message_field, completion_chunks, completion_response
+
+
+def completion_payload(content: str = "", tool_calls: Optional[List[Dict]] = None, model: str = "mock",
+                       prompt_tokens: int = 0, completion_tokens: int = 0) -> Dict:
+    """A chat.completion response body as the Mistral API returns it"""
+    return {
+        "id": f"mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "model": model,
+        "created": int(time.time()),
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        },
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls" if tool_calls else "stop",
+            "message": {"role": "assistant", "content": content, "tool_calls": tool_calls}
+        }]
+    }
+
+
+def scripted_responder(tool_hops: int = 1, tool: str = "list_files", arguments: Optional[Dict] = None,
+                       tools_per_hop: int = 1, reply_chars: int = 200) -> Callable:
+    """A deterministic model: `tool_hops` rounds of tool calls per user turn, then a reply
+
+    The reply length and the tool arguments are fixed, so runs are
+    reproducible and comparable across code changes.
+    """
+    arguments = arguments if arguments is not None else {"directory": "."}
+
+    def respond(messages: List[Any], tools: Optional[List[Dict]] = None) -> Dict:
+        # Hops already taken in this turn = assistant tool requests since the last user message
+        hops = 0
+        turn = 0
+        for message in messages:
+            role = _message_field(message, "role")
+            if role == "user":
+                hops = 0
+                turn += 1
+            elif role == "assistant" and _message_field(message, "tool_calls"):
+                hops += 1
+
+        if hops < tool_hops and tools:
+            calls = [
+                {
+                    "id": f"call_{turn}_{hops}_{i}",
+                    "type": "function",
+                    "function": {"name": tool, "arguments": json.dumps(arguments)}
+                }
+                for i in range(tools_per_hop)
+            ]
+            return completion_payload("", calls)
+
+        text = f"Turn {turn} done. " + "lorem ipsum " * (reply_chars // 12)
+        return completion_payload(text[:reply_chars])
+
+    return respond
+
+
+class MockBackend(LLMBackend):
+    """Local stand-in for the API: answers with a responder function, optional fake latency"""
+
+    def __init__(self, responder: Optional[Callable] = None, latency: float = 0.0):
+        self.responder = responder or scripted_responder()
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _payload(self, request: Dict, wait: bool = True) -> Dict:
+        with self._lock:
+            self.calls += 1
+        if wait and self.latency:
+            time.sleep(self.latency)
+        payload = self.responder(request.get("messages", []), request.get("tools"))
+        # Rough token accounting so usage-driven code paths run too
+        prompt_chars = len(json.dumps(request.get("messages", []), default=_serializable))
+        message = payload["choices"][0]["message"]
+        completion_chars = len(message.get("content") or "") + len(json.dumps(message.get("tool_calls") or []))
+        payload["usage"] = {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": completion_chars // 4,
+            "total_tokens": (prompt_chars + completion_chars) // 4
+        }
+        payload["model"] = request.get("model", payload["model"])
+        return payload
+
+    def complete(self, **request) -> Any:
+        return completion_response(self._payload(request))
+
+    def stream(self, **request) -> Any:
+        return ReplayStream(self._payload(request))
+
+    async def complete_async(self, **request) -> Any:
+        await asyncio.sleep(self.latency)
+        return completion_response(self._payload(request, wait=False))
+
+    async def stream_async(self, **request) -> Any:
+        await asyncio.sleep(self.latency)
+        return ReplayStream(self._payload(request, wait=False))
+
+
+class RecordReplayBackend(LLMBackend):
+    """Records real exchanges to a JSONL file, or replays them deterministically
+
+    mode="record" forwards to `inner` and appends every exchange;
+    mode="replay" answers from the file only. Requests are matched by a hash
+    of model, messages and tools; identical requests replay in recorded order.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", inner: Optional[LLMBackend] = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"mode must be 'record' or 'replay', not {mode!r}")
+        if mode == "record" and inner is None:
+            raise ValueError("record mode needs an inner backend to record from")
+
+        self.path = Path(path)
+        self.mode = mode
+        self.inner = inner
+        self._lock = threading.Lock()
+        self._recorded = {}
+
+        if mode == "replay":
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        self._recorded.setdefault(exchange["key"], []).append(exchange["response"])
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def request_key(request: Dict) -> str:
+        canonical = json.dumps(
+            {
+                "model": request.get("model"),
+                "messages": request.get("messages"),
+                "tools": request.get("tools")
+            },
+            sort_keys=True,
+            default=_serializable
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _exchange(self, request: Dict) -> Dict:
+        key = self.request_key(request)
+
+        if self.mode == "replay":
+            with self._lock:
+                responses = self._recorded.get(key)
+                if not responses:
+                    raise KeyError(f"No recorded exchange for this request (key {key[:12]}) in {self.path}")
+                # Keep the last one so a replayed loop that repeats itself still gets an answer
+                return responses.pop(0) if len(responses) > 1 else responses[0]
+
+        payload = _serializable(self.inner.complete(**request))
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps({
+                "key": key,
+                "request": json.loads(json.dumps(request, default=_serializable)),
+                "response": payload
+            }) + "\n")
+        return payload
+
+    def complete(self, **request) -> Any:
+        return completion_response(self._exchange(request))
+
+    def stream(self, **request) -> Any:
+        # Recorded as whole responses; replayed as chunks so streaming code paths still run
+        return ReplayStream(self._exchange(request))
+
+    async def stream_async(self, **request) -> Any:
+        return ReplayStream(await asyncio.to_thread(self._exchange, request))
+
+
+class StubServer:
+    """Local HTTP stub of the Mistral chat completions API
+
+    Point the real client at it with MISTRAL_SERVER_URL=stub.url. Supports
+    plain and streamed (server-sent events) completions.
+    """
+
+    def __init__(self, responder: Optional[Callable] = None, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0):
+        self.responder = responder or scripted_responder()
+        self.latency = latency
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stub.requests.append((time.perf_counter(), self.path, body))
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    return self._send(404, {"message": f"Unknown path {self.path}"})
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                payload = stub.responder(body.get("messages", []), body.get("tools"))
+                payload["model"] = body.get("model", payload["model"])
+                if not body.get("stream"):
+                    return self._send(200, payload)
+
+                events = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in completion_chunks(payload))
+                data = (events + "data: [DONE]\n\n").encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send(self, status: int, payload: Dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_port}"
+        self._thread = None
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    """Run the stub API server in the foreground"""
+    if sys.argv[1:2] != ["serve"]:
+        print(__doc__.strip())
+        return 1
+
+    port = int(sys.argv[sys.argv.index("--port") + 1]) if "--port" in sys.argv else 8765
+    stub = StubServer(port=port)
+    print(f"Stub Mistral API on {stub.url} - run the agent with MISTRAL_SERVER_URL={stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,663 @@
+#!/usr/bin/env python3
+"""
+AI Agent Level 5 - Server
+REST and WebSocket API over a pool of live agent sessions
+
+    python server.py [--host 127.0.0.1] [--port 8080] [--max-sessions 64] [--idle-timeout 1800] [--cache] [--stub]
+
+REST:
+    POST   /sessions                      {"session_id": optional}    -> {"session_id"}
+    GET    /sessions                                                  -> live sessions
+    POST   /sessions/<id>/messages        {"message": "..."}          -> {"answer", "events"}
+    GET    /sessions/<id>/messages                                    -> the session history
+    DELETE /sessions/<id>                                             -> close it (history stays on disk; 409 mid-turn)
+    GET    /health, /metrics (Prometheus text)
+
+WebSocket (/ws): send {"message": "...", "session_id": optional}; receive
+"session", "thinking", "status", "token", "tool_call", "tool_result",
+"shell_output", "agent_spawned" events, then {"type": "answer"} (or "error").
+
+Set AGENT_SERVER_TOKEN to require "Authorization: Bearer <token>". An
+"X-Tenant" header (or "tenant" in a WebSocket message) bills a new session
+to that tenant's token quota (see BudgetGovernor in main.py); a turn refused
+for budget gets 429 with Retry-After.
+--stub answers with the scripted model from offline_llm.py (no key or network).
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import base64
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, List, Optional, Any
+
+from main import (
+    QuietUI,
+    CentralBrain,
+    SessionJournal,
+    BudgetExceeded,
+    LLMBackend,
+    MistralBackend,
+    CachedBackend,
+    Tracer,
+    _serializable,
+)
+
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class EventUI(QuietUI):
+    """Turns what the terminal UI would draw into event dicts for the current request"""
+
+    # Tool output in events is cut to this; the model still gets all of it
+    MAX_RESULT_CHARS = 4000
+
+    def __init__(self):
+        self.sink: Optional[Callable[[Dict], None]] = None
+
+    def emit(self, event: Dict):
+        sink = self.sink
+        if sink is not None:
+            sink(event)
+
+    def system_msg(self, msg: str, status: str = "INFO"):
+        self.emit({"type": "status", "status": status.lower(), "message": msg})
+
+    def ai_thinking(self, text: str = "AI is thinking..."):
+        self.emit({"type": "thinking", "message": text})
+
+    def tool_call(self, tool_name: str, inputs: Dict, call_id: str = ""):
+        self.emit({"type": "tool_call", "tool": tool_name, "arguments": inputs, "id": call_id})
+
+    def tool_result(self, result: str, tool_name: str = "", call_id: str = ""):
+        self.emit({
+            "type": "tool_result",
+            "tool": tool_name,
+            "id": call_id,
+            "result": result[:self.MAX_RESULT_CHARS],
+            "truncated": len(result) > self.MAX_RESULT_CHARS
+        })
+
+    def agent_spawn(self, agent_name: str):
+        self.emit({"type": "agent_spawned", "name": agent_name})
+
+    def stream_token(self, text: str):
+        self.emit({"type": "token", "text": text})
+
+    def shell_output(self, text: str):
+        self.emit({"type": "shell_output", "text": text})
+
+    def error_box(self, error_type: str, details: str):
+        self.emit({"type": "error", "error": error_type, "message": details})
+
+
+class PoolFull(Exception):
+    """Every pooled session is in the middle of a turn"""
+
+
+class SessionBusy(Exception):
+    """The session is in use by a request"""
+
+
+class PooledSession:
+    """A live CentralBrain plus what the pool needs to schedule and evict it"""
+
+    def __init__(self, session_id: str, brain: Optional[CentralBrain], ui: EventUI):
+        self.session_id = session_id
+        self.brain = brain
+        self.ui = ui
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.turns = 0
+        # Requests holding the session (counted under the pool lock); pinned sessions are never evicted
+        self.pins = 0
+        # Set once the brain is built (or failed to build)
+        self.ready = threading.Event()
+        if brain is not None:
+            self.ready.set()
+
+    def chat(self, message: str, sink: Callable[[Dict], None]) -> str:
+        """One turn with its events sent to sink; turns of a session never overlap"""
+        with self.lock:
+            self.ui.sink = sink
+            try:
+                answer = self.brain.chat(message)
+                self.turns += 1
+                return answer
+            finally:
+                self.ui.sink = None
+                self.last_used = time.monotonic()
+
+    def describe(self) -> Dict:
+        return {
+            "session_id": self.session_id,
+            "messages": len(self.brain.messages),
+            "turns": self.turns,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1),
+            "busy": self.pins > 0
+        }
+
+
+class SessionPool:
+    """Live sessions sharing one backend (one API client) and one tracer
+
+    At most `max_sessions` stay in memory; the least recently used idle
+    one is closed to make room, and sessions idle for `idle_timeout`
+    seconds are closed in the background. A closed session keeps its
+    journal, so the next request for it resumes it from disk.
+    """
+
+    def __init__(self, backend: Optional[LLMBackend] = None, max_sessions: int = 64, idle_timeout: float = 1800,
+                 tracer: Optional[Tracer] = None, response_cache: Optional[bool] = None, **brain_kwargs):
+        self.backend = backend or MistralBackend(os.getenv("MISTRAL_API_KEY"))
+        if response_cache is None:
+            response_cache = os.getenv("AGENT_LLM_CACHE", "").lower() in ("1", "true", "yes")
+        if response_cache and not isinstance(self.backend, CachedBackend):
+            self.backend = CachedBackend(self.backend)
+        self.tracer = tracer or Tracer(
+            f"./memory/traces/server_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+            "./memory/metrics.prom"
+        )
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.brain_kwargs = brain_kwargs
+        self.memory_dir = "./memory"
+        self.sessions: Dict[str, PooledSession] = {}
+        self.evicted = 0
+        self._lock = threading.Lock()
+        # Sessions taken out of the pool whose brains are still closing; set once closed
+        self._closing: Dict[str, threading.Event] = {}
+        self._stop = threading.Event()
+        self._reaper = threading.Thread(target=self._reap, daemon=True, name="session-reaper")
+        self._reaper.start()
+
+    def get(self, session_id: Optional[str] = None, tenant: Optional[str] = None,
+            pin: bool = False) -> PooledSession:
+        """The live session, resumed from disk or created as needed (billed to tenant)
+
+        With pin=True the session stays pinned, so it cannot be evicted or
+        closed, until release(session).
+        """
+        if session_id is None:
+            session_id = f"{datetime.now().strftime('%Y%m%d')}_{os.urandom(4).hex()}"
+        if not SESSION_ID.match(session_id):
+            raise ValueError("session_id may only contain letters, digits, '_' and '-' (at most 64)")
+        if tenant is not None and not SESSION_ID.match(tenant):
+            raise ValueError("tenant may only contain letters, digits, '_' and '-' (at most 64)")
+
+        while True:
+            evicted = None
+            with self._lock:
+                closing = self._closing.get(session_id)
+                if closing is None:
+                    session = self.sessions.get(session_id)
+                    opening = session is None
+                    if opening:
+                        if len(self.sessions) >= self.max_sessions:
+                            evicted = self._evict_lru()
+                        # Claimed here, built below without holding the pool lock
+                        session = PooledSession(session_id, None, EventUI())
+                        self.sessions[session_id] = session
+                    session.pins += 1
+                    session.last_used = time.monotonic()
+
+            if closing is not None:
+                # Resume only once the old brain has written its journal out
+                closing.wait()
+                continue
+            if opening:
+                try:
+                    self._open(session, tenant)
+                finally:
+                    if evicted is not None:
+                        self._retire(evicted)
+            else:
+                session.ready.wait()
+            if session.brain is not None:
+                if not pin:
+                    self.release(session)
+                return session
+            # Another request failed to build it and gave up its claim; try again
+            self.release(session)
+
+    def _open(self, session: PooledSession, tenant: Optional[str]):
+        """Build the brain of a claimed session, or give up the claim"""
+        brain_kwargs = dict(self.brain_kwargs)
+        if tenant:
+            brain_kwargs["tenant"] = tenant
+        try:
+            session.brain = CentralBrain(
+                backend=self.backend,
+                tracer=self.tracer,
+                session_id=session.session_id,
+                # Evicted (or earlier) sessions carry on from their journal
+                resume=any(Path(self.memory_dir).glob(f"session_{session.session_id}.json*")),
+                ui=session.ui,
+                stream=True,
+                **brain_kwargs
+            )
+        except BaseException:
+            with self._lock:
+                if self.sessions.get(session.session_id) is session:
+                    del self.sessions[session.session_id]
+                session.pins -= 1
+            raise
+        finally:
+            session.ready.set()
+
+    def release(self, session: PooledSession):
+        """Unpin a session taken with get(pin=True)"""
+        with self._lock:
+            session.pins -= 1
+            session.last_used = time.monotonic()
+
+    @contextmanager
+    def checkout(self, session_id: Optional[str] = None, tenant: Optional[str] = None):
+        """The live session, pinned for the duration of the block"""
+        session = self.get(session_id, tenant, pin=True)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def find(self, session_id: str) -> Optional[PooledSession]:
+        """The live session, if there is one; never creates, resumes or evicts"""
+        if not SESSION_ID.match(session_id):
+            raise ValueError("session_id may only contain letters, digits, '_' and '-' (at most 64)")
+        with self._lock:
+            return self.sessions.get(session_id)
+
+    def history(self, session_id: str) -> Optional[List[Any]]:
+        """Messages of a live session, or of a closed one read from its journal; None if unknown"""
+        session = self.find(session_id)
+        if session is not None:
+            session.ready.wait()
+        if session is not None and session.brain is not None:
+            return list(session.brain.messages)
+        if not any(Path(self.memory_dir).glob(f"session_{session_id}.json*")):
+            return None
+        return SessionJournal(session_id, self.memory_dir).load()
+
+    def _evict_lru(self) -> PooledSession:
+        """Take the least recently used idle session out of the pool (under _lock)
+
+        The caller closes it with _retire() once the pool lock is released.
+        """
+        for session in sorted(self.sessions.values(), key=lambda s: s.last_used):
+            if not session.pins and not session.lock.locked():
+                self._detach(session)
+                self.evicted += 1
+                return session
+        raise PoolFull(f"All {self.max_sessions} sessions are busy; try again shortly")
+
+    def _detach(self, session: PooledSession):
+        """Remove a session from the pool until _retire() has closed it (under _lock)"""
+        del self.sessions[session.session_id]
+        self._closing[session.session_id] = threading.Event()
+
+    def _retire(self, session: PooledSession):
+        """Close a detached session's brain without holding the pool lock"""
+        try:
+            with session.lock:
+                session.brain.close()
+        finally:
+            with self._lock:
+                self._closing.pop(session.session_id).set()
+
+    def _reap(self):
+        while not self._stop.wait(min(60, max(self.idle_timeout / 4, 1))):
+            self.evict_idle()
+
+    def evict_idle(self) -> int:
+        """Close sessions idle longer than idle_timeout; returns how many"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [session for session in self.sessions.values()
+                    if not session.pins and now - session.last_used >= self.idle_timeout
+                    and not session.lock.locked()]
+            for session in idle:
+                self._detach(session)
+            self.evicted += len(idle)
+        errors = []
+        for session in idle:
+            try:
+                self._retire(session)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return len(idle)
+
+    def close_session(self, session_id: str) -> bool:
+        """Close a live session; False if there is none, SessionBusy while a request holds it"""
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            if session.pins:
+                raise SessionBusy(f"Session {session_id} is in the middle of a turn; try again shortly")
+            self._detach(session)
+        self._retire(session)
+        return True
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            return [session.describe() for session in self.sessions.values() if session.brain is not None]
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            closing = list(self._closing.values())
+        for event in closing:
+            event.wait()
+        for session in sessions:
+            session.ready.wait()
+            with session.lock:
+                if session.brain is not None:
+                    session.brain.close()
+        self.tracer.close()
+
+
+class WebSocket:
+    """Server side of RFC 6455 on a request's socket: text frames, ping/pong, close"""
+
+    # Largest message (all of its frames) a client may send; larger ones close with 1009
+    MAX_MESSAGE_BYTES = 1 << 20
+    CLOSE_TOO_BIG = 1009
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    @staticmethod
+    def accept_key(key: str) -> str:
+        return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+    def _read_frame(self, limit: int) -> tuple:
+        """(fin, opcode, payload) of the next frame; a payload over limit bytes closes the connection"""
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            raise ConnectionError("Connection closed")
+        fin, opcode = header[0] & 0x80, header[0] & 0x0F
+        masked, length = header[1] & 0x80, header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        if length > limit:
+            self.close(self.CLOSE_TOO_BIG, "Message too big")
+            raise ConnectionError(f"Frame of {length} bytes is over the {limit} byte limit")
+        mask = self.rfile.read(4) if masked else b""
+        payload = self.rfile.read(length)
+        if masked:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return bool(fin), opcode, payload
+
+    def receive(self) -> Optional[str]:
+        """The next text message, or None once the client closed"""
+        parts = []
+        size = 0
+        while True:
+            fin, opcode, payload = self._read_frame(self.MAX_MESSAGE_BYTES - size)
+            if opcode == 0x8:
+                self._send(0x8, payload[:2])
+                self.closed = True
+                return None
+            if opcode == 0x9:
+                self._send(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            parts.append(payload)
+            size += len(payload)
+            if fin:
+                return b"".join(parts).decode('utf-8', errors='replace')
+
+    def _send(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        with self._send_lock:
+            if self.closed and opcode != 0x8:
+                return
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def close(self, code: int, reason: str = ""):
+        """Send a close frame; nothing else is sent afterwards"""
+        try:
+            self._send(0x8, struct.pack(">H", code) + reason.encode()[:123])
+        except OSError:
+            pass
+        self.closed = True
+
+    def send_json(self, event: Dict):
+        try:
+            self._send(0x1, json.dumps(event, default=_serializable).encode())
+        except OSError:
+            # The client went away mid-turn; the turn still finishes and is journaled
+            self.closed = True
+
+
+def make_handler(pool: SessionPool, token: Optional[str] = None):
+    """Request handler class bound to a session pool"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        server_version = "AIAgentLevel5"
+
+        def _send(self, status: int, payload: Any, content_type: str = "application/json",
+                  headers: Optional[Dict[str, str]] = None):
+            if content_type == "application/json":
+                data = json.dumps(payload, default=_serializable).encode()
+            else:
+                data = payload.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> Dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            if not length:
+                return {}
+            body = json.loads(self.rfile.read(length))
+            if not isinstance(body, dict):
+                raise ValueError("Request body must be a JSON object")
+            return body
+
+        def _authorized(self) -> bool:
+            if not token or self.headers.get("Authorization") == f"Bearer {token}":
+                return True
+            self._send(401, {"error": "Missing or wrong bearer token"})
+            return False
+
+        def _route(self) -> List[str]:
+            return [part for part in self.path.split("?", 1)[0].split("/") if part]
+
+        def do_GET(self):
+            parts = self._route()
+            if parts == ["health"]:
+                return self._send(200, {"status": "ok", "sessions": len(pool.sessions)})
+            if not self._authorized():
+                return
+            if parts == ["metrics"]:
+                return self._send(200, pool.tracer.prometheus(), "text/plain; version=0.0.4")
+            if parts == ["sessions"]:
+                return self._send(200, {"sessions": pool.list(), "evicted": pool.evicted})
+            if parts == ["ws"] and self.headers.get("Upgrade", "").lower() == "websocket":
+                return self._websocket()
+            if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+                return self._guarded(lambda: self._history(parts[1]))
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            parts = self._route()
+            if parts == ["sessions"]:
+                return self._guarded(lambda: self._send(201, {
+                    "session_id": pool.get(self._body().get("session_id"), self.headers.get("X-Tenant")).session_id
+                }))
+            if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+                return self._guarded(lambda: self._turn(parts[1]))
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+        def do_DELETE(self):
+            if not self._authorized():
+                return
+            parts = self._route()
+            if len(parts) == 2 and parts[0] == "sessions":
+                return self._guarded(lambda: self._close(parts[1]))
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+        def _guarded(self, handle: Callable):
+            """Map request and capacity problems to status codes"""
+            try:
+                handle()
+            except (ValueError, json.JSONDecodeError) as e:
+                self._send(400, {"error": str(e)})
+            except PoolFull as e:
+                self._send(503, {"error": str(e)})
+            except SessionBusy as e:
+                self._send(409, {"error": str(e)})
+            except BudgetExceeded as e:
+                retry = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None
+                self._send(429, {"error": str(e), "retry_after": e.retry_after}, headers=retry)
+            except Exception as e:
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def _history(self, session_id: str):
+            messages = pool.history(session_id)
+            if messages is None:
+                return self._send(404, {"error": f"No session {session_id}"})
+            self._send(200, {"session_id": session_id, "messages": messages})
+
+        def _close(self, session_id: str):
+            closed = pool.close_session(session_id)
+            self._send(200 if closed else 404, {"session_id": session_id, "closed": closed})
+
+        def _turn(self, session_id: str):
+            message = self._body().get("message")
+            if not isinstance(message, str) or not message.strip():
+                raise ValueError('Body needs a non-empty "message"')
+            events = []
+            with pool.checkout(session_id, self.headers.get("X-Tenant")) as session:
+                answer = session.chat(message, events.append)
+            # Tokens are only useful live; the answer has the whole text
+            events = [e for e in events if e["type"] != "token"]
+            self._send(200, {"session_id": session_id, "answer": answer, "events": events})
+
+        def _websocket(self):
+            key = self.headers.get("Sec-WebSocket-Key")
+            if not key:
+                return self._send(400, {"error": "Missing Sec-WebSocket-Key"})
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", WebSocket.accept_key(key))
+            self.end_headers()
+            self.close_connection = True
+
+            ws = WebSocket(self.rfile, self.wfile)
+            session_id = None
+            try:
+                while not ws.closed:
+                    text = ws.receive()
+                    if text is None:
+                        break
+                    try:
+                        request = json.loads(text)
+                        if not isinstance(request, dict) or not str(request.get("message") or "").strip():
+                            raise ValueError('Send {"message": "...", "session_id": optional}')
+                        with pool.checkout(request.get("session_id") or session_id,
+                                           request.get("tenant") or self.headers.get("X-Tenant")) as session:
+                            session_id = session.session_id
+                            ws.send_json({"type": "session", "session_id": session_id})
+                            answer = session.chat(request["message"], ws.send_json)
+                        ws.send_json({"type": "answer", "session_id": session_id, "text": answer})
+                    except (ValueError, json.JSONDecodeError, PoolFull, SessionBusy) as e:
+                        ws.send_json({"type": "error", "message": str(e)})
+                    except BudgetExceeded as e:
+                        ws.send_json({"type": "error", "message": str(e), "retry_after": e.retry_after})
+                    except Exception as e:
+                        ws.send_json({"type": "error", "message": f"{type(e).__name__}: {e}"})
+            except (ConnectionError, OSError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(pool: SessionPool, host: str = "127.0.0.1", port: int = 8080,
+          token: Optional[str] = None) -> ThreadingHTTPServer:
+    """An HTTP server for the pool (not yet serving; call serve_forever)"""
+    server = ThreadingHTTPServer((host, port), make_handler(pool, token))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    """Run the server in the foreground"""
+    args = sys.argv[1:]
+
+    def option(name: str, default: str) -> str:
+        return args[args.index(name) + 1] if name in args else default
+
+    if "--help" in args or "-h" in args:
+        print(__doc__.strip())
+        return 0
+
+    if "--stub" in args:
+        from offline_llm import MockBackend
+        backend = MockBackend(latency=0.2)
+    elif os.getenv("MISTRAL_API_KEY"):
+        backend = MistralBackend(os.getenv("MISTRAL_API_KEY"))
+    else:
+        print("Error: set MISTRAL_API_KEY (or run with --stub)", file=sys.stderr)
+        return 1
+
+    pool = SessionPool(
+        backend=backend,
+        max_sessions=int(option("--max-sessions", "64")),
+        idle_timeout=float(option("--idle-timeout", "1800")),
+        response_cache=True if "--cache" in args else None
+    )
+    host, port = option("--host", "127.0.0.1"), int(option("--port", "8080"))
+    server = serve(pool, host, port, os.getenv("AGENT_SERVER_TOKEN"))
+    print(f"AI Agent Level 5 serving on http://{host}:{server.server_port} (WebSocket: ws://{host}:{server.server_port}/ws)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,63 @@
+"""Session journal: crash recovery and resume"""
+
+import json
+
+from main import SessionJournal
+
+
+def message(i):
+    return {"role": "user", "content": f"m{i}"}
+
+
+def contents(journal):
+    return [m["content"] for m in journal.load()]
+
+
+def test_resume_after_torn_journal_line_keeps_new_records(tmp_path):
+    journal = SessionJournal("s", str(tmp_path), snapshot_every=0)
+    for i in range(3):
+        journal.record(message(i))
+    journal._handle.close()
+    # Crash halfway through writing the fourth record
+    with open(journal.journal_file, 'a') as f:
+        f.write('{"seq": 3, "message": {"role": "us')
+
+    resumed = SessionJournal("s", str(tmp_path), snapshot_every=0)
+    assert contents(resumed) == ["m0", "m1", "m2"]
+    for i in range(3, 6):
+        resumed.record(message(i))
+    resumed._handle.close()
+
+    assert contents(SessionJournal("s", str(tmp_path))) == ["m0", "m1", "m2", "m3", "m4", "m5"]
+
+
+def test_fold_cut_short_by_crash_is_recovered(tmp_path):
+    journal = SessionJournal("s", str(tmp_path), snapshot_every=2)
+    for i in range(4):
+        journal.record(message(i))
+    folded = journal.snapshot_file.read_bytes()
+    journal.record(message(4))
+    journal._handle.close()
+    # Crash while the next fold was appending m4 to the snapshot in place
+    with open(journal.snapshot_file, 'r+b') as f:
+        f.seek(len(folded) - 2)
+        f.truncate()
+        f.write(b',\n{"role": "user", "con')
+
+    resumed = SessionJournal("s", str(tmp_path), snapshot_every=2)
+    assert contents(resumed) == ["m0", "m1", "m2", "m3", "m4"]
+    for i in range(5, 8):
+        resumed.record(message(i))
+    resumed.close()
+
+    assert [m["content"] for m in json.loads(resumed.snapshot_file.read_bytes())] == [f"m{i}" for i in range(8)]
+
+
+def test_fold_appends_without_rewriting_the_snapshot(tmp_path):
+    journal = SessionJournal("s", str(tmp_path), snapshot_every=1)
+    journal.record(message(0))
+    inode = journal.snapshot_file.stat().st_ino
+    for i in range(1, 5):
+        journal.record(message(i))
+    assert journal.snapshot_file.stat().st_ino == inode
+    assert contents(journal) == [f"m{i}" for i in range(5)]
@@ -0,0 +1,96 @@
+"""Model routing: which tier answers, and what reaches the screen"""
+
+import asyncio
+
+import pytest
+
+from main import CentralBrain, ModelRouter, QuietUI
+from offline_llm import MockBackend, completion_payload, scripted_responder
+from async_agent import AsyncCentralBrain
+
+
+class RecordingUI(QuietUI):
+    """Collects streamed tokens"""
+
+    tokens = []
+
+    @classmethod
+    def stream_token(cls, token):
+        cls.tokens.append(token)
+
+
+@pytest.fixture
+def ui(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    RecordingUI.tokens = []
+    return RecordingUI
+
+
+class TieredBackend(MockBackend):
+    """The small model answers tersely after one tool call; the large one answers in full"""
+
+    LARGE_ANSWER = "The directory holds the project sources and their tests."
+
+    def __init__(self):
+        super().__init__(scripted_responder(tool_hops=1))
+
+    def _payload(self, request, wait=True):
+        after_tools = any(m.get("role") == "tool" for m in request["messages"])
+        if not after_tools:
+            self.responder = scripted_responder(tool_hops=1)
+        elif request["model"] == "small":
+            self.responder = lambda messages, tools=None: completion_payload("Done.")
+        else:
+            self.responder = lambda messages, tools=None: completion_payload(self.LARGE_ANSWER)
+        return super()._payload(request, wait)
+
+
+def brain(cls, ui, final_tier=None, backend=None):
+    router = ModelRouter({ModelRouter.SMALL: ["small"], ModelRouter.LARGE: ["large"]}, final_tier=final_tier)
+    return cls(backend=backend or MockBackend(scripted_responder(tool_hops=1)), ui=ui, stream=True,
+               router=router, skills_dir=None)
+
+
+def test_routed_tool_turn_streams_final_answer(ui):
+    agent = brain(CentralBrain, ui)
+    try:
+        answer = agent.chat("list the files here")
+    finally:
+        agent.close()
+    assert answer.startswith("Turn 1 done.")
+    assert "".join(ui.tokens) == answer
+    assert len(ui.tokens) > 1
+
+
+def test_async_routed_tool_turn_streams_final_answer(ui):
+    agent = brain(AsyncCentralBrain, ui)
+    try:
+        answer = asyncio.run(agent.chat("list the files here"))
+    finally:
+        agent.close()
+    assert "".join(ui.tokens) == answer
+    assert len(ui.tokens) > 1
+
+
+def test_final_tier_large_shows_only_the_large_answer(ui):
+    agent = brain(CentralBrain, ui, final_tier=ModelRouter.LARGE)
+    try:
+        answer = agent.chat("list the files here")
+    finally:
+        agent.close()
+    assert agent.router.stats["escalations"] == 1
+    assert "".join(ui.tokens) == answer
+
+
+@pytest.mark.parametrize("cls", [CentralBrain, AsyncCentralBrain])
+def test_escalated_short_answer_is_shown_once(ui, cls):
+    agent = brain(cls, ui, backend=TieredBackend())
+    try:
+        answer = agent.chat("list the files here")
+        if asyncio.iscoroutine(answer):
+            answer = asyncio.run(answer)
+    finally:
+        agent.close()
+    assert agent.router.stats["escalations"] == 1
+    assert answer == TieredBackend.LARGE_ANSWER
+    assert "".join(ui.tokens) == answer
@@ -0,0 +1,91 @@
+"""The raw chat path against the installed Mistral SDK
+
+These fail when an SDK upgrade moves the internals SDKChatTransport uses, rather
+than letting MistralBackend quietly fall back to the slower SDK methods.
+"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from mistralai import Mistral, models
+
+from main import MistralBackend, RequestScheduler, SDKChatTransport
+
+COMPLETION = {
+    "id": "c1", "object": "chat.completion", "model": "m", "created": 0,
+    "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}]
+}
+CHUNK = {"id": "c1", "model": "m", "choices": [{"index": 0, "delta": {"content": "hi"}, "finish_reason": None}]}
+
+
+def respond(request: httpx.Request) -> httpx.Response:
+    body = json.loads(request.content)
+    if body["messages"][-1]["content"] == "fail":
+        return httpx.Response(429, headers={"retry-after": "1"}, text="slow down")
+    if body["stream"]:
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=f"data: {json.dumps(CHUNK)}\n\ndata: [DONE]\n\n".encode())
+    return httpx.Response(200, json=COMPLETION)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return respond(request)
+
+    async def async_handler(request):
+        await request.aread()
+        return handler(request)
+
+    client = Mistral(api_key="key", client=httpx.Client(transport=httpx.MockTransport(handler)),
+                     async_client=httpx.AsyncClient(transport=httpx.MockTransport(async_handler)))
+    # Only the raw path may answer
+    for name in ("complete", "stream", "complete_async", "stream_async"):
+        monkeypatch.setattr(client.chat, name, lambda *a, **k: pytest.fail("fell back to the SDK method"))
+    backend = MistralBackend(client=client, scheduler=RequestScheduler(max_retries=0))
+    backend.seen = seen
+    return backend
+
+
+def test_installed_sdk_has_the_internals_the_raw_path_uses():
+    assert SDKChatTransport.missing() == []
+
+
+def test_complete_posts_the_prebuilt_body(backend):
+    response = backend.complete(model="m", messages=[{"role": "user", "content": "hello"}])
+
+    assert isinstance(response, models.ChatCompletionResponse)
+    assert response.choices[0].message.content == "hi"
+    request = backend.seen[0]
+    assert request.url.path == "/v1/chat/completions"
+    assert request.headers["authorization"] == "Bearer key"
+    assert json.loads(request.content)["messages"] == [{"role": "user", "content": "hello"}]
+
+
+def test_stream_yields_completion_events(backend):
+    events = list(backend.stream(model="m", messages=[{"role": "user", "content": "hello"}]))
+    assert [e.data.choices[0].delta.content for e in events] == ["hi"]
+
+
+def test_async_paths(backend):
+    async def run():
+        response = await backend.complete_async(model="m", messages=[{"role": "user", "content": "hello"}])
+        stream = await backend.stream_async(model="m", messages=[{"role": "user", "content": "hello"}])
+        return response, [e.data.choices[0].delta.content async for e in stream]
+
+    response, chunks = asyncio.run(run())
+    assert response.choices[0].message.content == "hi"
+    assert chunks == ["hi"]
+
+
+def test_errors_keep_the_sdk_type_and_status(backend):
+    with pytest.raises(models.SDKError) as error:
+        backend.complete(model="m", messages=[{"role": "user", "content": "fail"}])
+    assert error.value.status_code == 429
+    assert RequestScheduler.retry_after(error.value) == 1.0
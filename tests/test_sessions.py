@@ -0,0 +1,98 @@
+"""Which sessions --resume and search_memory see, and how the server pool closes them"""
+
+import time
+import threading
+
+import pytest
+
+from main import CentralBrain, ModelRouter, QuietUI, SessionJournal, SubAgentPool, MemoryIndex
+from batch import BatchRunner
+from offline_llm import MockBackend, scripted_responder
+from server import SessionPool
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def brain(**kwargs):
+    return CentralBrain(backend=MockBackend(scripted_responder(tool_hops=0)), ui=QuietUI, skills_dir=None,
+                        router=ModelRouter({ModelRouter.LARGE: ["large"]}), sub_agent_workers=0, **kwargs)
+
+
+def test_resume_ignores_sub_agent_sessions(workdir):
+    parent = brain(session_id="user")
+    parent.chat("hello")
+    parent.close()
+
+    time.sleep(0.01)
+    pool = SubAgentPool(MockBackend(scripted_responder(tool_hops=0)), max_workers=1)
+    agent_id = pool.spawn("helper", "helps", [], "say something")
+    assert pool.wait(agent_id, timeout=10)["status"] == "done"
+    pool.shutdown()
+
+    assert (workdir / "memory" / "agents" / f"session_agent_{agent_id}.json").exists()
+    assert SessionJournal.latest_session_id() == "user"
+
+
+def test_failed_sub_agent_is_closed(workdir, monkeypatch):
+    closed = []
+    monkeypatch.setattr(CentralBrain, "chat", lambda self, message: 1 / 0)
+    monkeypatch.setattr(CentralBrain, "close", lambda self: closed.append(self.journal.session_id))
+    pool = SubAgentPool(MockBackend(), max_workers=1)
+    agent_id = pool.spawn("helper", "helps", [], "fail")
+    assert pool.wait(agent_id, timeout=10)["status"] == "failed"
+    pool.shutdown()
+    assert closed == [f"agent_{agent_id}"]
+
+
+def test_batch_sessions_stay_out_of_resume_and_memory_search(workdir):
+    parent = brain(session_id="user")
+    parent.chat("hello")
+    parent.close()
+
+    time.sleep(0.01)
+    runner = BatchRunner("out.jsonl", backend=MockBackend(scripted_responder(tool_hops=0)), skills_dir=None,
+                         router=ModelRouter({ModelRouter.LARGE: ["large"]}), sub_agent_workers=0)
+    assert runner.run(iter([{"id": "x", "prompt": "zanzibar"}]))["ok"] == 1
+
+    assert list((workdir / "memory" / "batch").glob("session_batch_*.json"))
+    assert SessionJournal.latest_session_id() == "user"
+    assert MemoryIndex().search("hello")
+    assert MemoryIndex().search("zanzibar") == []
+
+
+def test_evicted_session_closes_outside_the_pool_lock(workdir, monkeypatch):
+    closing, release = threading.Event(), threading.Event()
+    close = CentralBrain.close
+
+    def slow_close(self):
+        if self.journal.session_id == "a":
+            closing.set()
+            release.wait(10)
+        close(self)
+
+    monkeypatch.setattr(CentralBrain, "close", slow_close)
+    pool = SessionPool(MockBackend(scripted_responder(tool_hops=0)), max_sessions=1, response_cache=False,
+                       skills_dir=None, router=ModelRouter({ModelRouter.LARGE: ["large"]}), sub_agent_workers=0)
+    with pool.checkout("a") as session:
+        session.brain.chat("hello")
+
+    threading.Thread(target=pool.get, args=("b",), daemon=True).start()
+    assert closing.wait(10)
+    # The pool stays usable while "a" is still writing its journal out
+    started = time.monotonic()
+    assert [s["session_id"] for s in pool.list()] in ([], ["b"])
+    assert time.monotonic() - started < 1
+
+    resumed = []
+    waiter = threading.Thread(target=lambda: resumed.append(pool.get("a")), daemon=True)
+    waiter.start()
+    waiter.join(0.2)
+    assert not resumed
+    release.set()
+    waiter.join(10)
+    assert resumed and any(m["role"] == "user" for m in resumed[0].brain.messages)
+    pool.close()
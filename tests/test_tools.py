@@ -0,0 +1,30 @@
+"""File tools: atomic writes"""
+
+import os
+import stat
+
+from main import ToolExecutor, QuietUI
+
+
+def test_edit_through_symlink_keeps_the_link(tmp_path):
+    target = tmp_path / "real.txt"
+    target.write_text("hello world\n")
+    link = tmp_path / "link.txt"
+    link.symlink_to(target.name)
+
+    result = ToolExecutor(ui=QuietUI).execute("edit_file", {
+        "path": str(link), "edits": [{"search": "world", "replace": "there"}]
+    })
+
+    assert result.startswith("Edited")
+    assert link.is_symlink()
+    assert target.read_text() == "hello there\n"
+
+
+def test_new_file_gets_the_umask_mode(tmp_path):
+    previous = os.umask(0o027)
+    try:
+        ToolExecutor(ui=QuietUI).execute("write_file", {"path": str(tmp_path / "new.txt"), "content": "a"})
+    finally:
+        os.umask(previous)
+    assert stat.S_IMODE((tmp_path / "new.txt").stat().st_mode) == 0o640